@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+import json
+import sys
+
+import click
+
+
+def load_runs(results_fp):
+    with open(results_fp) as results_f:
+        results = json.load(results_f)
+    return results, {(r['scale'], r['runner']): r for r in results['runs']}
+
+
+def change_pct(base, new):
+    if not base or new is None:
+        return None
+    return (new - base) / base * 100
+
+
+def compare_metrics(base, new):
+    '''
+    Yields the name, base value and new value of each metric of a benchmark run along with its
+    time in seconds, where higher is better for throughputs and lower is better for times and memory.
+    '''
+    for key in ('wall_s', 'points_per_s', 'users_per_s', 'peak_rss_mb'):
+        yield key, base[key], new[key], new['wall_s']
+    for name in sorted(set(base['stages']) | set(new['stages'])):
+        base_stage, new_stage = base['stages'].get(name, {}), new['stages'].get(name, {})
+        wall_s = max(base_stage.get('wall_s', 0.0), new_stage.get('wall_s', 0.0))
+        yield f'{name}.points_per_s', base_stage.get('points_per_s'), new_stage.get('points_per_s'), wall_s
+
+
+def is_regression(metric, change, threshold_pct):
+    if change is None:
+        return False
+    higher_is_better = metric.endswith('_per_s')
+    return -change > threshold_pct if higher_is_better else change > threshold_pct
+
+
+@click.command()
+@click.argument('base_fp', type=click.Path(exists=True, dir_okay=False))
+@click.argument('new_fp', type=click.Path(exists=True, dir_okay=False))
+@click.option('--threshold', 'threshold_pct', default=10.0, help='Percent change in a metric reported as a regression.')
+@click.option('--min-seconds', default=0.5, help='Ignore regressions in stages shorter than this many seconds.')
+def main(base_fp, new_fp, threshold_pct, min_seconds):
+    '''
+    Compares two saved benchmark results and exits with an error if any metric regressed by more
+    than the threshold.
+    '''
+    base_results, base_runs = load_runs(base_fp)
+    new_results, new_runs = load_runs(new_fp)
+    click.echo(f'base: {base_results["label"]} (tripkit {base_results["environment"]["tripkit_version"]})')
+    click.echo(f'new:  {new_results["label"]} (tripkit {new_results["environment"]["tripkit_version"]})')
+    for key in ('scales', 'seed', 'workers', 'settings', 'cli_args'):
+        if base_results.get(key) != new_results.get(key):
+            click.echo(f'Warning: results were run with different {key}.')
+
+    regressions = []
+    for run_key in sorted(set(base_runs) & set(new_runs)):
+        click.echo(f'\n{run_key[1]} / {run_key[0]}')
+        for metric, base, new, wall_s in compare_metrics(base_runs[run_key], new_runs[run_key]):
+            change = change_pct(base, new)
+            flag = ''
+            if wall_s >= min_seconds and is_regression(metric, change, threshold_pct):
+                flag = '  REGRESSION'
+                regressions.append((run_key, metric))
+            base_str = f'{base:.2f}' if base is not None else '-'
+            new_str = f'{new:.2f}' if new is not None else '-'
+            change_str = f'{change:+.1f}%' if change is not None else ''
+            click.echo(f'  {metric:<32} {base_str:>12} {new_str:>12} {change_str:>9}{flag}')
+    for run_key in sorted(set(base_runs) ^ set(new_runs)):
+        click.echo(f'\n{run_key[1]} / {run_key[0]}: only in one result, skipped')
+
+    if regressions:
+        click.echo(f'\n{len(regressions)} metrics regressed by more than {threshold_pct:.0f}%.')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+from datetime import datetime
+import json
+import os
+import platform
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+from benchmarks import synthetic
+from cli.utils import maxrss_mb, tripkit_version
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_DIR, 'benchmarks', 'results')
+RUNNERS = ['itinerum', 'qstarz']
+
+CONFIG_TEMPLATE = '''\
+SURVEY_NAME = 'benchmark_{runner}'
+INPUT_DATA_DIR = {input_dir!r}
+INPUT_DATA_TYPE = '{runner}'
+OUTPUT_DATA_DIR = {output_dir!r}
+SUBWAY_STATIONS_FP = {subway_stations_fp!r}
+TRIP_DETECTION_BREAK_INTERVAL_SECONDS = 300
+TRIP_DETECTION_SUBWAY_BUFFER_METERS = 300
+TRIP_DETECTION_COLD_START_DISTANCE_METERS = 750
+TRIP_DETECTION_ACCURACY_CUTOFF_METERS = 50
+TIMEZONE = 'America/Montreal'
+ACTIVITY_LOCATION_PROXIMITY_METERS = 50
+MAP_MATCHING_BIKING_API_URL = ''
+MAP_MATCHING_DRIVING_API_URL = ''
+MAP_MATCHING_WALKING_API_URL = ''
+GIS_OUTPUT_FORMAT = 'gpkg'
+'''
+
+
+def git_revision():
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR).decode().strip()
+        changes = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_DIR)
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return f'{revision}-dirty' if changes.strip() else revision
+
+
+def environment():
+    return {
+        'git_revision': git_revision(),
+        'tripkit_version': tripkit_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def write_config(run_dir, data_dir, runner, settings):
+    config_fp = os.path.join(run_dir, 'tripkit_config.py')
+    with open(config_fp, 'w') as config_f:
+        config_f.write(
+            CONFIG_TEMPLATE.format(
+                runner=runner,
+                input_dir=os.path.join(data_dir, runner),
+                output_dir=os.path.join(run_dir, 'output'),
+                subway_stations_fp=os.path.join(data_dir, 'subway_entrances.csv'),
+            )
+        )
+        for key, value in settings:
+            config_f.write(f'{key} = {value}\n')
+    return config_fp
+
+
+def run_cli(run_dir, config_fp, workers, cli_args):
+    '''
+    Runs the tripkit-cli with profiling in a fresh process from `run_dir` and returns its wall time
+    and the peak resident memory of its process tree, or `None` where not available.
+    '''
+    cmd = [sys.executable, '-c', 'from cli.tripkit_cli import main; main()', '-c', config_fp, '--quiet', '--profile']
+    cmd += ['--workers', str(workers)] + cli_args
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get('PYTHONPATH')])))
+    log_fp = os.path.join(run_dir, 'tripkit-cli.log')
+    with open(log_fp, 'w') as log_f:
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, cwd=run_dir, env=env, stdout=log_f, stderr=subprocess.STDOUT)
+        if hasattr(os, 'wait4'):
+            _, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            peak_mb = maxrss_mb(usage)
+        else:
+            # Windows
+            proc.wait()
+            peak_mb = None
+        wall_s = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise click.ClickException(f'tripkit-cli exited with code {proc.returncode}, see log: {log_fp}')
+    return wall_s, peak_mb
+
+
+def stage_throughput(report, num_users, num_points):
+    '''
+    Returns the total time of each stage from a profile report, counting stages run once for the
+    survey with those run for each user, and its throughput in points and users per second of that
+    stage's time.
+    '''
+    stages = {}
+    for name, stage in report['run'].items():
+        stages[name] = {'wall_s': stage['wall_s'], 'cpu_s': stage['cpu_s'], 'process_peak_rss_mb': stage['process_peak_rss_mb']}
+    for name, summary in report['stages'].items():
+        stage = stages.setdefault(name, {'wall_s': 0.0, 'cpu_s': 0.0, 'process_peak_rss_mb': 0.0})
+        stage['wall_s'] += summary['wall_s']['total']
+        stage['cpu_s'] += summary['cpu_s']['total']
+        stage['process_peak_rss_mb'] = max(stage['process_peak_rss_mb'], summary['process_peak_rss_mb'])
+        stage['user_p95_s'] = summary['wall_s']['p95']
+    for stage in stages.values():
+        stage['points_per_s'] = num_points / stage['wall_s'] if stage['wall_s'] else None
+        stage['users_per_s'] = num_users / stage['wall_s'] if stage['wall_s'] else None
+    return stages
+
+
+def benchmark(work_dir, scale_name, runner, counts, workers, settings, cli_args):
+    run_dir = os.path.join(work_dir, scale_name, runner)
+    shutil.rmtree(run_dir, ignore_errors=True)
+    os.makedirs(os.path.join(run_dir, 'output'))
+    config_fp = write_config(run_dir, os.path.join(work_dir, scale_name, 'input'), runner, settings)
+    wall_s, peak_mb = run_cli(run_dir, config_fp, workers, cli_args)
+
+    with open(os.path.join(run_dir, 'output', f'benchmark_{runner}-profile.json')) as report_f:
+        report = json.load(report_f)
+    num_users, num_points = counts['users'], counts['points']
+    return {
+        'scale': scale_name,
+        'runner': runner,
+        'users': num_users,
+        'points': num_points,
+        'wall_s': wall_s,
+        'points_per_s': num_points / wall_s,
+        'users_per_s': num_users / wall_s,
+        'peak_rss_mb': peak_mb,
+        'stages': stage_throughput(report, num_users, num_points),
+    }
+
+
+@click.command()
+@click.option('-s', '--scale', 'scale_names', multiple=True, type=click.Choice(list(synthetic.SCALES)), default=['small', 'medium'], help='Synthetic survey sizes to benchmark, can be repeated.')
+@click.option('-r', '--runner', 'runners', multiple=True, type=click.Choice(RUNNERS), default=RUNNERS, help='Runners to benchmark, can be repeated.')
+@click.option('--users', type=click.IntRange(min=1), help='Override the number of users of each scale.')
+@click.option('--days', type=click.IntRange(min=1), help='Override the number of days of each scale.')
+@click.option('--interval', 'interval_s', type=click.IntRange(min=1), help='Override the seconds between points while travelling.')
+@click.option('--stationary-interval', 'stationary_interval_s', type=click.IntRange(min=1), help='Override the seconds between points while stopped.')
+@click.option('--stops', type=click.IntRange(min=0), help='Override the number of stops after work each day.')
+@click.option('--subway-entrances', type=click.IntRange(min=0), help='Override the number of subway entrances.')
+@click.option('--workers', default=1, type=click.IntRange(min=1), help='Number of worker processes for each run.')
+@click.option('--repeat', default=1, type=click.IntRange(min=1), help='Run each benchmark this many times and keep the fastest.')
+@click.option('--set', 'settings', multiple=True, help='Override a config value for each run as KEY=VALUE, can be repeated.')
+@click.option('--cli-args', default='', help='Extra tripkit-cli options for each run, such as "-wg".')
+@click.option('--seed', default=1, help='Seed for the synthetic surveys.')
+@click.option('--label', help='Name of the results file, defaults to the git revision.')
+@click.option('--work-dir', type=click.Path(file_okay=False), help='Directory for synthetic inputs and outputs, a temporary directory is used by default.')
+def main(scale_names, runners, workers, repeat, settings, cli_args, seed, label, work_dir, **overrides):
+    '''
+    Benchmarks the tripkit-cli runners end to end on synthetic surveys of increasing size and saves
+    the throughput and memory use of each processing stage to `benchmarks/results/<label>.json`.
+    '''
+    settings = [s.split('=', 1) for s in settings]
+    if any(len(s) != 2 for s in settings):
+        raise click.BadParameter('config overrides must be given as KEY=VALUE', param_hint='--set')
+    overrides = {k: v for k, v in overrides.items() if v is not None}
+    temp_dir = None if work_dir else tempfile.mkdtemp(prefix='tripkit-benchmark-')
+    work_dir = os.path.abspath(work_dir or temp_dir)
+
+    results = {
+        'label': label or git_revision(),
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'environment': environment(),
+        'workers': workers,
+        'settings': dict(settings),
+        'cli_args': cli_args,
+        'seed': seed,
+        'scales': {},
+        'runs': [],
+    }
+    try:
+        for scale_name in scale_names:
+            scale = synthetic.SCALES[scale_name]._replace(**overrides)
+            click.echo(f'Generating {scale_name} survey: {dict(scale._asdict())}')
+            counts = synthetic.generate(os.path.join(work_dir, scale_name, 'input'), scale, seed=seed)
+            results['scales'][scale_name] = dict(scale._asdict())
+
+            for runner in runners:
+                runs = []
+                for idx in range(repeat):
+                    click.echo(f'Running {runner} on {scale_name} survey ({idx + 1}/{repeat})...')
+                    runs.append(
+                        benchmark(work_dir, scale_name, runner, counts[runner], workers, settings, shlex.split(cli_args))
+                    )
+                result = min(runs, key=lambda r: r['wall_s'])
+                click.echo(
+                    f'  {result["points"]} points, {result["users"]} users in {result["wall_s"]:.2f}s: '
+                    f'{result["points_per_s"]:.0f} points/s, {result["users_per_s"]:.2f} users/s, '
+                    f'peak memory {result["peak_rss_mb"] or 0:.1f} MB'
+                )
+                results['runs'].append(result)
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    results_fp = os.path.join(RESULTS_DIR, f'{results["label"]}.json')
+    with open(results_fp, 'w') as results_f:
+        json.dump(results, results_f, indent=2)
+    click.echo(f'Saved results: {results_fp}')
+
+
+if __name__ == '__main__':
+    main()
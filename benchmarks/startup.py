@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+from benchmarks.run import REPO_DIR, RESULTS_DIR, environment, git_revision
+
+# modules that only the processing commands should import
+HEAVY_MODULES = ['tripkit', 'fiona', 'numpy', 'cli.runners.itinerum', 'cli.runners.qstarz']
+
+# runs the cli and reports which of the heavy modules were imported once it exits
+CLI_CODE = '''\
+import atexit, sys
+atexit.register(lambda: sys.stderr.write('\\nheavy-modules:' + ','.join(m for m in {heavy} if m in sys.modules)))
+from cli.tripkit_cli import main
+main()
+'''
+
+CONFIG = '''\
+SURVEY_NAME = 'startup'
+INPUT_DATA_DIR = './input'
+INPUT_DATA_TYPE = 'unknown'
+OUTPUT_DATA_DIR = './output'
+'''
+
+# command line arguments of the startup paths that should not import the heavy modules
+SCENARIOS = [
+    ('help', ['--help']),
+    ('sweep_help', ['sweep', '--help']),
+    ('import_help', ['import', '--help']),
+    ('merge_help', ['merge', '--help']),
+    ('watch_help', ['watch', '--help']),
+    ('missing_config', ['-c', 'missing_config.py']),
+    ('unknown_data_type', ['-c', 'tripkit_config.py']),
+]
+
+
+def time_cli(run_dir, args):
+    '''
+    Runs the cli in a fresh interpreter and returns its wall time in milliseconds with the heavy
+    modules it imported.
+    '''
+    cmd = [sys.executable, '-W', 'ignore', '-c', CLI_CODE.format(heavy=HEAVY_MODULES)] + args
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+    start = time.perf_counter()
+    result = subprocess.run(cmd, cwd=run_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    wall_ms = (time.perf_counter() - start) * 1000
+    marker = result.stderr.decode().rpartition('heavy-modules:')[2].strip()
+    return wall_ms, [m for m in marker.split(',') if m]
+
+
+def time_python(run_dir):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'pass'], cwd=run_dir)
+    return (time.perf_counter() - start) * 1000
+
+
+@click.command()
+@click.option('-r', '--runs', default=10, type=click.IntRange(min=1), help='Number of times each startup path is run.')
+@click.option('--max-ms', type=float, help='Fail if any startup path takes longer than this many milliseconds over the interpreter startup.')
+@click.option('--baseline', 'baseline_fp', type=click.Path(exists=True, dir_okay=False), help='Saved startup results to compare against.')
+@click.option('--threshold', 'threshold_pct', default=25.0, help='Percent slowdown from the baseline reported as a regression.')
+@click.option('--min-ms', default=10.0, help='Ignore slowdowns from the baseline smaller than this many milliseconds.')
+@click.option('--label', help='Name of the saved results file, defaults to the git revision.')
+def main(runs, max_ms, baseline_fp, threshold_pct, min_ms, label):
+    '''
+    Times the tripkit-cli startup paths that do not process data and exits with an error if any
+    imports tripkit or the runners, or is slower than the limit or the baseline.
+    '''
+    results = {'label': label or git_revision(), 'environment': environment(), 'runs': runs, 'scenarios': {}}
+    with tempfile.TemporaryDirectory() as run_dir:
+        with open(os.path.join(run_dir, 'tripkit_config.py'), 'w') as config_f:
+            config_f.write(CONFIG)
+        python_ms = statistics.median([time_python(run_dir) for _ in range(runs)])
+        click.echo(f'{"python":<20} {python_ms:>9.1f} ms')
+        results['python_ms'] = python_ms
+
+        for name, args in SCENARIOS:
+            timings, heavy = [], set()
+            for _ in range(runs):
+                wall_ms, imported = time_cli(run_dir, args)
+                timings.append(wall_ms)
+                heavy.update(imported)
+            median_ms = statistics.median(timings)
+            results['scenarios'][name] = {
+                'median_ms': median_ms,
+                'min_ms': min(timings),
+                'overhead_ms': median_ms - python_ms,
+                'heavy_modules': sorted(heavy),
+            }
+            heavy_str = f'  imports {", ".join(sorted(heavy))}' if heavy else ''
+            click.echo(f'{name:<20} {median_ms:>9.1f} ms  (+{median_ms - python_ms:.1f} ms){heavy_str}')
+
+    failures = []
+    baseline = None
+    if baseline_fp:
+        with open(baseline_fp) as baseline_f:
+            baseline = json.load(baseline_f)
+    for name, scenario in results['scenarios'].items():
+        if scenario['heavy_modules']:
+            failures.append(f'{name} imports {", ".join(scenario["heavy_modules"])}')
+        if max_ms is not None and scenario['overhead_ms'] > max_ms:
+            failures.append(f'{name} takes {scenario["overhead_ms"]:.1f} ms over the interpreter startup')
+        base = baseline['scenarios'].get(name) if baseline else None
+        if base:
+            change_ms = scenario['overhead_ms'] - base['overhead_ms']
+            if change_ms > min_ms and change_ms / max(base['overhead_ms'], 1e-6) * 100 > threshold_pct:
+                failures.append(f'{name} is {change_ms:.1f} ms slower than {baseline["label"]}')
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    results_fp = os.path.join(RESULTS_DIR, f'startup-{results["label"]}.json')
+    with open(results_fp, 'w') as results_f:
+        json.dump(results, results_f, indent=2)
+    click.echo(f'Saved results to {results_fp}')
+
+    if failures:
+        for failure in failures:
+            click.echo(f'REGRESSION: {failure}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+import os
+import shutil
+import sys
+import tempfile
+
+import click
+
+from benchmarks import synthetic
+from benchmarks.run import write_config
+
+# a grid of every itinerum trip detection parameter, including values either side of the defaults
+DEFAULT_PARAMS = [
+    'BREAK_INTERVAL_SECONDS=180,300,600',
+    'SUBWAY_BUFFER_METERS=100,300',
+    'COLD_START_DISTANCE_METERS=500:1000:250',
+    'ACCURACY_CUTOFF_METERS=20,50',
+]
+
+
+def trip_signature(trip):
+    '''
+    Returns the attributes of a trip and its points written to the trip outputs.
+    '''
+    points = [
+        (p.database_id, p.latitude, p.longitude, p.h_accuracy, p.distance_before, p.trip_distance, p.period_before, p.timestamp_UTC)
+        for p in trip.points
+    ]
+    return trip.num, trip.trip_code, points
+
+
+def check(cfg, param_args):
+    '''
+    Returns the user ID and parameters of each combination of a sweep for which the itinerum runner's
+    `sweep_user` detects different trips or complete days than `triplab.v2.algorithm.run()`.
+
+    :param cfg:        The tripkit config for the survey.
+    :param param_args: The `NAME=VALUES` arguments of the parameters to sweep.
+    '''
+    from cli import coordinates, loader, sweep
+    from cli.runners import itinerum
+
+    grid = sweep.parse_grid(param_args, itinerum.SWEEP_PARAMS)
+    combos = sweep.combinations(grid)
+    configs = sweep.sweep_configs(sweep.config_values(cfg), combos)
+    tripkit = itinerum.setup(cfg)
+    algorithm = tripkit.process.trip_detection.triplab.v2.algorithm
+    counter = tripkit.process.complete_days.triplab.counter
+
+    click.echo(f'Checking {len(combos)} configs of {", ".join(sorted(grid))}...')
+    mismatches = []
+    num_users = 0
+    for user in loader.iter_users(tripkit):
+        num_users += 1
+        coordinates.materialize(user)
+        swept = itinerum.sweep_user(tripkit, user, configs)
+        for combo, user_cfg, (trips, complete_day_summaries) in zip(combos, configs, swept):
+            expected_trips = algorithm.run(user.coordinates, parameters=itinerum.trip_detection_parameters(tripkit, user, user_cfg))
+            expected_summaries = counter.run(expected_trips, cfg.TIMEZONE)
+            same_trips = [trip_signature(t) for t in trips] == [trip_signature(t) for t in expected_trips]
+            same_stats = sweep.user_stats(trips, complete_day_summaries) == sweep.user_stats(expected_trips, expected_summaries)
+            if not (same_trips and same_stats):
+                click.echo(f'  {user.uuid} {combo}: {len(trips)} swept trips, {len(expected_trips)} expected')
+                mismatches.append((user.uuid, combo))
+    click.echo(f'Checked {num_users} users.')
+    return mismatches
+
+
+@click.command()
+@click.option('-p', '--param', 'param_args', multiple=True, help='Parameter values to check as NAME=VALUES, defaults to a grid of every parameter.')
+@click.option('--users', default=4, type=click.IntRange(min=1), help='Number of users of the synthetic survey.')
+@click.option('--days', default=2, type=click.IntRange(min=1), help='Number of days of the synthetic survey.')
+@click.option('--seed', default=1, help='Seed for the synthetic survey.')
+@click.option('--work-dir', type=click.Path(file_okay=False), help='Directory for synthetic inputs and outputs, a temporary directory is used by default.')
+def main(param_args, users, days, seed, work_dir):
+    '''
+    Checks that a parameter sweep of the itinerum runner, which detects trips from coordinates
+    projected once per user, finds the same trips and complete days as tripkit's trip detection
+    with each config, and exits with an error if any user's results differ.
+    '''
+    from cli.tripkit_cli import dynamic_import
+
+    temp_dir = None if work_dir else tempfile.mkdtemp(prefix='tripkit-sweep-check-')
+    work_dir = os.path.abspath(work_dir or temp_dir)
+    cwd = os.getcwd()
+    try:
+        run_dir = os.path.join(work_dir, 'itinerum')
+        shutil.rmtree(run_dir, ignore_errors=True)
+        os.makedirs(os.path.join(run_dir, 'output'))
+        input_dir = os.path.join(work_dir, 'input')
+        synthetic.generate(input_dir, synthetic.SCALES['small']._replace(users=users, days=days), seed=seed)
+        cfg = dynamic_import(write_config(run_dir, input_dir, 'itinerum', []), 'tripkit_config')
+        # tripkit creates its cache database in the working directory
+        os.chdir(run_dir)
+        mismatches = check(cfg, param_args or DEFAULT_PARAMS)
+    finally:
+        os.chdir(cwd)
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    if mismatches:
+        click.echo(f'{len(mismatches)} user configs detected different trips than tripkit.')
+        sys.exit(1)
+    click.echo('Sweep trips match tripkit.')
+
+
+if __name__ == '__main__':
+    main()
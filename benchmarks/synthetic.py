@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+from collections import namedtuple
+import csv
+from datetime import datetime, timedelta
+import math
+import os
+import random
+import uuid
+
+CITY_CENTER = (45.5017, -73.5673)
+CITY_RADIUS_M = 9000
+SUBWAY_LINES = 4
+ENTRANCES_PER_STATION = 3
+SUBWAY_MIN_RIDE_M = 2000
+START_DATE = datetime(2019, 10, 1)
+UTC_OFFSET = timedelta(hours=4)  # America/Montreal during EDT
+
+# travel speeds in m/s
+SPEEDS = {'walk': 1.3, 'bike': 4.5, 'car': 11.0, 'subway': 9.0}
+
+Scale = namedtuple('Scale', ['users', 'days', 'interval_s', 'stationary_interval_s', 'stops', 'subway_entrances'])
+SCALES = {
+    'small': Scale(users=5, days=2, interval_s=10, stationary_interval_s=300, stops=1, subway_entrances=60),
+    'medium': Scale(users=25, days=3, interval_s=5, stationary_interval_s=120, stops=2, subway_entrances=300),
+    'large': Scale(users=100, days=7, interval_s=10, stationary_interval_s=60, stops=3, subway_entrances=1000),
+}
+
+ITINERUM_SURVEY_HEADERS = [
+    'uuid',
+    'created_at_UTC',
+    'modified_at_UTC',
+    'itinerum_version',
+    'location_home_lat',
+    'location_home_lon',
+    'location_study_lat',
+    'location_study_lon',
+    'location_work_lat',
+    'location_work_lon',
+    'member_type',
+    'model',
+    'os',
+    'os_version',
+    'travel_mode_work',
+    'travel_mode_alt_work',
+    'travel_mode_study',
+    'travel_mode_alt_study',
+]
+ITINERUM_COORDINATES_HEADERS = [
+    'uuid',
+    'latitude',
+    'longitude',
+    'altitude',
+    'speed',
+    'direction',
+    'h_accuracy',
+    'v_accuracy',
+    'acceleration_x',
+    'acceleration_y',
+    'acceleration_z',
+    'point_type',
+    'mode_detected',
+    'timestamp_UTC',
+    'timestamp_epoch',
+]
+ITINERUM_PROMPTS_HEADERS = [
+    'uuid',
+    'prompt_uuid',
+    'prompt_num',
+    'response',
+    'latitude',
+    'longitude',
+    'displayed_at_UTC',
+    'displayed_at_epoch',
+    'recorded_at_UTC',
+    'recorded_at_epoch',
+    'edited_at_UTC',
+    'edited_at_epoch',
+]
+ITINERUM_CANCELLED_PROMPTS_HEADERS = [
+    'uuid',
+    'prompt_uuid',
+    'latitude',
+    'longitude',
+    'displayed_at_UTC',
+    'displayed_at_epoch',
+    'cancelled_at_UTC',
+    'cancelled_at_epoch',
+    'is_travelling',
+]
+QSTARZ_COORDINATES_HEADERS = [
+    'INDEX',
+    'UTC_DATE',
+    'UTC_TIME',
+    'LOCAL_DATE',
+    'LOCAL_TIME',
+    'LATITUDE',
+    'N/S',
+    'LONGITUDE',
+    'E/W',
+    'ALTITUDE',
+    'SPEED',
+    'USER',
+]
+
+# a recorded point in metres from the city center with its local time and speed in m/s
+Point = namedtuple('Point', ['x', 'y', 'local_time', 'speed', 'h_accuracy'])
+
+
+def to_latlon(x, y):
+    lat = CITY_CENTER[0] + y / 110574.0
+    lon = CITY_CENTER[1] + x / (111320.0 * math.cos(math.radians(CITY_CENTER[0])))
+    return lat, lon
+
+
+def _random_place(rng):
+    angle = rng.uniform(0, 2 * math.pi)
+    dist = CITY_RADIUS_M * math.sqrt(rng.random())
+    return (dist * math.cos(angle), dist * math.sin(angle))
+
+
+def _distance(a, b):
+    return math.hypot(b[0] - a[0], b[1] - a[1])
+
+
+def subway_entrances(rng, count):
+    '''
+    Returns subway entrances as (x, y) metres from the city center, grouped around stations spaced
+    evenly along straight lines crossing the city.
+
+    :param rng:   The random generator.
+    :param count: The number of entrances.
+    '''
+    num_stations = math.ceil(count / ENTRANCES_PER_STATION)
+    stations_per_line = max(math.ceil(num_stations / SUBWAY_LINES), 2)
+    entrances = []
+    for line in range(SUBWAY_LINES):
+        angle = math.pi * line / SUBWAY_LINES + rng.uniform(-0.2, 0.2)
+        for idx in range(stations_per_line):
+            along = -CITY_RADIUS_M + 2 * CITY_RADIUS_M * idx / (stations_per_line - 1)
+            station = (along * math.cos(angle), along * math.sin(angle))
+            for _ in range(ENTRANCES_PER_STATION):
+                entrances.append((station[0] + rng.gauss(0, 30), station[1] + rng.gauss(0, 30)))
+    return entrances[:count]
+
+
+class UserDiary(object):
+    '''
+    Generates a user's recorded points from a daily schedule of home, work and other stops, with
+    the travel mode of each trip chosen by its distance. Points are recorded every `interval_s` while
+    travelling, with no points recorded underground between subway entrances. The same schedule is
+    generated for any recording interval while stopped so both exports describe the same travel.
+
+    :param seed:      The seed for this user.
+    :param scale:     The :py:class:`Scale` of the synthetic survey.
+    :param entrances: The survey's subway entrances.
+    '''
+
+    def __init__(self, seed, scale, entrances):
+        rng = random.Random(seed)
+        self.scale = scale
+        self.entrances = entrances
+        self.home = _random_place(rng)
+        self.work = _random_place(rng)
+        self.places = [_random_place(rng) for _ in range(max(scale.stops, 1) * 3)]
+        self.schedule_seed = rng.getrandbits(64)
+
+    def _fix(self, x, y, t, speed, noise_m):
+        # occasional poor fixes exercise the accuracy cutoff
+        if self.noise.random() < 0.02:
+            h_accuracy = self.noise.uniform(60, 150)
+        else:
+            h_accuracy = self.noise.uniform(5, 20)
+        x, y = x + self.noise.gauss(0, noise_m), y + self.noise.gauss(0, noise_m)
+        self.points.append(Point(x, y, t, speed, h_accuracy))
+
+    def stay(self, place, t, until):
+        # consecutive fixes of a stationary receiver drift by only a few metres
+        while t < until:
+            self._fix(place[0], place[1], t, 0.0, 3)
+            t += timedelta(seconds=self.stationary_interval_s)
+        return until
+
+    def move(self, orig, dest, t, mode, recorded=True):
+        speed = SPEEDS[mode] * self.rng.uniform(0.8, 1.2)
+        duration_s = _distance(orig, dest) / speed
+        if recorded:
+            steps = max(int(duration_s / self.scale.interval_s), 1)
+            for step in range(steps + 1):
+                f = step / steps
+                x, y = orig[0] + (dest[0] - orig[0]) * f, orig[1] + (dest[1] - orig[1]) * f
+                self._fix(x, y, t + timedelta(seconds=duration_s * f), speed, 5)
+        return t + timedelta(seconds=duration_s)
+
+    def _nearest_entrance(self, place, min_distance_m=0, away_from=None):
+        candidates = [e for e in self.entrances if not away_from or _distance(away_from, e) >= min_distance_m]
+        return min(candidates or self.entrances, key=lambda e: _distance(place, e))
+
+    def trip(self, orig, dest, t, subway=False):
+        distance = _distance(orig, dest)
+        if self.entrances and (subway or (distance > 2500 and self.rng.random() < 0.4)):
+            entrance = self._nearest_entrance(orig)
+            exit_ = self._nearest_entrance(dest, min_distance_m=SUBWAY_MIN_RIDE_M, away_from=entrance)
+            if _distance(entrance, exit_) >= SUBWAY_MIN_RIDE_M:
+                t = self.move(orig, entrance, t, 'walk')
+                t = self.move(entrance, exit_, t + timedelta(minutes=self.rng.uniform(2, 6)), 'subway', recorded=False)
+                return self.move(exit_, dest, t, 'walk')
+        if distance < 1500:
+            mode = 'walk'
+        elif distance < 5000:
+            mode = self.rng.choice(['bike', 'car'])
+        else:
+            mode = 'car'
+        return self.move(orig, dest, t, mode)
+
+    def generate(self, stationary_interval_s):
+        '''
+        Returns the user's recorded points for all days of the survey.
+
+        :param stationary_interval_s: The seconds between points recorded while stopped.
+        '''
+        self.rng = random.Random(self.schedule_seed)
+        self.noise = random.Random(self.schedule_seed + 1)
+        self.stationary_interval_s = stationary_interval_s
+        self.points = []
+        for day in range(self.scale.days):
+            midnight = START_DATE + timedelta(days=day)
+            leave_home = midnight + timedelta(hours=7, minutes=self.rng.uniform(30, 90))
+            t = self.stay(self.home, midnight + timedelta(hours=4), leave_home)
+            t = self.trip(self.home, self.work, t)
+            t = self.stay(self.work, t, midnight + timedelta(hours=16, minutes=self.rng.uniform(30, 90)))
+            location = self.work
+            for stop in self.rng.sample(self.places, self.scale.stops):
+                t = self.trip(location, stop, t)
+                t = self.stay(stop, t, t + timedelta(minutes=self.rng.uniform(10, 40)))
+                location = stop
+            # return home by subway on the first day so every user has a signal gap between trips
+            t = self.trip(location, self.home, t, subway=day == 0)
+            self.stay(self.home, t, midnight + timedelta(hours=23, minutes=59))
+        return self.points
+
+
+def _utc(point):
+    return point.local_time + UTC_OFFSET
+
+
+def write_subway_entrances(csv_fp, entrances):
+    with open(csv_fp, 'w', newline='') as csv_f:
+        writer = csv.writer(csv_f, dialect='excel')
+        writer.writerow(['latitude', 'longitude'])
+        writer.writerows(to_latlon(x, y) for x, y in entrances)
+
+
+def write_itinerum(input_dir, diaries, rng):
+    os.makedirs(input_dir, exist_ok=True)
+    survey_f = open(os.path.join(input_dir, 'survey_responses.csv'), 'w', newline='')
+    coordinates_f = open(os.path.join(input_dir, 'coordinates.csv'), 'w', newline='')
+    survey_writer = csv.writer(survey_f, dialect='excel')
+    coordinates_writer = csv.writer(coordinates_f, dialect='excel')
+    survey_writer.writerow(ITINERUM_SURVEY_HEADERS)
+    coordinates_writer.writerow(ITINERUM_COORDINATES_HEADERS)
+    num_points = 0
+    for diary in diaries:
+        points = diary.generate(diary.scale.stationary_interval_s)
+        uuid_str = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        created_at = (START_DATE + UTC_OFFSET).strftime('%Y-%m-%d %H:%M:%S')
+        home_lat, home_lon = to_latlon(*diary.home)
+        work_lat, work_lon = to_latlon(*diary.work)
+        survey_writer.writerow(
+            [uuid_str, created_at, created_at, '99', home_lat, home_lon, None, None, work_lat, work_lon]
+            + ['employed', 'iPhone', 'ios', '12.4', 'subway', 'walking', None, None]
+        )
+        for p in points:
+            lat, lon = to_latlon(p.x, p.y)
+            timestamp_UTC = _utc(p)
+            epoch = int((timestamp_UTC - datetime(1970, 1, 1)).total_seconds())
+            coordinates_writer.writerow(
+                [uuid_str, lat, lon, 30, p.speed, 0, p.h_accuracy, 10, 0, 0, 0, None, None]
+                + [timestamp_UTC.strftime('%Y-%m-%d %H:%M:%S'), epoch]
+            )
+        num_points += len(points)
+    survey_f.close()
+    coordinates_f.close()
+
+    # prompts are not used by the runner but are required by the loader
+    for fn, headers in [
+        ('prompt_responses.csv', ITINERUM_PROMPTS_HEADERS),
+        ('cancelled_prompts.csv', ITINERUM_CANCELLED_PROMPTS_HEADERS),
+    ]:
+        with open(os.path.join(input_dir, fn), 'w', newline='') as csv_f:
+            csv.writer(csv_f, dialect='excel').writerow(headers)
+    return num_points
+
+
+def write_qstarz(input_dir, diaries):
+    os.makedirs(input_dir, exist_ok=True)
+    num_points = 0
+    with open(os.path.join(input_dir, 'coordinates.csv'), 'w', newline='') as csv_f:
+        writer = csv.writer(csv_f, dialect='excel')
+        writer.writerow(QSTARZ_COORDINATES_HEADERS)
+        for user_idx, diary in enumerate(diaries):
+            # GPS loggers record at a fixed interval whether travelling or stopped
+            for p in diary.generate(diary.scale.interval_s):
+                num_points += 1
+                lat, lon = to_latlon(p.x, p.y)
+                timestamp_UTC = _utc(p)
+                writer.writerow(
+                    [num_points, timestamp_UTC.strftime('%Y/%m/%d'), timestamp_UTC.strftime('%H:%M:%S')]
+                    + [p.local_time.strftime('%Y/%m/%d'), p.local_time.strftime('%H:%M:%S')]
+                    + [abs(lat), 'N' if lat >= 0 else 'S', abs(lon), 'E' if lon >= 0 else 'W']
+                    + [30, p.speed * 3.6, f'user{user_idx}']
+                )
+    return num_points
+
+
+def generate(output_dir, scale, seed=1):
+    '''
+    Writes a synthetic survey as Itinerum and QStarz .csv exports of the same users' travel, along
+    with the survey's subway entrances. Itinerum points are recorded every `stationary_interval_s`
+    while stopped, as the app does to save battery, and QStarz points every `interval_s` throughout.
+    Returns the number of users and coordinates of each export.
+
+    :param output_dir: The directory for the `itinerum` and `qstarz` input directories and
+                       `subway_entrances.csv`.
+    :param scale:      The :py:class:`Scale` of the synthetic survey.
+    :param seed:       The seed for a reproducible survey.
+    '''
+    rng = random.Random(seed)
+    entrances = subway_entrances(rng, scale.subway_entrances)
+    diaries = [UserDiary(rng.getrandbits(64), scale, entrances) for _ in range(scale.users)]
+
+    os.makedirs(output_dir, exist_ok=True)
+    write_subway_entrances(os.path.join(output_dir, 'subway_entrances.csv'), entrances)
+    return {
+        'itinerum': {'users': scale.users, 'points': write_itinerum(os.path.join(output_dir, 'itinerum'), diaries, rng)},
+        'qstarz': {'users': scale.users, 'points': write_qstarz(os.path.join(output_dir, 'qstarz'), diaries)},
+    }
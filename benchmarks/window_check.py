@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+from contextlib import closing
+import csv
+import json
+import math
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import uuid
+
+import click
+
+from benchmarks import synthetic
+from benchmarks.run import run_cli, write_config
+from cli import shards
+
+# tables of the cache database written by processing
+DATABASE_TABLES = ['detected_trip_coordinates', 'detected_trip_day_summaries']
+WINDOWS = ['day', 'week']
+# canue averages merged activity locations in set order, which varies with the hash seed of each
+# process, so their coordinates can differ in the last bits between any two runs
+FLOAT_TOLERANCE = 1e-9
+
+
+def user_labels(run_dir):
+    '''
+    Returns the QStarz user ID of each user's uuid in the dashed and hex forms written to the outputs,
+    since tripkit generates new uuids for the users of each run's cache database.
+    '''
+    with open(os.path.join(run_dir, '_temp', 'benchmark_qstarz.json')) as lookup_f:
+        uuid_lookup = json.load(lookup_f)
+    labels = {}
+    for orig_id, user_uuid in uuid_lookup.items():
+        labels[user_uuid] = orig_id
+        labels[uuid.UUID(user_uuid).hex] = orig_id
+    return labels
+
+
+def relabel(value, labels):
+    return labels.get(value, value) if isinstance(value, str) else value
+
+
+def sort_key(row):
+    return [(value is None, str(value)) for value in row]
+
+
+def is_same(expected, value):
+    '''
+    Returns whether two outputs are equal, with floats compared within `FLOAT_TOLERANCE`.
+    '''
+    if isinstance(expected, float) and isinstance(value, float):
+        return math.isclose(expected, value, rel_tol=0, abs_tol=FLOAT_TOLERANCE)
+    if isinstance(expected, dict) and isinstance(value, dict):
+        return expected.keys() == value.keys() and all(is_same(expected[k], value[k]) for k in expected)
+    if isinstance(expected, (list, tuple)) and isinstance(value, (list, tuple)):
+        return len(expected) == len(value) and all(is_same(e, v) for e, v in zip(expected, value))
+    return expected == value
+
+
+def read_csv(fp, header_rows, matched_rows, labels):
+    '''
+    Returns the header rows shared by every user of a survey-wide .csv file and its other rows sorted,
+    with the users' uuids replaced by their QStarz user IDs, since users are written in the order of
+    their uuids and the remaining header rows are those of the first user.
+    '''
+    with open(fp, newline='') as csv_f:
+        rows = list(csv.reader(csv_f))
+    body = [[relabel(value, labels) for value in row] for row in rows[header_rows:]]
+    return rows[:matched_rows], sorted(body, key=sort_key)
+
+
+def read_geopackage(fp, labels):
+    '''
+    Returns the properties and geometry coordinates of the features of each layer of a GeoPackage by
+    the layer's name without its user's uuid, read as data so files are compared without the creation
+    times of their metadata.
+    '''
+    import fiona
+
+    layers = {}
+    for layer in fiona.listlayers(fp):
+        with fiona.open(fp, layer=layer) as src:
+            features = [({k: relabel(v, labels) for k, v in f['properties'].items()}, f['geometry']['coordinates']) for f in src]
+        layers[layer.split('_', 1)[-1]] = features
+    return layers
+
+
+def read_database(fp, labels):
+    '''
+    Returns the sorted rows of the cache database tables written by processing without their
+    autoincrement ids. Users are labeled by their QStarz user IDs and the trip points referenced by
+    the day summaries by their user, trip and timestamp.
+    '''
+    tables = {}
+    point_keys = {}
+    with closing(sqlite3.connect(fp)) as conn:
+        for table in DATABASE_TABLES:
+            cursor = conn.execute(f'SELECT * FROM {table} ORDER BY id')
+            columns = [c[0] for c in cursor.description]
+            rows = []
+            for values in cursor:
+                row = {c: relabel(v, labels) for c, v in zip(columns, values)}
+                if table == 'detected_trip_coordinates':
+                    point_keys[row['id']] = (row['user_id'], row['trip_num'], row['timestamp_UTC'])
+                for column in ('start_point_id', 'end_point_id'):
+                    if column in row:
+                        row[column] = point_keys.get(row[column])
+                rows.append([row[c] for c in columns if c != 'id'])
+            tables[table] = sorted(rows, key=sort_key)
+    return tables
+
+
+def read_outputs(run_dir):
+    '''
+    Returns the contents of a run's output files other than its profile, and the rows of the cache
+    database tables it wrote, by names without the users' uuids.
+    '''
+    labels = user_labels(run_dir)
+    csv_headers = {f'benchmark_qstarz-{name}.csv': (rows, matched) for name, rows, matched in shards.MERGED_CSV_OUTPUTS}
+    outputs = {}
+    output_dir = os.path.join(run_dir, 'output')
+    for filename in sorted(os.listdir(output_dir)):
+        fp = os.path.join(output_dir, filename)
+        if filename.startswith('benchmark_qstarz-profile.'):
+            continue
+        if filename.endswith('.gpkg'):
+            user_uuid, name = filename.split('_', 1)
+            outputs[f'{relabel(user_uuid, labels)}_{name}'] = read_geopackage(fp, labels)
+        else:
+            outputs[filename] = read_csv(fp, *csv_headers.get(filename, (1, 1)), labels)
+    outputs.update(read_database(os.path.join(run_dir, '_temp', 'benchmark_qstarz.sqlite'), labels))
+    return outputs
+
+
+def run(work_dir, input_dir, name, cli_args):
+    run_dir = os.path.join(work_dir, name)
+    shutil.rmtree(run_dir, ignore_errors=True)
+    os.makedirs(os.path.join(run_dir, 'output'))
+    config_fp = write_config(run_dir, input_dir, 'qstarz', [])
+    run_cli(run_dir, config_fp, 1, ['--write-geo'] + cli_args)
+    return read_outputs(run_dir)
+
+
+@click.command()
+@click.option('-w', '--window', 'windows', multiple=True, type=click.Choice(WINDOWS), default=WINDOWS, help='Windows to check, can be repeated.')
+@click.option('--users', default=3, type=click.IntRange(min=1), help='Number of users of the synthetic survey.')
+@click.option('--days', default=9, type=click.IntRange(min=1), help='Number of days of the synthetic survey, more than a week to span several windows.')
+@click.option('--seed', default=1, help='Seed for the synthetic survey.')
+@click.option('--work-dir', type=click.Path(file_okay=False), help='Directory for synthetic inputs and outputs, a temporary directory is used by default.')
+def main(windows, users, days, seed, work_dir):
+    '''
+    Runs the QStarz runner on the same synthetic survey with and without `--window` and exits with
+    an error if the activity locations, trips or summaries of any windowed run differ.
+    '''
+    temp_dir = None if work_dir else tempfile.mkdtemp(prefix='tripkit-window-check-')
+    work_dir = os.path.abspath(work_dir or temp_dir)
+    mismatches = []
+    try:
+        input_dir = os.path.join(work_dir, 'input')
+        synthetic.generate(input_dir, synthetic.SCALES['small']._replace(users=users, days=days), seed=seed)
+        click.echo('Running without a window...')
+        expected = run(work_dir, input_dir, 'full', [])
+        for window in windows:
+            click.echo(f'Running with --window {window}...')
+            outputs = run(work_dir, input_dir, window, ['--window', window])
+            for name in sorted(set(expected) | set(outputs)):
+                if not is_same(expected.get(name), outputs.get(name)):
+                    click.echo(f'  {name} differs')
+                    mismatches.append((window, name))
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    if mismatches:
+        click.echo(f'{len(mismatches)} outputs of windowed runs differ.')
+        sys.exit(1)
+    click.echo(f'Windowed outputs match for {len(expected)} outputs.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+import hashlib
+import json
+import logging
+import os
+import pickle
+
+from tripkit.utils.misc import temp_path
+
+from cli.cache import evict_lru
+from cli.utils import tripkit_version
+
+logger = logging.getLogger('itinerum-tripkit-cli.artifacts')
+
+# increment when the pickled stage outputs change to invalidate existing artifacts
+ARTIFACT_FORMAT_VERSION = 1
+DEFAULT_ARTIFACTS_MAX_MB = 1024
+
+# returned by `ArtifactStore.load()` when no artifact matches since `None` is a valid stage output
+MISSING = object()
+
+
+class ArtifactStore(object):
+    '''
+    On-disk store of each user's processing stage outputs pickled under a key of the stage's
+    inputs and config parameters. Only the latest artifact of each stage is kept for a user so
+    a changed parameter replaces the artifacts of the stages downstream of it as they rerun. The
+    artifacts of the least recently used users are evicted once the store grows beyond
+    `ARTIFACTS_MAX_MB` from the config. Each survey, and so each shard, has its own store.
+
+    :param cfg: The tripkit config for the survey.
+    '''
+
+    def __init__(self, cfg):
+        self.artifacts_dir = temp_path(f'{cfg.SURVEY_NAME}-artifacts')
+        self.max_bytes = getattr(cfg, 'ARTIFACTS_MAX_MB', DEFAULT_ARTIFACTS_MAX_MB) * 1024 * 1024
+        os.makedirs(self.artifacts_dir, exist_ok=True)
+
+    def key(self, parts):
+        '''
+        Returns the key of a stage output from its JSON-serializable identifying parts.
+        '''
+        parts = dict(parts, tripkit_version=tripkit_version(), format_version=ARTIFACT_FORMAT_VERSION)
+        return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _user_dir(self, uuid):
+        return os.path.join(self.artifacts_dir, str(uuid))
+
+    def load(self, uuid, stage, key):
+        '''
+        Returns a user's stored stage output for a key or `MISSING` when not stored.
+        '''
+        artifact_fp = os.path.join(self._user_dir(uuid), f'{stage}-{key}.pickle')
+        try:
+            os.utime(self._user_dir(uuid))  # mark as recently used
+            with open(artifact_fp, 'rb') as artifact_f:
+                return pickle.load(artifact_f)
+        except FileNotFoundError:
+            # not stored, or evicted by another worker process
+            return MISSING
+
+    def save(self, uuid, stage, key, value):
+        user_dir = self._user_dir(uuid)
+        os.makedirs(user_dir, exist_ok=True)
+        artifact_fp = os.path.join(user_dir, f'{stage}-{key}.pickle')
+        tmp_fp = f'{artifact_fp}.tmp'
+        with open(tmp_fp, 'wb') as artifact_f:
+            pickle.dump(value, artifact_f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        # replace the artifact of this stage from any previous parameters
+        for fn in os.listdir(user_dir):
+            if fn.startswith(f'{stage}-') and fn.endswith('.pickle') and fn != os.path.basename(artifact_fp):
+                os.remove(os.path.join(user_dir, fn))
+        os.replace(tmp_fp, artifact_fp)
+        logger.debug(f'Saved {stage} artifact for {uuid}.')
+        self.evict(keep=user_dir)
+
+    def evict(self, keep=None):
+        '''
+        Removes the artifacts of the least recently used users until the store fits within its size limit.
+
+        :param keep: (Optional) A user's artifacts directory to never evict, such as the user just saved.
+        '''
+        entries = []
+        for entry in os.listdir(self.artifacts_dir):
+            user_dir = os.path.join(self.artifacts_dir, entry)
+            try:
+                entries.append((os.path.getmtime(user_dir), user_dir))
+            except FileNotFoundError:
+                continue
+        evict_lru(entries, self.max_bytes, keep=keep)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+import logging
+import time
+import uuid
+
+from tripkit.database import DetectedTripCoordinate, DetectedTripDaySummary
+
+logger = logging.getLogger('itinerum-tripkit-cli.bulkwriter')
+
+
+def _user_id(user):
+    # match the hex representation used by `tripkit.database.Database.bulk_insert`
+    return user.uuid.hex if isinstance(user.uuid, uuid.UUID) else user.uuid
+
+
+def _columns(Model):
+    return [c for c in Model._meta.columns.keys() if c != 'id']
+
+
+class BulkWriter(object):
+    '''
+    Stands in for the trip saving methods of a :py:class:`tripkit.database.Database` and buffers
+    the rows of many users to write them together within a single transaction on `flush()`. Trip
+    point ids are assigned when saved so day summaries can reference them before being written.
+    The database is set to write-ahead logging with synchronous writes disabled until closed.
+
+    :param database: The TripKit cache database.
+    '''
+
+    def __init__(self, database):
+        self.database = database
+        self.trip_rows = {}
+        self.day_rows = {}
+        self.next_trip_id = None
+        self.rows_written = 0
+        self.write_s = 0.0
+
+        self.db = database.db
+        self.synchronous = self.db.execute_sql('PRAGMA synchronous;').fetchone()[0]
+        self.db.execute_sql('PRAGMA journal_mode = WAL;')
+        self.db.execute_sql('PRAGMA synchronous = OFF;')
+
+    def _reserve_trip_ids(self, count):
+        if self.next_trip_id is None:
+            max_id = self.db.execute_sql(f'SELECT MAX(id) FROM {DetectedTripCoordinate._meta.table_name};').fetchone()[0]
+            self.next_trip_id = (max_id or 0) + 1
+        start_id = self.next_trip_id
+        self.next_trip_id += count
+        return range(start_id, self.next_trip_id)
+
+    def save_trips(self, user, trips, overwrite=True):
+        points = [(trip, point) for trip in trips for point in trip.points]
+        rows = []
+        for (trip, point), row_id in zip(points, self._reserve_trip_ids(len(points))):
+            point.database_id = row_id
+            rows.append(
+                {
+                    'id': row_id,
+                    'user_id': _user_id(user),
+                    'trip_num': trip.num,
+                    'trip_code': trip.trip_code,
+                    'latitude': point.latitude,
+                    'longitude': point.longitude,
+                    'h_accuracy': point.h_accuracy,
+                    'distance_before': point.distance_before,
+                    'trip_distance': point.trip_distance,
+                    'period_before': point.period_before,
+                    'timestamp_UTC': point.timestamp_UTC,
+                }
+            )
+        if overwrite or _user_id(user) not in self.trip_rows:
+            self.trip_rows[_user_id(user)] = (overwrite, rows)
+        else:
+            self.trip_rows[_user_id(user)][1].extend(rows)
+
+    def save_trip_day_summaries(self, user, trip_day_summaries, timezone, overwrite=True):
+        if not trip_day_summaries:
+            logger.info(f'no daily summaries for {user.uuid}. Has trip detection been run?')
+            return
+
+        rows = []
+        for s in trip_day_summaries:
+            rows.append(
+                {
+                    'user_id': _user_id(user),
+                    'timezone': timezone,
+                    'date': s.date,
+                    'has_trips': s.has_trips,
+                    'is_complete': s.is_complete,
+                    'start_point_id': s.start_point.database_id if s.start_point else None,
+                    'end_point_id': s.end_point.database_id if s.end_point else None,
+                    'consecutive_inactive_days': s.consecutive_inactive_days,
+                    'inactivity_streak': s.inactivity_streak,
+                }
+            )
+        if overwrite or _user_id(user) not in self.day_rows:
+            self.day_rows[_user_id(user)] = (overwrite, rows)
+        else:
+            self.day_rows[_user_id(user)][1].extend(rows)
+
+    def _write_table(self, cur, Model, buffered, columns):
+        table_name = Model._meta.table_name
+        overwrite_ids = [(user_id,) for user_id, (overwrite, _) in buffered.items() if overwrite]
+        cur.executemany(f'DELETE FROM {table_name} WHERE user_id = ?;', overwrite_ids)
+
+        columns_str = ','.join(columns)
+        values_str = ','.join(['?'] * len(columns))
+        query = f'INSERT INTO {table_name} ({columns_str}) VALUES ({values_str});'
+        rows = [[row[c] for c in columns] for _, user_rows in buffered.values() for row in user_rows]
+        cur.executemany(query, rows)
+        return len(rows)
+
+    def flush(self):
+        '''
+        Writes all buffered rows to the database within a single transaction.
+        '''
+        if not self.trip_rows and not self.day_rows:
+            return
+        start = time.time()
+        conn = self.db.connection()
+        cur = conn.cursor()
+        cur.execute('BEGIN IMMEDIATE;')
+        try:
+            trip_columns = ['id'] + _columns(DetectedTripCoordinate)
+            rows_written = self._write_table(cur, DetectedTripCoordinate, self.trip_rows, trip_columns)
+            day_columns = _columns(DetectedTripDaySummary)
+            rows_written += self._write_table(cur, DetectedTripDaySummary, self.day_rows, day_columns)
+        except Exception:
+            cur.execute('ROLLBACK;')
+            raise
+        cur.execute('COMMIT;')
+
+        self.trip_rows, self.day_rows = {}, {}
+        self.rows_written += rows_written
+        self.write_s += time.time() - start
+        logger.debug(f'Wrote {rows_written} rows to the cache database.')
+
+    def close(self):
+        self.flush()
+        self.db.execute_sql(f'PRAGMA synchronous = {self.synchronous};')
+        logger.info(f'Wrote {self.rows_written} trip and day summary rows to the cache database in {self.write_s:.2f}s.')
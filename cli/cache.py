@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+from tripkit.process.canue.models import Coordinate as PreparedCoordinate
+from tripkit.utils.misc import temp_path
+
+from cli.manifest import fingerprint_user_coordinates
+from cli.utils import tripkit_version
+
+logger = logging.getLogger('itinerum-tripkit-cli.cache')
+
+# increment when the stored columns change to invalidate existing caches
+CACHE_FORMAT_VERSION = 1
+DEFAULT_CACHE_MAX_MB = 4096
+# timestamps read at a time when splitting an entry into time windows
+WINDOW_BLOCK_ROWS = 1000000
+
+# columns of pre-processed coordinates stored as individual memory-mappable .npy arrays;
+# missing float values are stored as NaN and restored as `None`
+COLUMNS = [
+    ('latitude', 'f8'),
+    ('longitude', 'f8'),
+    ('timestamp_UTC', 'datetime64[us]'),
+    ('duration_s', 'i8'),
+    ('distance_m', 'f8'),
+    ('altitude', 'f8'),
+    ('speed', 'f8'),
+    ('bearing', 'f8'),
+    ('delta_heading', 'f8'),
+    ('easting', 'f8'),
+    ('northing', 'f8'),
+    ('zone_num', 'i8'),
+    ('zone_letter', 'U1'),
+    ('timestamp_epoch', 'i8'),
+    ('avg_distance_m', 'f8'),
+    ('avg_delta_heading', 'f8'),
+]
+NULLABLE_COLUMNS = {'altitude', 'speed', 'avg_distance_m', 'avg_delta_heading'}
+
+
+def _column_array(coordinates, name, dtype):
+    values = [getattr(c, name) for c in coordinates]
+    if name in NULLABLE_COLUMNS:
+        values = [np.nan if v is None else v for v in values]
+    return np.array(values, dtype=dtype)
+
+
+def _entry_size(entry_dir):
+    return sum(os.path.getsize(os.path.join(entry_dir, fn)) for fn in os.listdir(entry_dir))
+
+
+def evict_lru(entries, max_bytes, keep=None):
+    '''
+    Removes the least recently used entry directories until their total size fits within a limit.
+
+    :param entries:   (last used time, entry directory) pairs of the entries.
+    :param max_bytes: The maximum total size of the entries.
+    :param keep:      (Optional) An entry directory to never evict, such as the entry just saved.
+    '''
+    sized = []
+    for last_used, entry_dir in entries:
+        try:
+            sized.append((last_used, _entry_size(entry_dir), entry_dir))
+        except FileNotFoundError:
+            # evicted by another worker process since listed
+            continue
+    entries = sized
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, entry_dir in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        if entry_dir == keep:
+            continue
+        logger.debug(f'Evicting cached entry: {entry_dir}')
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total_bytes -= size
+
+
+class PreparedCoordinatesCache(object):
+    '''
+    On-disk cache of pre-processed coordinates stored as one memory-mapped array per column. Entries
+    are keyed by the user, a hash of their input coordinates, the installed tripkit version and the
+    cache format so stale results are never loaded, and the least recently used entries are evicted
+    once the cache grows beyond `PREPARED_CACHE_MAX_MB` from the config. Each survey, and so each shard,
+    has its own cache.
+
+    :param cfg: The tripkit config for the survey.
+    '''
+
+    def __init__(self, cfg):
+        self.cache_dir = temp_path(f'{cfg.SURVEY_NAME}-prepared')
+        self.max_bytes = getattr(cfg, 'PREPARED_CACHE_MAX_MB', DEFAULT_CACHE_MAX_MB) * 1024 * 1024
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, user):
+        key_parts = [fingerprint_user_coordinates(user), tripkit_version(), str(CACHE_FORMAT_VERSION)]
+        digest = hashlib.sha1(':'.join(key_parts).encode()).hexdigest()
+        return f'{user.uuid}-{digest}'
+
+    def load(self, key, rows=None):
+        '''
+        Returns the cached coordinates for a key or `None` when not cached. The columns are memory-mapped
+        but the loaded rows are built into tripkit's pre-processed coordinate objects, which its
+        clustering and trip detection take as lists, so only `--window` runs that read the columns
+        one time window at a time with `load_columns` avoid holding every row in memory.
+
+        :param key:  The cache key of a user's pre-processed coordinates.
+        :param rows: (Optional) A slice of the rows to load, only these rows are read from disk.
+        '''
+        entry_dir = os.path.join(self.cache_dir, key)
+        meta_fp = os.path.join(entry_dir, 'meta.json')
+        rows = rows if rows else slice(None)
+        try:
+            with open(meta_fp, 'r') as meta_f:
+                meta = json.load(meta_f)
+            os.utime(meta_fp)  # mark as recently used
+            arrays = {name: np.load(os.path.join(entry_dir, f'{name}.npy'), mmap_mode='r') for name, _ in COLUMNS}
+        except FileNotFoundError:
+            # not cached, or evicted by another worker process
+            return None
+
+        columns = {}
+        for name, _ in COLUMNS:
+            values = arrays[name][rows]
+            if name == 'timestamp_UTC':
+                values = values.astype('datetime64[us]').tolist()
+            elif name in NULLABLE_COLUMNS:
+                values = [None if v != v else v for v in values.tolist()]
+            else:
+                values = values.tolist()
+            columns[name] = values
+
+        coordinates = []
+        for values in zip(*[columns[name] for name, _ in COLUMNS]):
+            c = PreparedCoordinate.__new__(PreparedCoordinate)
+            c.uuid = meta['uuid']
+            for (name, _), value in zip(COLUMNS, values):
+                setattr(c, name, value)
+            c.kmeans, c.stdev, c.stop_label = None, None, None
+            coordinates.append(c)
+        return coordinates
+
+    def load_columns(self, key, names, rows=None):
+        '''
+        Returns the arrays of the given columns of cached coordinates, with missing float values as NaN.
+
+        :param key:   The cache key of a user's pre-processed coordinates.
+        :param names: The column names to load.
+        :param rows:  (Optional) A slice of the rows to load, only these rows are read from disk.
+        '''
+        entry_dir = os.path.join(self.cache_dir, key)
+        rows = rows if rows else slice(None)
+        return {name: np.array(np.load(os.path.join(entry_dir, f'{name}.npy'), mmap_mode='r')[rows]) for name in names}
+
+    def window_slices(self, key, window_s, block_rows=WINDOW_BLOCK_ROWS):
+        '''
+        Returns the row slices of the consecutive coordinates within the same time window of a cached
+        entry or `None` when not cached. Timestamps are read in blocks of rows from the memory-mapped
+        column so the whole column is never held in memory.
+
+        :param key:        The cache key of a user's pre-processed coordinates.
+        :param window_s:   The length of each time window in seconds.
+        :param block_rows: (Optional) The number of timestamps read at a time.
+        '''
+        entry_dir = os.path.join(self.cache_dir, key)
+        try:
+            os.utime(os.path.join(entry_dir, 'meta.json'))  # mark as recently used
+            epochs = np.load(os.path.join(entry_dir, 'timestamp_epoch.npy'), mmap_mode='r')
+        except FileNotFoundError:
+            # not cached, or evicted by another worker process
+            return None
+        starts = [0] if len(epochs) else []
+        last_window = None
+        for block_start in range(0, len(epochs), block_rows):
+            windows = epochs[block_start:block_start + block_rows] // window_s
+            if last_window is not None and windows[0] != last_window:
+                starts.append(block_start)
+            starts.extend((np.flatnonzero(np.diff(windows)) + block_start + 1).tolist())
+            last_window = windows[-1]
+        return [slice(start, end) for start, end in zip(starts, starts[1:] + [len(epochs)])]
+
+    def _begin_entry(self, key):
+        entry_dir = os.path.join(self.cache_dir, key)
+        tmp_dir = f'{entry_dir}.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        return entry_dir, tmp_dir
+
+    def _publish_entry(self, entry_dir, tmp_dir, uuid, count):
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as meta_f:
+            json.dump({'uuid': str(uuid), 'count': count, 'version': CACHE_FORMAT_VERSION}, meta_f)
+
+        # replace any stale entries for this user before publishing the new entry
+        for entry in os.listdir(self.cache_dir):
+            if entry.startswith(f'{uuid}-') and not entry.endswith('.tmp'):
+                shutil.rmtree(os.path.join(self.cache_dir, entry), ignore_errors=True)
+        os.rename(tmp_dir, entry_dir)
+        self.evict(keep=entry_dir)
+
+    def save(self, key, uuid, coordinates):
+        entry_dir, tmp_dir = self._begin_entry(key)
+        for name, dtype in COLUMNS:
+            np.save(os.path.join(tmp_dir, f'{name}.npy'), _column_array(coordinates, name, dtype))
+        self._publish_entry(entry_dir, tmp_dir, uuid, len(coordinates))
+
+    def save_chunks(self, key, uuid, chunks):
+        '''
+        Saves a user's pre-processed coordinates given as consecutive chunks, appending each chunk to
+        the column files as it is given so only one chunk is held in memory.
+
+        :param key:    The cache key of a user's pre-processed coordinates.
+        :param uuid:   The user's uuid.
+        :param chunks: An iterable of lists of pre-processed coordinates.
+        '''
+        entry_dir, tmp_dir = self._begin_entry(key)
+        raw_fps = {name: os.path.join(tmp_dir, f'{name}.raw') for name, _ in COLUMNS}
+        raw_fs = {name: open(raw_fp, 'wb') for name, raw_fp in raw_fps.items()}
+        count = 0
+        try:
+            for chunk in chunks:
+                for name, dtype in COLUMNS:
+                    _column_array(chunk, name, dtype).tofile(raw_fs[name])
+                count += len(chunk)
+        finally:
+            for raw_f in raw_fs.values():
+                raw_f.close()
+
+        # copy the raw columns into .npy arrays through a memory map
+        for name, dtype in COLUMNS:
+            if count:
+                values = np.memmap(raw_fps[name], dtype=dtype, mode='r')
+            else:
+                values = np.array([], dtype=dtype)
+            np.save(os.path.join(tmp_dir, f'{name}.npy'), values)
+            del values
+            os.remove(raw_fps[name])
+        self._publish_entry(entry_dir, tmp_dir, uuid, count)
+
+    def evict(self, keep=None):
+        '''
+        Removes the least recently used entries until the cache fits within its size limit.
+
+        :param keep: (Optional) An entry directory to never evict, such as the entry just saved.
+        '''
+        entries = []
+        for entry in os.listdir(self.cache_dir):
+            meta_fp = os.path.join(self.cache_dir, entry, 'meta.json')
+            if not entry.endswith('.tmp') and os.path.exists(meta_fp):
+                entries.append((os.path.getmtime(meta_fp), os.path.join(self.cache_dir, entry)))
+        evict_lru(entries, self.max_bytes, keep=keep)
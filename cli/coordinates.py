@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+from tripkit.database import Coordinate
+
+# columns of the coordinates table in model field order, the `user` column holds the user's uuid
+COLUMNS = [field.name for field in Coordinate._meta.sorted_fields]
+
+# users' coordinates are left as their database query instead of being loaded into memory,
+# enabled for the windowed processing of long traces
+_streaming = False
+
+
+class CoordinatePoint(object):
+    '''
+    Lightweight row of a user's coordinates with the same attributes as a
+    :py:class:`tripkit.database.Coordinate` model instance.
+    '''
+
+    # `uuid` is set on each point by the CANUE pre-processing
+    __slots__ = COLUMNS + ['uuid']
+
+    def __init__(self, row):
+        for name, value in zip(COLUMNS, row):
+            setattr(self, name, value)
+        self.uuid = None
+
+
+class UserCoordinates(object):
+    '''
+    A user's coordinates read from the cache database with a single query on first use and kept
+    in memory so every processing stage iterates the same points. Stands in for the lazy coordinates
+    query of a :py:class:`tripkit.models.User` with its `count()` and `model` attributes.
+
+    :param query: The user's coordinates query from the cache database.
+    '''
+
+    model = Coordinate
+
+    def __init__(self, query):
+        self._query = query
+        self._points = None
+
+    @property
+    def points(self):
+        if self._points is None:
+            self._points = [CoordinatePoint(row) for row in self._query.tuples().iterator()]
+        return self._points
+
+    def __iter__(self):
+        return iter(self.points)
+
+    def __len__(self):
+        return len(self.points)
+
+    def __getitem__(self, idx):
+        return self.points[idx]
+
+    def count(self):
+        return len(self.points)
+
+    def rows(self, *columns):
+        '''
+        Yields a tuple of the given column values for each point.
+
+        :param columns: The column names to select.
+        '''
+        for p in self.points:
+            yield tuple(getattr(p, name) for name in columns)
+
+
+def set_streaming(enabled):
+    '''
+    Sets whether users' coordinates are streamed from their database query by each stage
+    instead of being loaded into memory once.
+    '''
+    global _streaming
+    _streaming = enabled
+
+
+def iter_points(user):
+    '''
+    Yields a user's coordinates from memory when loaded or otherwise streamed from the database.
+    '''
+    if isinstance(user.coordinates, UserCoordinates):
+        return iter(user.coordinates)
+    return (CoordinatePoint(row) for row in user.coordinates.tuples().iterator())
+
+
+def materialize(user):
+    '''
+    Replaces a user's coordinates query with the in-memory coordinates, if not already loaded
+    and not streaming.
+    '''
+    if not _streaming and not isinstance(user.coordinates, UserCoordinates):
+        user.coordinates = UserCoordinates(user.coordinates)
+    return user.coordinates
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+import click
+import concurrent.futures
+from datetime import datetime
+import logging
+import os
+import sys
+import threading
+
+import fiona
+import fiona.crs
+from tripkit import utils
+from tripkit.io import formatters
+
+from cli.coordinates import UserCoordinates
+
+logger = logging.getLogger('itinerum-tripkit-cli.gis')
+
+# `tripkit.io` writer of each GIS output format
+FORMAT_WRITERS = {
+    'shp': 'shapefile',
+    'gpkg': 'geopackage',
+    'geojson': 'geojson',
+}
+WRITER_THREADS = 2
+# writes waiting on the writer threads before the processing thread blocks
+MAX_QUEUED_WRITES = 8
+# features buffered for each layer of the survey-wide GeoPackage between inserts
+SURVEY_LAYER_BATCH_FEATURES = 20000
+
+INPUT_IGNORE_KEYS = ('id', 'user', 'longitude', 'latitude', 'prompt_uuid')
+# GeoPackage property types of the input database columns
+INPUT_FIELD_TYPES = {
+    'FLOAT': 'float',
+    'INT': 'int',
+    'BOOL': 'int',
+    'TEXT': 'str',
+    'DATETIME': 'datetime',
+}
+TRIPS_SCHEMA = {
+    'geometry': 'LineString',
+    'properties': [
+        ('uuid', 'str'),
+        ('start_UTC', 'datetime'),
+        ('end_UTC', 'datetime'),
+        ('trip_code', 'int'),
+        ('distance', 'float'),
+    ],
+}
+LOCATIONS_SCHEMA = {
+    'geometry': 'Point',
+    'properties': [
+        ('uuid', 'str'),
+        ('label', 'str'),
+    ],
+}
+
+# writer of the current process, created on first use
+_writer = None
+# target of the survey-wide GeoPackage features, swapped for a recorder while processing a user
+_survey_target = None
+
+
+def output_format(cfg):
+    return cfg.GIS_OUTPUT_FORMAT.lower()
+
+
+def survey_file_enabled(cfg):
+    return bool(getattr(cfg, 'GIS_OUTPUT_SURVEY_FILE', False))
+
+
+def check_config(cfg):
+    '''
+    Exits with an error before any users are processed if the GIS output settings are invalid.
+    '''
+    output_fmt = output_format(cfg)
+    if output_fmt not in FORMAT_WRITERS:
+        click.echo(f'Error: file format {cfg.GIS_OUTPUT_FORMAT} not recognized.')
+        sys.exit(1)
+    if survey_file_enabled(cfg) and output_fmt != 'gpkg':
+        click.echo('Error: a survey-wide GIS file can only be written as gpkg.')
+        sys.exit(1)
+
+
+class QueryRows(object):
+    '''
+    The rows of a database query read into memory with the query's `model` attribute used by
+    the `tripkit.io` formatters, so they can be written by another thread without sharing the
+    database connection.
+    '''
+
+    def __init__(self, query):
+        self.model = query.model
+        self.rows = list(query)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class BackgroundWriter(object):
+    '''
+    Runs write functions on background threads with a bounded number of writes waiting, so the
+    processing thread blocks instead of buffering outputs without limit when writing falls behind.
+    A failed write is raised by the next call to `submit` or by `close`.
+
+    :param threads:    The number of writer threads, a single thread runs writes in order.
+    :param max_queued: The number of submitted writes allowed to wait on the writer threads.
+    '''
+
+    def __init__(self, threads=WRITER_THREADS, max_queued=MAX_QUEUED_WRITES):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix='gis-writer')
+        self.slots = threading.BoundedSemaphore(threads + max_queued)
+        self.errors = []
+
+    def _done(self, future):
+        self.slots.release()
+        if future.exception():
+            logger.error(f'GIS write failed: {future.exception()!r}')
+            self.errors.append(future.exception())
+
+    def raise_errors(self):
+        if self.errors:
+            raise self.errors[0]
+
+    def submit(self, fn, *args, **kwargs):
+        self.raise_errors()
+        self.slots.acquire()
+        self.executor.submit(fn, *args, **kwargs).add_done_callback(self._done)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.raise_errors()
+
+
+class AsyncFileWriter(object):
+    '''
+    Writes each user's GIS files with the `tripkit.io` writer of the configured format on background
+    threads. Queries are read before the write is queued since the cache database connection cannot
+    be used from the writer threads.
+
+    :param tripkit: The TripKit instance for the survey.
+    '''
+
+    def __init__(self, tripkit):
+        self.io = getattr(tripkit.io, FORMAT_WRITERS[output_format(tripkit.config)])
+        self.background = BackgroundWriter()
+
+    def write_inputs(self, fn_base, coordinates, prompts, cancelled_prompts):
+        if isinstance(coordinates, UserCoordinates):
+            # load the in-memory coordinates before the writer thread iterates them
+            coordinates.count()
+        else:
+            coordinates = QueryRows(coordinates)
+        self.background.submit(
+            self.io.write_inputs, fn_base, coordinates, QueryRows(prompts), QueryRows(cancelled_prompts)
+        )
+
+    def write_trips(self, fn_base, trips):
+        self.background.submit(self.io.write_trips, fn_base, list(trips))
+
+    def write_activity_locations(self, fn_base, locations):
+        self.background.submit(self.io.write_activity_locations, fn_base, list(locations))
+
+    def close(self):
+        self.background.close()
+
+
+def _with_uuid(uuid, features):
+    for feature in features:
+        feature['properties']['uuid'] = str(uuid)
+    return features
+
+
+def _input_schema(model):
+    # column types are mapped directly since `formatters._input_gpkg_schema` cannot infer float columns
+    properties = [('uuid', 'str')]
+    for column in model._meta.sorted_fields:
+        if column.name not in INPUT_IGNORE_KEYS:
+            properties.append((column.name, INPUT_FIELD_TYPES[column.field_type]))
+    return {'geometry': 'Point', 'properties': properties}
+
+
+def _parse_datetimes(schema, features):
+    # timestamps stored with a UTC offset are read from the database as text
+    columns = [name for name, field_type in schema['properties'] if field_type == 'datetime']
+    for feature in features:
+        properties = feature['properties']
+        for name in columns:
+            if isinstance(properties[name], str):
+                properties[name] = datetime.fromisoformat(properties[name])
+
+
+class SurveyFeatureWriter(object):
+    '''
+    Builds each user's GIS features tagged with their uuid for the layers of the survey-wide GeoPackage
+    and passes them to the :py:class:`GeoPackageSink`, or to the recorder of the user's survey-wide
+    writes while the user is processed.
+    '''
+
+    def write_inputs(self, fn_base, coordinates, prompts, cancelled_prompts):
+        layers = [
+            ('coordinates', coordinates, formatters._input_coordinates_features),
+            ('prompts', prompts, formatters._input_prompts_features),
+            ('cancelled_prompts', cancelled_prompts, formatters._input_cancelled_prompts_features),
+        ]
+        for layer, rows, features_fn in layers:
+            schema = _input_schema(rows.model)
+            features = _with_uuid(fn_base, features_fn(rows, INPUT_IGNORE_KEYS))
+            _parse_datetimes(schema, features)
+            _survey_target.write_gis_features(layer, schema, features)
+
+    def write_trips(self, fn_base, trips):
+        features = []
+        for trip in trips:
+            properties = {
+                'uuid': str(fn_base),
+                'start_UTC': trip.start_UTC,
+                'end_UTC': trip.end_UTC,
+                'trip_code': trip.trip_code,
+                'distance': trip.distance,
+            }
+            features.append(formatters._points_to_geojson_linestring(trip.geojson_coordinates, properties))
+        _survey_target.write_gis_features('trips', TRIPS_SCHEMA, features)
+
+    def write_activity_locations(self, fn_base, locations):
+        features = _with_uuid(fn_base, formatters._activity_locations_features(locations))
+        _survey_target.write_gis_features('locations', LOCATIONS_SCHEMA, features)
+
+    def close(self):
+        pass
+
+
+class GeoPackageSink(object):
+    '''
+    Writes the GIS features of every user to the layers of a single survey-wide GeoPackage instead of
+    separate files for each user. Features are buffered for each layer and inserted in batches within
+    a single transaction by one background thread, the only writer of the file. A file left by a
+    previous run is replaced on first write.
+
+    :param cfg:            The tripkit config for the survey.
+    :param batch_features: (Optional) The number of buffered features of a layer that triggers an insert.
+    '''
+
+    def __init__(self, cfg, batch_features=SURVEY_LAYER_BATCH_FEATURES):
+        self.gpkg_fp = os.path.join(cfg.OUTPUT_DATA_DIR, f'{cfg.SURVEY_NAME}.gpkg')
+        self.batch_features = batch_features
+        self.background = BackgroundWriter(threads=1)
+        self.schemas = {}
+        self.buffers = {}
+        self.created = set()
+        self.cleaned = False
+
+    def _insert(self, layer, schema, features):
+        if not self.cleaned:
+            utils.misc.clean_up_old_file(self.gpkg_fp)
+            self.cleaned = True
+        mode = 'a' if layer in self.created else 'w'
+        with fiona.open(
+            self.gpkg_fp, mode, driver='GPKG', layer=layer, schema=schema, crs=fiona.crs.from_epsg(4326)
+        ) as gpkg_f:
+            gpkg_f.writerecords(features)
+        self.created.add(layer)
+
+    def _flush_layer(self, layer):
+        features = self.buffers.pop(layer, None)
+        if features:
+            self.background.submit(self._insert, layer, self.schemas[layer], features)
+
+    def write_gis_features(self, layer, schema, features):
+        self.schemas.setdefault(layer, schema)
+        self.buffers.setdefault(layer, []).extend(features)
+        if len(self.buffers[layer]) >= self.batch_features:
+            self._flush_layer(layer)
+
+    def flush(self):
+        for layer in list(self.buffers):
+            self._flush_layer(layer)
+
+    def close(self):
+        self.flush()
+        self.background.close()
+        if self.created:
+            logger.info(f'Wrote survey-wide GIS layers ({", ".join(sorted(self.created))}) to {self.gpkg_fp}')
+
+
+def writer(tripkit):
+    '''
+    Returns the GIS writer of the current process for the configured output, which writes each
+    user's files on background threads or passes their features to the survey-wide GeoPackage.
+    '''
+    global _writer
+    if _writer is None:
+        if survey_file_enabled(tripkit.config):
+            _writer = SurveyFeatureWriter()
+        else:
+            _writer = AsyncFileWriter(tripkit)
+    return _writer
+
+
+def set_survey_target(target):
+    '''
+    Sets the object receiving survey-wide GeoPackage features and returns the previous target.
+    '''
+    global _survey_target
+    previous, _survey_target = _survey_target, target
+    return previous
+
+
+def close():
+    '''
+    Waits for the queued GIS writes of the current process and raises the first failed write.
+    '''
+    global _writer
+    if _writer is not None:
+        _writer, closing = None, _writer
+        closing.close()
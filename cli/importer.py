@@ -0,0 +1,568 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+import click
+import collections
+import concurrent.futures
+import csv
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import time
+import types
+import uuid
+
+from tripkit import TripKit
+from tripkit.csvparser import itinerum as itinerum_csv
+from tripkit.csvparser.common import _generate_null_survey, _load_user_locations
+from tripkit.database import (
+    CancelledPromptResponse,
+    Coordinate,
+    PromptResponse,
+    SubwayStationEntrance,
+    UserLocation,
+    UserSurveyResponse,
+)
+from tripkit.utils.misc import temp_path
+
+from cli.parallel import config_values
+
+logger = logging.getLogger('itinerum-tripkit-cli.importer')
+
+# size of the byte ranges of large .csv files parsed by each worker task
+CHUNK_BYTES = 8 * 1024 * 1024
+# parsed chunks waiting to be inserted per worker, bounding the parent's memory use
+CHUNKS_IN_FLIGHT_PER_WORKER = 2
+# rows per multi-row insert statement are limited by SQLite's default maximum number of variables
+MAX_SQL_VARIABLES = 999
+IMPORTS_TABLE = 'cli_imported_files'
+IMPORT_STATUS_TABLE = 'cli_import_status'
+# user id indexes recreated by `tripkit.csvparser` with new names after loading a table's rows
+TRIPKIT_INDEX_NAMES = {
+    'coordinate_user_id': 'coordinates_user_id',
+    'promptresponse_user_id': 'prompt_responses_user_id',
+}
+
+# state initialized once within each worker process
+_worker = {}
+
+
+class InputFile(object):
+    '''
+    An input .csv file loaded to a cache database table.
+
+    :param filename:   The filename within the input data directory.
+    :param model:      The database model of the table the file is loaded to.
+    :param row_filter: (Optional) The name of the row filter parsing the file's rows in parallel.
+    :param load:       (Optional) Function called as `load(tripkit, fp)` to load small files serially instead.
+    :param splittable: (Optional) Parse the file in byte ranges split on newlines, only for files
+                       without multiline values.
+    :param required:   (Optional) Raise an error if the file does not exist.
+    '''
+
+    def __init__(self, filename, model, row_filter=None, load=None, splittable=False, required=True):
+        self.filename = filename
+        self.model = model
+        self.row_filter = row_filter
+        self.load = load
+        self.splittable = splittable
+        self.required = required
+
+
+def _load_subway_stations(tripkit, fp):
+    tripkit.csv.load_subway_stations(fp)
+
+
+def _load_qstarz_locations(tripkit, fp):
+    _load_user_locations(fp, uuid_lookup=load_uuid_lookup(tripkit.config))
+
+
+# files in the order loaded by `tripkit.setup()` so rows are given the same ids
+INPUT_FILES = {
+    'itinerum': [
+        InputFile('survey_responses.csv', UserSurveyResponse, row_filter='itinerum_survey_responses'),
+        InputFile('coordinates.csv', Coordinate, row_filter='itinerum_coordinates', splittable=True),
+        InputFile('prompt_responses.csv', PromptResponse, row_filter='itinerum_prompts'),
+        InputFile('cancelled_prompts.csv', CancelledPromptResponse, row_filter='itinerum_cancelled_prompts'),
+    ],
+    'qstarz': [
+        InputFile('coordinates.csv', Coordinate, row_filter='qstarz_coordinates', splittable=True),
+        InputFile('locations.csv', UserLocation, load=_load_qstarz_locations, required=False),
+    ],
+}
+
+
+def _row_filter(name):
+    if name == 'qstarz_coordinates':
+        return _worker['tripkit'].csv._coordinates_row_filter
+    return {
+        'itinerum_survey_responses': itinerum_csv._survey_response_row_filter,
+        'itinerum_coordinates': itinerum_csv._coordinates_row_filter,
+        'itinerum_prompts': itinerum_csv._prompts_row_filter,
+        'itinerum_cancelled_prompts': itinerum_csv._cancelled_prompts_row_filter,
+    }[name]
+
+
+def table_columns(model):
+    return [c for c in model._meta.columns.keys() if c != 'id']
+
+
+def _db_values(row, table_name, columns, user_ids):
+    # match the values inserted by `tripkit.database.Database.bulk_insert`, with the hex
+    # representation of each user's uuid memoized since a user has many rows
+    def hex_id(value):
+        if value not in user_ids:
+            user_ids[value] = uuid.UUID(hex=value).hex
+        return user_ids[value]
+
+    if table_name == 'survey_responses':
+        row['uuid'] = hex_id(row['uuid'])
+        row.setdefault('orig_id', None)
+    elif 'uuid' in row:
+        row['user_id'] = hex_id(row['uuid'])
+    elif 'user_id' not in row:
+        row['user_id'] = hex_id(row['user'])
+    return [row[c] for c in columns]
+
+
+def _read_rows(fp, start, end):
+    with open(fp, 'rb') as csv_f:
+        csv_f.seek(start)
+        data = csv_f.read(end - start).decode('utf-8')
+    return csv.reader(io.StringIO(data))
+
+
+def _init_worker(cfg_values, log_level):
+    logging.basicConfig(level=log_level)
+    _worker['tripkit'] = TripKit(config=types.SimpleNamespace(**cfg_values))
+
+
+def _parse_chunk(fp, start, end, headers, row_filter_name, table_name, columns, uuid_lookup):
+    '''
+    Returns the flattened database values of the rows within a byte range of an input file and the
+    number of rows.
+    '''
+    if uuid_lookup is not None:
+        _worker['tripkit'].csv.uuid_lookup = uuid_lookup
+    row_filter = _row_filter(row_filter_name)
+    values = []
+    num_rows = 0
+    user_ids = {}
+    for row in _read_rows(fp, start, end):
+        if not row:
+            continue
+        db_row = row_filter(dict(zip(headers, row)))
+        if not db_row:
+            continue
+        values.extend(_db_values(db_row, table_name, columns, user_ids))
+        num_rows += 1
+    return values, num_rows
+
+
+def _scan_user_ids(fp, start, end, user_idx):
+    '''
+    Returns the QStarz user ids within a byte range of a coordinates file in order of first appearance.
+    '''
+    user_ids = {}
+    for row in _read_rows(fp, start, end):
+        # skip repeated header rows as `tripkit.csvparser.QstarzCSVParser` does
+        if not row or 'USER' in row:
+            continue
+        user_ids.setdefault(row[user_idx], None)
+    return list(user_ids)
+
+
+def chunk_ranges(fp, start, end, chunk_bytes):
+    '''
+    Returns the byte ranges splitting a file between two offsets on newlines.
+    '''
+    ranges = []
+    with open(fp, 'rb') as csv_f:
+        while start < end:
+            stop = min(start + chunk_bytes, end)
+            if stop < end:
+                csv_f.seek(stop)
+                csv_f.readline()
+                stop = min(csv_f.tell(), end)
+            ranges.append((start, stop))
+            start = stop
+    return ranges
+
+
+def file_sha1(fp, size=None):
+    digest = hashlib.sha1()
+    remaining = os.path.getsize(fp) if size is None else size
+    with open(fp, 'rb') as f:
+        while remaining > 0:
+            data = f.read(min(remaining, 1024 * 1024))
+            if not data:
+                break
+            digest.update(data)
+            remaining -= len(data)
+    return digest.hexdigest()
+
+
+def ends_with_newline(fp, size):
+    if not size:
+        return False
+    with open(fp, 'rb') as f:
+        f.seek(size - 1)
+        return f.read(1) == b'\n'
+
+
+def load_uuid_lookup(cfg):
+    lookup_fp = temp_path(f'{cfg.SURVEY_NAME}.json')
+    if not os.path.exists(lookup_fp):
+        return {}
+    with open(lookup_fp, 'r') as json_f:
+        return json.load(json_f)
+
+
+def save_uuid_lookup(cfg, uuid_lookup):
+    with open(temp_path(f'{cfg.SURVEY_NAME}.json'), 'w') as json_f:
+        json.dump(uuid_lookup, json_f)
+
+
+def import_finished(db):
+    '''
+    Returns whether the last import to a cache database finished, or True if the database was not
+    created by an import.
+    '''
+    if not db.table_exists(IMPORT_STATUS_TABLE):
+        return True
+    row = db.execute_sql(f'''SELECT finished FROM {IMPORT_STATUS_TABLE} WHERE id = 1;''').fetchone()
+    return not row or bool(row[0])
+
+
+def check_import_finished(tripkit):
+    '''
+    Raises an error if the last import to the survey's cache database was interrupted, since its
+    tables already exist and `tripkit.setup()` would use the partially imported rows.
+    '''
+    if not import_finished(tripkit.database.db):
+        raise click.ClickException('the last import of the input data did not finish, run the import command again.')
+
+
+class ImportState(object):
+    '''
+    The size, modification time and hash of each input file when last imported, stored in the cache
+    database itself so the state is committed with the imported rows and removed with the database.
+    Whether the last import finished is stored alongside so an interrupted import is not mistaken for
+    a complete cache database.
+
+    :param db: The cache database connection.
+    '''
+
+    def __init__(self, db):
+        self.db = db
+        self.db.execute_sql(
+            f'''CREATE TABLE IF NOT EXISTS {IMPORTS_TABLE} (
+                    fp TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha1 TEXT);'''
+        )
+        self.db.execute_sql(
+            f'''CREATE TABLE IF NOT EXISTS {IMPORT_STATUS_TABLE} (
+                    id INTEGER PRIMARY KEY CHECK (id = 1), finished INTEGER NOT NULL);'''
+        )
+
+    def finished(self):
+        return import_finished(self.db)
+
+    def set_finished(self, finished):
+        self.db.execute_sql(
+            f'''INSERT OR REPLACE INTO {IMPORT_STATUS_TABLE} (id, finished) VALUES (1, ?);''', (int(finished),)
+        )
+
+    def get(self, fp):
+        row = self.db.execute_sql(
+            f'''SELECT size, mtime_ns, sha1 FROM {IMPORTS_TABLE} WHERE fp = ?;''', (fp,)
+        ).fetchone()
+        return row
+
+    def save(self, fp, size, mtime_ns, sha1):
+        self.db.execute_sql(
+            f'''INSERT OR REPLACE INTO {IMPORTS_TABLE} (fp, size, mtime_ns, sha1) VALUES (?, ?, ?, ?);''',
+            (fp, size, mtime_ns, sha1),
+        )
+
+    def delete(self, fp):
+        self.db.execute_sql(f'''DELETE FROM {IMPORTS_TABLE} WHERE fp = ?;''', (fp,))
+
+    def imported_fps(self):
+        return [row[0] for row in self.db.execute_sql(f'''SELECT fp FROM {IMPORTS_TABLE};''').fetchall()]
+
+    def clear(self):
+        self.db.execute_sql(f'''DELETE FROM {IMPORTS_TABLE};''')
+
+    def plan(self, fp, stat):
+        '''
+        Returns whether a file should be skipped, appended from the end of its last import or fully
+        reimported with the byte offset to import from.
+        '''
+        previous = self.get(fp)
+        if not previous:
+            return 'full', 0
+        size, mtime_ns, previous_sha1 = previous
+        if (size, mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+            return 'skip', size
+        if stat.st_size == size and file_sha1(fp) == previous_sha1:
+            # only touched, remember the new modification time to skip hashing next time
+            self.save(fp, size, stat.st_mtime_ns, previous_sha1)
+            return 'skip', size
+        # rows appended to a file are imported alone when the previously imported bytes are unchanged
+        if stat.st_size > size and ends_with_newline(fp, size) and file_sha1(fp, size) == previous_sha1:
+            return 'append', size
+        return 'full', 0
+
+
+def drop_indexes(db, table_name):
+    '''
+    Drops the indexes of a table and returns the statements to create them again, with the names
+    given by `tripkit.setup()` to the indexes it recreates.
+    '''
+    indexes = db.execute_sql(
+        '''SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL;''',
+        (table_name,),
+    ).fetchall()
+    statements = []
+    for name, sql in indexes:
+        db.execute_sql(f'DROP INDEX "{name}";')
+        statements.append(sql.replace(f'"{name}"', f'"{TRIPKIT_INDEX_NAMES.get(name, name)}"', 1))
+    return statements
+
+
+def insert_values(cursor, table_name, columns, values, num_rows):
+    '''
+    Inserts flattened row values with multi-row insert statements.
+    '''
+    rows_per_statement = max(1, MAX_SQL_VARIABLES // len(columns))
+    row_sql = f'({",".join(["?"] * len(columns))})'
+    columns_str = ','.join(columns)
+
+    def query(rows):
+        return f'INSERT INTO {table_name} ({columns_str}) VALUES {",".join([row_sql] * rows)};'
+
+    statement_size = rows_per_statement * len(columns)
+    full_rows = num_rows - num_rows % rows_per_statement
+    if full_rows:
+        statements = (values[idx : idx + statement_size] for idx in range(0, full_rows * len(columns), statement_size))
+        cursor.executemany(query(rows_per_statement), statements)
+    if num_rows > full_rows:
+        cursor.execute(query(num_rows - full_rows), values[full_rows * len(columns) :])
+
+
+class Importer(object):
+    '''
+    Loads the input .csv files of a survey to the cache database. Large files are split into byte
+    ranges parsed by worker processes and their rows are streamed into the database in file order
+    with multi-row inserts, creating the table's indexes once all rows are inserted. Files unchanged
+    since the last import are skipped and rows appended to a file are imported alone.
+
+    :param tripkit: The TripKit instance for the survey, without `setup()` having loaded the input data.
+    :param workers: The number of worker processes parsing files.
+    :param force:   Reimport every file even if unchanged.
+    '''
+
+    def __init__(self, tripkit, workers=1, force=False):
+        self.tripkit = tripkit
+        self.cfg = tripkit.config
+        self.db = tripkit.database.db
+        self.workers = workers
+        self.force = force
+        self.executor = None
+        self.rows_imported = 0
+        self.import_s = 0.0
+        # mode of each file imported by the last run, 'full' or 'append'
+        self.modes = {}
+
+        with self.db.atomic():
+            created = not UserSurveyResponse.table_exists()
+            if created:
+                tripkit.database.create()
+            self.state = ImportState(self.db)
+            if created:
+                # the new tables are incomplete until the first import finishes
+                self.state.set_finished(False)
+
+    def __enter__(self):
+        if self.workers > 1:
+            logger.info(f'Starting {self.workers} worker processes...')
+            # spawn fresh interpreters so workers do not inherit the parent's open database connection
+            mp_context = multiprocessing.get_context('spawn')
+            initargs = (config_values(self.cfg), logging.getLogger().getEffectiveLevel())
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=mp_context, initializer=_init_worker, initargs=initargs
+            )
+        else:
+            _worker['tripkit'] = self.tripkit
+        return self
+
+    def __exit__(self, *exc):
+        if self.executor:
+            self.executor.shutdown()
+
+    def _map(self, func, tasks):
+        # yields results in task order while keeping a bounded number of tasks queued
+        if not self.executor:
+            for task in tasks:
+                yield func(*task)
+            return
+        pending = collections.deque()
+        max_pending = self.workers * CHUNKS_IN_FLIGHT_PER_WORKER
+        for task in tasks:
+            pending.append(self.executor.submit(func, *task))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def input_files(self):
+        '''
+        Yields the full filepath of each of the survey's input files with its :py:class:`InputFile`.
+        '''
+        subway_stations_fp = getattr(self.cfg, 'SUBWAY_STATIONS_FP', None)
+        if subway_stations_fp:
+            filename = os.path.basename(subway_stations_fp)
+            yield os.path.abspath(subway_stations_fp), InputFile(filename, SubwayStationEntrance, load=_load_subway_stations)
+        for input_file in INPUT_FILES[self.cfg.INPUT_DATA_TYPE]:
+            yield os.path.abspath(os.path.join(self.cfg.INPUT_DATA_DIR, input_file.filename)), input_file
+
+    def clear(self):
+        '''
+        Deletes the rows and import state of every input file so all files are imported again.
+        '''
+        with self.db.atomic():
+            for _, input_file in self.input_files():
+                input_file.model.delete().execute()
+            self.state.clear()
+
+    def run(self):
+        self.modes = {}
+        if not self.state.finished():
+            if self.state.imported_fps():
+                click.echo('Last import did not finish, reimporting every input file...')
+            self.clear()
+        self.state.set_finished(False)
+        for fp, input_file in self.input_files():
+            if not os.path.exists(fp):
+                if input_file.required:
+                    raise click.ClickException(f'input file {fp} could not be found.')
+                if self.state.get(fp):
+                    logger.info(f'{input_file.filename} removed, deleting its imported rows...')
+                    with self.db.atomic():
+                        input_file.model.delete().execute()
+                        self.state.delete(fp)
+                continue
+
+            stat = os.stat(fp)
+            mode, offset = ('full', 0) if self.force else self.state.plan(fp, stat)
+            if mode == 'skip':
+                click.echo(f'{input_file.filename}: unchanged since last import, skipped.')
+                continue
+            if input_file.load:
+                mode, offset = 'full', 0
+
+            start_time = time.time()
+            with self.db.atomic():
+                if mode == 'full':
+                    input_file.model.delete().execute()
+                if input_file.load:
+                    input_file.load(self.tripkit, fp)
+                    num_rows = input_file.model.select().count()
+                else:
+                    num_rows = self.import_rows(input_file, fp, offset, stat.st_size, defer_indexes=mode == 'full')
+                self.state.save(fp, stat.st_size, stat.st_mtime_ns, file_sha1(fp, stat.st_size))
+            elapsed_s = time.time() - start_time
+            self.modes[fp] = mode
+            self.rows_imported += num_rows
+            self.import_s += elapsed_s
+            appended = ' appended' if mode == 'append' else ''
+            click.echo(
+                f'{input_file.filename}: imported {num_rows}{appended} rows in {elapsed_s:.1f}s '
+                f'({num_rows / max(elapsed_s, 1e-6):.0f} rows/s)'
+            )
+        self.state.set_finished(True)
+
+    def headers(self, input_file, fp):
+        # QStarz files are parsed with fixed headers and their first row skipped
+        with open(fp, 'rb') as csv_f:
+            header_line = csv_f.readline()
+            data_start = csv_f.tell()
+        if input_file.row_filter == 'qstarz_coordinates':
+            return self.tripkit.csv.headers, data_start
+        return next(csv.reader([header_line.decode('utf-8-sig')])), data_start
+
+    def update_qstarz_users(self, fp, ranges):
+        '''
+        Adds new QStarz users found within the byte ranges of the coordinates file to the uuid lookup
+        and the null survey responses, returning the lookup.
+        '''
+        uuid_lookup = load_uuid_lookup(self.cfg)
+        user_idx = self.tripkit.csv.headers.index('USER')
+        new_lookup = {}
+        for user_ids in self._map(_scan_user_ids, [(fp, start, end, user_idx) for start, end in ranges]):
+            for user_id in user_ids:
+                if user_id not in uuid_lookup and user_id not in new_lookup:
+                    new_lookup[user_id] = str(uuid.uuid4())
+        if new_lookup:
+            uuid_lookup.update(new_lookup)
+            save_uuid_lookup(self.cfg, uuid_lookup)
+
+        existing = {u.uuid.hex for u in UserSurveyResponse.select(UserSurveyResponse.uuid)}
+        missing = {orig_id: u for orig_id, u in uuid_lookup.items() if uuid.UUID(u).hex not in existing}
+        if missing:
+            logger.info(f'Adding {len(missing)} new QStarz users to the survey responses...')
+            _generate_null_survey(
+                self.cfg.INPUT_DATA_DIR, self.tripkit.csv.coordinates_csv, id_column='user', uuid_lookup=missing
+            )
+        return uuid_lookup
+
+    def import_rows(self, input_file, fp, offset, size, defer_indexes):
+        table_name = input_file.model._meta.table_name
+        columns = table_columns(input_file.model)
+        headers, data_start = self.headers(input_file, fp)
+        start = max(offset, data_start)
+        if input_file.splittable:
+            ranges = chunk_ranges(fp, start, size, CHUNK_BYTES)
+        else:
+            ranges = [(start, size)] if start < size else []
+
+        uuid_lookup = None
+        if input_file.row_filter == 'qstarz_coordinates':
+            uuid_lookup = self.update_qstarz_users(fp, ranges)
+
+        index_statements = drop_indexes(self.db, table_name) if defer_indexes else []
+        cursor = self.db.connection().cursor()
+        tasks = [
+            (fp, start, end, headers, input_file.row_filter, table_name, columns, uuid_lookup) for start, end in ranges
+        ]
+        num_rows = 0
+        for values, chunk_rows in self._map(_parse_chunk, tasks):
+            insert_values(cursor, table_name, columns, values, chunk_rows)
+            num_rows += chunk_rows
+            logger.info(f'{input_file.filename}: inserted {num_rows} rows...')
+        if index_statements:
+            logger.info(f'Creating {len(index_statements)} indexes on {table_name}...')
+            for sql in index_statements:
+                self.db.execute_sql(sql)
+        return num_rows
+
+
+def run(cfg, workers=1, force=False):
+    '''
+    Imports the survey's input .csv files to the cache database, skipping files unchanged since the
+    last import.
+
+    :param cfg:     The tripkit config for the survey.
+    :param workers: (Optional) The number of worker processes parsing files.
+    :param force:   (Optional) Reimport every file even if unchanged.
+    '''
+    tripkit = TripKit(config=cfg)
+    with Importer(tripkit, workers=workers, force=force) as importer:
+        importer.run()
+    if importer.rows_imported:
+        click.echo(
+            f'Imported {importer.rows_imported} rows in {importer.import_s:.1f}s '
+            f'({importer.rows_imported / max(importer.import_s, 1e-6):.0f} rows/s)'
+        )
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+from collections import deque
+import logging
+
+from tripkit.database import UserSurveyResponse
+
+from cli import profiler
+
+logger = logging.getLogger('itinerum-tripkit-cli.loader')
+
+DEFAULT_BATCH_SIZE = 100
+
+
+def count_users(tripkit):
+    '''
+    Returns the number of users in the cache database, including users without coordinates.
+    '''
+    tripkit.check_setup()
+    return UserSurveyResponse.select().count()
+
+
+def user_uuids(tripkit):
+    '''
+    Returns the uuids of the survey's users in the same order as `tripkit.load_users()`.
+    '''
+    tripkit.check_setup()
+    return [u.uuid for u in UserSurveyResponse.select(UserSurveyResponse.uuid)]
+
+
+class StoredUser(object):
+    '''
+    A user whose outputs stored in the run manifest are replayed without the user being loaded
+    from the database, for users known to be unchanged since they were last processed.
+
+    :param uuid: The user's uuid.
+    '''
+
+    def __init__(self, uuid):
+        self.uuid = uuid
+
+
+def _load_batch(tripkit, uuids, offset, total, stored):
+    users = deque()
+    for idx, uuid in enumerate(uuids, start=offset + 1):
+        if uuid in stored:
+            users.append(StoredUser(uuid))
+            continue
+        logger.info(f'Loading user from database: {idx}/{total}...')
+        user = tripkit.database.load_user(uuid)
+        if user.coordinates.count() == 0:
+            logger.info(f'User {idx} has no points, skipped.')
+            continue
+        user.trips = tripkit.database.load_trips(user)
+        user.activity_locations = tripkit.database.load_activity_locations(user)
+        users.append(user)
+    return users
+
+
+def iter_users(tripkit, batch_size=DEFAULT_BATCH_SIZE, uuids=None, stored=None):
+    '''
+    Yields the survey's users in the same order as `tripkit.load_users()`, loading the next batch
+    of users from the cache database only once the previous batch has been consumed. Each user is
+    released by the loader once yielded so memory use is bounded by the batch size rather than the
+    number of users in the survey.
+
+    :param tripkit:    The TripKit instance for the survey.
+    :param batch_size: The number of users loaded from the database at a time.
+    :param uuids:      (Optional) The uuids of the users to load instead of every user.
+    :param stored:     (Optional) The uuids of users yielded as :py:class:`StoredUser` instead of
+                       being loaded, which must have current outputs in the run manifest.
+    '''
+    with profiler.stage('load_users'):
+        uuids = uuids if uuids is not None else user_uuids(tripkit)
+    stored = stored if stored else set()
+    for offset in range(0, len(uuids), batch_size):
+        with profiler.stage('load_users'):
+            users = _load_batch(tripkit, uuids[offset : offset + batch_size], offset, len(uuids), stored)
+        while users:
+            yield users.popleft()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+import hashlib
+import json
+import logging
+import pickle
+import sqlite3
+
+from tripkit.database import Coordinate
+from tripkit.utils.misc import temp_path
+
+from cli import gis
+from cli.coordinates import UserCoordinates
+from cli.utils import tripkit_version
+
+logger = logging.getLogger('itinerum-tripkit-cli.manifest')
+
+# config prefixes of the processing parameters that change a user's outputs
+PARAMETER_PREFIXES = ('TRIP_DETECTION_', 'ACTIVITY_')
+FINGERPRINT_COLUMNS = [f for f in Coordinate._meta.sorted_fields if f.name not in ('id', 'user')]
+
+
+def fingerprint_coordinates(coordinates):
+    '''
+    Returns a hash of a user's input coordinates rows.
+
+    :param coordinates: A user's coordinates query from the cache database or in-memory coordinates.
+    '''
+    if isinstance(coordinates, UserCoordinates):
+        rows = coordinates.rows(*[f.name for f in FINGERPRINT_COLUMNS])
+    else:
+        rows = coordinates.select(*FINGERPRINT_COLUMNS).tuples().iterator()
+
+    digest = hashlib.sha1()
+    for row in rows:
+        digest.update(repr(row).encode())
+    return digest.hexdigest()
+
+
+def fingerprint_user_coordinates(user):
+    '''
+    Returns the hash of a user's input coordinates, kept on the user so their coordinates are hashed
+    only once for the run manifest and the prepared coordinates cache.
+    '''
+    if getattr(user, 'coordinates_fingerprint', None) is None:
+        user.coordinates_fingerprint = fingerprint_coordinates(user.coordinates)
+    return user.coordinates_fingerprint
+
+
+def fingerprint_parameters(cfg, options):
+    '''
+    Returns a hash of the config values and runner options that a user's outputs depend upon.
+    '''
+    parameters = {key: value for key, value in vars(cfg).items() if key.startswith(PARAMETER_PREFIXES)}
+    parameters.update(
+        {
+            'INPUT_DATA_TYPE': cfg.INPUT_DATA_TYPE,
+            'TIMEZONE': cfg.TIMEZONE,
+            'options': options,
+            'tripkit_version': tripkit_version(),
+        }
+    )
+    # the recorded writes include the features of the survey-wide GeoPackage
+    if gis.survey_file_enabled(cfg):
+        parameters['GIS_OUTPUT_SURVEY_FILE'] = True
+    return hashlib.sha1(json.dumps(parameters, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class RunManifest(object):
+    '''
+    Stores each user's input fingerprint with the survey-wide .csv writes recorded when they were last
+    processed. Users are saved as soon as their database rows are written so an interrupted run
+    resumes from the first unwritten user.
+
+    :param cfg:     The tripkit config for the survey.
+    :param options: The runner options for the current run.
+    '''
+
+    def __init__(self, cfg, options):
+        self.db_fp = temp_path(f'{cfg.SURVEY_NAME}-manifest.sqlite')
+        self.parameters = fingerprint_parameters(cfg, options)
+        self.conn = sqlite3.connect(self.db_fp)
+        self.conn.execute(
+            '''CREATE TABLE IF NOT EXISTS users (uuid TEXT PRIMARY KEY, fingerprint TEXT, outputs BLOB);'''
+        )
+
+    def fingerprint(self, user):
+        coordinates_hash = fingerprint_user_coordinates(user)
+        return hashlib.sha1(f'{coordinates_hash}:{self.parameters}'.encode()).hexdigest()
+
+    def is_current(self, uuid, fingerprint):
+        row = self.conn.execute('''SELECT fingerprint FROM users WHERE uuid = ?;''', (str(uuid),)).fetchone()
+        return row is not None and row[0] == fingerprint
+
+    def load(self, uuid):
+        row = self.conn.execute('''SELECT outputs FROM users WHERE uuid = ?;''', (str(uuid),)).fetchone()
+        return pickle.loads(row[0])
+
+    def save(self, uuid, fingerprint, calls):
+        with self.conn:
+            self.conn.execute(
+                '''INSERT OR REPLACE INTO users (uuid, fingerprint, outputs) VALUES (?, ?, ?);''',
+                (str(uuid), fingerprint, pickle.dumps(calls, protocol=pickle.HIGHEST_PROTOCOL)),
+            )
+
+    def clear(self):
+        '''
+        Removes every stored user so all users are processed again, for inputs shared by all users
+        that are not part of their fingerprints.
+        '''
+        with self.conn:
+            self.conn.execute('''DELETE FROM users;''')
+
+    def close(self):
+        self.conn.close()
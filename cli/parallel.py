@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+import concurrent.futures
+import importlib
+import logging
+import multiprocessing
+import types
+
+from cli import gis, profiler, spatial
+from cli.recorder import record_user
+
+logger = logging.getLogger('itinerum-tripkit-cli.parallel')
+
+# allow worker processes to wait on the parent process's writes to the cache database
+SQLITE_BUSY_TIMEOUT_MS = 10 * 60 * 1000
+
+# state initialized once within each worker process
+_worker = {}
+
+
+def config_values(cfg):
+    '''
+    Returns the global variables of a config as a dictionary that can be sent to worker processes.
+    '''
+    return {key: value for key, value in vars(cfg).items() if key.isupper()}
+
+
+def _init_worker(runner_name, cfg_values, options, log_level, subway_index, profiler_settings):
+    logging.basicConfig(level=log_level)
+    logging.getLogger('peewee').setLevel(logging.INFO)
+    if subway_index:
+        spatial.set_subway_index(subway_index)
+    if profiler_settings:
+        profiler.enable(**profiler_settings)
+
+    runner = importlib.import_module(runner_name)
+    tripkit = runner.setup(types.SimpleNamespace(**cfg_values))
+    tripkit.database.db.execute_sql(f'PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS};')
+    _worker.update({'runner': runner, 'tripkit': tripkit, 'options': options})
+
+
+def _process_user(uuid):
+    tripkit = _worker['tripkit']
+    calls, db_calls = [], []
+    with profiler.user(uuid):
+        with profiler.stage('load_users'):
+            user = tripkit.load_users(uuid=uuid)
+        if user:
+            calls, db_calls = record_user(tripkit, _worker['runner'], user, _worker['options'])
+        # wait on the user's GIS files so a failed write is raised by the user's task in the parent process
+        with profiler.stage('gis_writes'):
+            gis.close()
+    # send the user's stage timings back to the parent process
+    stages = profiler.active().pop_user(uuid) if profiler.active() else None
+    return calls, db_calls, stages
+
+
+def worker_pool(tripkit, runner_name, workers, options):
+    '''
+    Returns a pool of worker processes that each initialize their own TripKit instance
+    for running the per-user pipeline of a runner module.
+
+    :param tripkit:     The parent process's TripKit instance.
+    :param runner_name: The importable name of the runner module providing `setup` and `process_user`.
+    :param workers:     The number of worker processes.
+    :param options:     Keyword arguments passed to the runner's `process_user` for every user.
+    '''
+    logger.info(f'Starting {workers} worker processes...')
+    # spawn fresh interpreters so workers do not inherit the parent's open database connection
+    mp_context = multiprocessing.get_context('spawn')
+    initargs = (
+        runner_name,
+        config_values(tripkit.config),
+        options,
+        logging.getLogger().getEffectiveLevel(),
+        spatial.shared_subway_index(),
+        profiler.active().settings() if profiler.active() else None,
+    )
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, mp_context=mp_context, initializer=_init_worker, initargs=initargs
+    )
+
+
+def submit_user(executor, uuid):
+    '''
+    Queues a user for processing and returns a future of the user's recorded .csv and database writes
+    with the user's stage timings when profiling.
+    '''
+    return executor.submit(_process_user, uuid)
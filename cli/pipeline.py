@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+import collections
+import concurrent.futures
+import importlib
+import logging
+
+from cli import coordinates, gis, parallel, profiler
+from cli.bulkwriter import BulkWriter
+from cli.loader import StoredUser
+from cli.manifest import RunManifest
+from cli.recorder import record_user, replay
+from cli.sinks import CSVSinks
+from cli.utils import peak_memory_mb
+
+logger = logging.getLogger('itinerum-tripkit-cli.pipeline')
+
+# users queued ahead of the oldest unwritten user for each worker process
+QUEUED_USERS_PER_WORKER = 2
+
+
+def _completed(result):
+    future = concurrent.futures.Future()
+    future.set_result(result)
+    return future
+
+
+def run_users(tripkit, runner_name, users, options, workers=1, incremental=False, batch_size=100):
+    '''
+    Runs the per-user pipeline of a runner module for each user and writes the survey-wide outputs
+    in the order of `users`, independent of the number of worker processes. Users are consumed
+    one at a time and released once their outputs are written, with at most a few users per worker
+    queued ahead when running in parallel. Survey-wide .csv files are held open for the whole run
+    and database writes are buffered and written for each batch of users within a single transaction.
+    GIS outputs are written on background threads and waited on once all users are processed.
+    Returns the number of users processed, not counting those skipped as unchanged.
+
+    :param tripkit:     The TripKit instance for the survey.
+    :param runner_name: The importable name of the runner module providing `process_user`.
+    :param users:       The ordered users to process as a list or generator, with any
+                        :py:class:`cli.loader.StoredUser` replayed from the run manifest.
+    :param options:     Keyword arguments passed to the runner's `process_user` for every user.
+    :param workers:     The number of worker processes, users are processed in this process when 1.
+    :param incremental: Skip users that are unchanged since they were last processed and reuse
+                        their previous outputs from the run manifest.
+    :param batch_size:  The number of users whose database writes are buffered between transactions.
+    '''
+    runner = importlib.import_module(runner_name)
+    manifest = RunManifest(tripkit.config, options) if incremental else None
+    writer = BulkWriter(tripkit.database)
+    sinks = CSVSinks(tripkit.config)
+    # survey-wide GeoPackage written by this process from the features recorded for each user
+    gis_sink = gis.GeoPackageSink(tripkit.config) if gis.survey_file_enabled(tripkit.config) else None
+    num_users, num_skipped, num_written = 0, 0, 0
+    # processed users waiting on their database writes before being saved to the manifest
+    unsaved = []
+
+    def _process(user, executor=None):
+        nonlocal num_users, num_skipped
+        num_users += 1
+        if isinstance(user, StoredUser):
+            num_skipped += 1
+            return None, _completed((manifest.load(user.uuid), [], None))
+        if not executor:
+            # share the user's coordinates between fingerprinting and processing
+            coordinates.materialize(user)
+        fingerprint = manifest.fingerprint(user) if manifest else None
+        if manifest and manifest.is_current(user.uuid, fingerprint):
+            num_skipped += 1
+            return None, _completed((manifest.load(user.uuid), [], None))
+        if executor:
+            return fingerprint, parallel.submit_user(executor, user.uuid)
+        with profiler.user(user.uuid):
+            calls, db_calls = record_user(tripkit, runner, user, options)
+        return fingerprint, _completed((calls, db_calls, None))
+
+    def _flush():
+        with profiler.stage('db_flush'):
+            writer.flush()
+            sinks.flush()
+            if gis_sink:
+                gis_sink.flush()
+        for uuid, fingerprint, calls in unsaved:
+            manifest.save(uuid, fingerprint, calls)
+        unsaved.clear()
+
+    def _write(uuid, fingerprint, future):
+        nonlocal num_written
+        calls, db_calls, stages = future.result()
+        if stages:
+            profiler.active().add_user(uuid, stages)
+        with profiler.stage('csv_writes', uuid=uuid):
+            replay(calls, sinks, gis_sink)
+        with profiler.stage('db_saves', uuid=uuid):
+            replay(db_calls, writer)
+        if fingerprint:
+            unsaved.append((uuid, fingerprint, calls))
+        num_written += 1
+        if num_written % batch_size == 0:
+            _flush()
+
+    try:
+        if workers > 1:
+            max_queued = workers * QUEUED_USERS_PER_WORKER
+            queued = collections.deque()
+            with parallel.worker_pool(tripkit, runner_name, workers, options) as executor:
+                for user in users:
+                    queued.append((user.uuid, *_process(user, executor)))
+                    del user
+                    if len(queued) >= max_queued:
+                        _write(*queued.popleft())
+                while queued:
+                    _write(*queued.popleft())
+        else:
+            for user in users:
+                _write(user.uuid, *_process(user))
+                del user
+    finally:
+        # keep the writes of completed users when a run exits early
+        _flush()
+        writer.close()
+        sinks.close()
+        with profiler.stage('gis_writes'):
+            # wait on the GIS files still being written in the background
+            gis.close()
+            if gis_sink:
+                gis_sink.close()
+        if manifest:
+            logger.info(f'Skipped {num_skipped}/{num_users} users unchanged since the last run.')
+            manifest.close()
+    return num_users - num_skipped
+
+    if profiler.active():
+        profiler.active().prune_dumps()
+        extra = {'workers': workers, 'batch_size': batch_size, 'incremental': incremental}
+        profiler.active().write_report(tripkit.config, tripkit.config.SURVEY_NAME, extra=extra)
+
+    peak_mb = peak_memory_mb()
+    if peak_mb is not None:
+        logger.info(f'Peak memory: {peak_mb:.1f} MB')
+        if workers > 1:
+            logger.info(f'Peak memory of largest worker process: {peak_memory_mb(children=True):.1f} MB')
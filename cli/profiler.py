@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+import contextlib
+import cProfile
+import csv
+import functools
+import json
+import logging
+import math
+import os
+import time
+
+from cli.utils import peak_memory_mb, tripkit_version
+
+logger = logging.getLogger('itinerum-tripkit-cli.profiler')
+
+PERCENTILES = [50, 90, 95, 99]
+
+# profiler of this process, stages are not timed when `None`
+_profiler = None
+
+
+class Profiler(object):
+    '''
+    Records the wall time, CPU time and process peak resident memory of each processing stage for
+    each user, with stages outside of a user's pipeline recorded for the run. Optionally saves a
+    cProfile dump of each user to keep those of the slowest users.
+
+    The peak resident memory is the highest of the whole process at the end of the stage rather than
+    the stage's own peak, so a stage only shows memory growth when it raises the process's peak.
+
+    :param dump_dir: The directory for cProfile dumps.
+    :param top_n:    The number of slowest users to keep cProfile dumps for, disabled when 0.
+    '''
+
+    def __init__(self, dump_dir, top_n=0):
+        self.dump_dir = dump_dir
+        self.top_n = top_n
+        self.run_stages = {}
+        self.users = {}
+        self.current = None
+
+    def settings(self):
+        return {'dump_dir': self.dump_dir, 'top_n': self.top_n}
+
+    def _record(self, stages, name, wall_s, cpu_s):
+        stage = stages.setdefault(name, {'wall_s': 0.0, 'cpu_s': 0.0, 'process_peak_rss_mb': 0.0})
+        stage['wall_s'] += wall_s
+        stage['cpu_s'] += cpu_s
+        stage['process_peak_rss_mb'] = max(stage['process_peak_rss_mb'], peak_memory_mb() or 0.0)
+
+    @contextlib.contextmanager
+    def stage(self, name, uuid=None):
+        if uuid is not None:
+            stages = self.users.setdefault(str(uuid), {})
+        elif self.current is not None:
+            stages = self.users[self.current]
+        else:
+            stages = self.run_stages
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self._record(stages, name, time.perf_counter() - wall_start, time.process_time() - cpu_start)
+
+    @contextlib.contextmanager
+    def user(self, uuid):
+        self.current = str(uuid)
+        self.users.setdefault(self.current, {})
+        profile = cProfile.Profile() if self.top_n else None
+        if profile:
+            profile.enable()
+        try:
+            with self.stage('total'):
+                yield
+        finally:
+            if profile:
+                profile.disable()
+                os.makedirs(self.dump_dir, exist_ok=True)
+                profile.dump_stats(os.path.join(self.dump_dir, f'{self.current}.prof'))
+            self.current = None
+
+    def pop_user(self, uuid):
+        return self.users.pop(str(uuid), {})
+
+    def add_user(self, uuid, stages):
+        user_stages = self.users.setdefault(str(uuid), {})
+        for name, stage in stages.items():
+            merged = user_stages.setdefault(name, {'wall_s': 0.0, 'cpu_s': 0.0, 'process_peak_rss_mb': 0.0})
+            merged['wall_s'] += stage['wall_s']
+            merged['cpu_s'] += stage['cpu_s']
+            merged['process_peak_rss_mb'] = max(merged['process_peak_rss_mb'], stage['process_peak_rss_mb'])
+
+    def summary(self):
+        summary = {}
+        names = sorted({name for stages in self.users.values() for name in stages})
+        for name in names:
+            stages = [s[name] for s in self.users.values() if name in s]
+            summary[name] = {'count': len(stages), 'process_peak_rss_mb': max(s['process_peak_rss_mb'] for s in stages)}
+            for key in ('wall_s', 'cpu_s'):
+                values = sorted(s[key] for s in stages)
+                summary[name][key] = {
+                    'total': sum(values),
+                    'mean': sum(values) / len(values),
+                    **{f'p{p}': percentile(values, p) for p in PERCENTILES},
+                    'max': values[-1],
+                }
+        return summary
+
+    def slowest_users(self):
+        totals = {uuid: stages['total']['wall_s'] for uuid, stages in self.users.items() if 'total' in stages}
+        return sorted(totals, key=totals.get, reverse=True)
+
+    def prune_dumps(self):
+        '''
+        Removes the cProfile dumps of all but the slowest users.
+        '''
+        if not self.top_n or not os.path.isdir(self.dump_dir):
+            return
+        keep = {f'{uuid}.prof' for uuid in self.slowest_users()[: self.top_n]}
+        for fn in os.listdir(self.dump_dir):
+            if fn.endswith('.prof') and fn not in keep:
+                os.remove(os.path.join(self.dump_dir, fn))
+
+    def write_report(self, cfg, fn_base, extra=None):
+        '''
+        Writes the recorded stages to a .json report with survey-level percentiles and a .csv with a
+        row for each stage of each user.
+        '''
+        report = {
+            'survey': cfg.SURVEY_NAME,
+            'tripkit_version': tripkit_version(),
+            'run': self.run_stages,
+            'stages': self.summary(),
+            'slowest_users': self.slowest_users()[:10],
+            'users': self.users,
+        }
+        report.update(extra if extra else {})
+        json_fp = os.path.join(cfg.OUTPUT_DATA_DIR, f'{fn_base}-profile.json')
+        with open(json_fp, 'w') as json_f:
+            json.dump(report, json_f, indent=2)
+
+        csv_fp = os.path.join(cfg.OUTPUT_DATA_DIR, f'{fn_base}-profile.csv')
+        with open(csv_fp, 'w', newline='') as csv_f:
+            writer = csv.writer(csv_f, dialect='excel')
+            writer.writerow(['uuid', 'stage', 'wall_s', 'cpu_s', 'process_peak_rss_mb'])
+            for name, stage in self.run_stages.items():
+                writer.writerow([None, name, stage['wall_s'], stage['cpu_s'], stage['process_peak_rss_mb']])
+            for uuid, stages in self.users.items():
+                for name, stage in stages.items():
+                    writer.writerow([uuid, name, stage['wall_s'], stage['cpu_s'], stage['process_peak_rss_mb']])
+        logger.info(f'Wrote profile report: {json_fp}')
+
+
+def percentile(values, p):
+    '''
+    Returns the nearest-rank percentile of sorted values.
+    '''
+    rank = max(math.ceil(p / 100 * len(values)), 1)
+    return values[rank - 1]
+
+
+def enable(dump_dir, top_n=0):
+    '''
+    Enables stage profiling for this process.
+    '''
+    global _profiler
+    _profiler = Profiler(dump_dir, top_n=top_n)
+    return _profiler
+
+
+def active():
+    '''
+    Returns the profiler of this process or `None` when profiling is disabled.
+    '''
+    return _profiler
+
+
+def stage(name, uuid=None):
+    '''
+    Times a block as a processing stage of the current user, or of the run outside of a user's pipeline.
+
+    :param name: The stage name.
+    :param uuid: (Optional) Record the stage for this user instead of the current user.
+    '''
+    if not _profiler:
+        return contextlib.nullcontext()
+    return _profiler.stage(name, uuid=uuid)
+
+
+def user(uuid):
+    '''
+    Times a user's full pipeline and records the stages run within it for the user.
+    '''
+    if not _profiler:
+        return contextlib.nullcontext()
+    return _profiler.user(uuid)
+
+
+def timed(name):
+    '''
+    Decorates a function to time each call as a processing stage.
+    '''
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
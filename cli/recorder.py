@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+import functools
+
+from tripkit.models.User import User
+
+from cli import gis
+
+
+# survey-wide .csv writes made by the runners for each user
+CSV_WRITE_METHODS = [
+    'write_trip_summaries',
+    'write_complete_days',
+    'write_activities_daily',
+    'write_condensed_activity_locations',
+    'write_condensed_trip_summaries',
+]
+# survey-wide GeoPackage writes made through `cli.gis` for each user
+GIS_WRITE_METHODS = [
+    'write_gis_features',
+]
+# cache database writes made by the runners for each user
+DATABASE_WRITE_METHODS = [
+    'save_trips',
+    'save_trip_day_summaries',
+]
+
+
+class UserSnapshot(object):
+    '''
+    Picklable stand-in for a :py:class:`tripkit.models.User` with the attributes used by the
+    .csv writers, the full user object holds open database queries that cannot be sent
+    between processes.
+    '''
+
+    def __init__(self, user):
+        self.uuid = user.uuid
+        self.activity_locations = user.activity_locations
+
+
+class CallRecorder(object):
+    '''
+    Stands in for an output writer (e.g., `tripkit.io.csv`) and records each call so it can be
+    replayed later against the real writer, such as by the parent process after a user has
+    been processed by a worker.
+
+    :param methods: The writer method names to record.
+    '''
+
+    def __init__(self, methods):
+        self.calls = []
+        for method in methods:
+            setattr(self, method, functools.partial(self._record, method))
+
+    def _record(self, method, *args, **kwargs):
+        args = [UserSnapshot(a) if isinstance(a, User) else a for a in args]
+        self.calls.append((method, args, kwargs))
+
+
+def record_user(tripkit, runner, user, options):
+    '''
+    Runs a runner's per-user pipeline and returns its survey-wide .csv and GeoPackage writes and its
+    cache database writes as two lists of recorded calls instead of writing them. Database writes must
+    be replayed in order since saved day summaries reference the ids assigned to the saved trip points.
+    '''
+    csv_io = tripkit.io.csv
+    csv_recorder = CallRecorder(CSV_WRITE_METHODS + GIS_WRITE_METHODS)
+    db_recorder = CallRecorder(DATABASE_WRITE_METHODS)
+    tripkit.io.csv = csv_recorder
+    gis_target = gis.set_survey_target(csv_recorder)
+    for method in DATABASE_WRITE_METHODS:
+        setattr(tripkit.database, method, getattr(db_recorder, method))
+    try:
+        runner.process_user(tripkit, user, **options)
+    finally:
+        tripkit.io.csv = csv_io
+        gis.set_survey_target(gis_target)
+        for method in DATABASE_WRITE_METHODS:
+            delattr(tripkit.database, method)
+    return csv_recorder.calls, db_recorder.calls
+
+
+def replay(calls, *targets):
+    '''
+    Replays recorded calls against the first of the targets providing each call's method.
+    '''
+    for method, args, kwargs in calls:
+        target = next(t for t in targets if hasattr(t, method))
+        getattr(target, method)(*args, **kwargs)
@@ -1,2 +1,16 @@
-from . import itinerum
-from . import qstarz
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+import importlib
+
+# runner modules by input data type, imported only once selected since importing tripkit is slow
+RUNNERS = {
+    'itinerum': 'cli.runners.itinerum',
+    'qstarz': 'cli.runners.qstarz',
+}
+
+
+def load(data_type):
+    '''
+    Returns the runner module for an input data type.
+    '''
+    return importlib.import_module(RUNNERS[data_type])
@@ -3,49 +3,86 @@
 import click
 from collections import namedtuple
 import logging
+import os
 import sys
+import utm
 
 from tripkit import TripKit, utils
+from tripkit.process.trip_detection.triplab.v2 import algorithm as triplab
+from tripkit.process.trip_detection.triplab.v2.models import GPSPoint
+
+from cli import coordinates, gis, importer, loader, pipeline, profiler, shards, spatial
 
 logger = logging.getLogger('itinerum-tripkit-cli.runners.itinerum')
 
+# config parameters of the trip detection algorithm that can be varied by a parameter sweep
+SWEEP_PARAMS = [
+    'TRIP_DETECTION_BREAK_INTERVAL_SECONDS',
+    'TRIP_DETECTION_SUBWAY_BUFFER_METERS',
+    'TRIP_DETECTION_COLD_START_DISTANCE_METERS',
+    'TRIP_DETECTION_ACCURACY_CUTOFF_METERS',
+]
+
 
 def setup(cfg):
     tripkit = TripKit(config=cfg)
+    importer.check_import_finished(tripkit)
     tripkit.setup(force=False)
     return tripkit
 
 
-def load_users(tripkit, user_id):
-    if user_id:
-        logger.info(f'Loading user by ID: {user_id}')
-        return [tripkit.load_users(uuid=user_id)]
-    return tripkit.load_users()
+def load_users(tripkit, user_id, batch_size=loader.DEFAULT_BATCH_SIZE, shard=None):
+    with profiler.stage('load_users'):
+        if user_id:
+            logger.info(f'Loading user by ID: {user_id}')
+            return [tripkit.load_users(uuid=user_id)]
+        uuids = shards.shard_uuids(tripkit, shard) if shard else None
+    return loader.iter_users(tripkit, batch_size=batch_size, uuids=uuids)
 
 
-def detect_trips(tripkit, user, write_geo=False, append_to=None):
-    parameters = {
-        'subway_entrances': tripkit.database.load_subway_entrances(),
-        'break_interval_seconds': tripkit.config.TRIP_DETECTION_BREAK_INTERVAL_SECONDS,
-        'subway_buffer_meters': tripkit.config.TRIP_DETECTION_SUBWAY_BUFFER_METERS,
-        'cold_start_distance': tripkit.config.TRIP_DETECTION_COLD_START_DISTANCE_METERS,
-        'accuracy_cutoff_meters': tripkit.config.TRIP_DETECTION_ACCURACY_CUTOFF_METERS,
+def algorithm_parameters(cfg, subway_entrances):
+    '''
+    Returns the `triplab.v2.algorithm.run()` parameters of a config with the subway entrances near a user.
+    '''
+    return {
+        'subway_entrances': subway_entrances,
+        'break_interval_seconds': cfg.TRIP_DETECTION_BREAK_INTERVAL_SECONDS,
+        'subway_buffer_meters': cfg.TRIP_DETECTION_SUBWAY_BUFFER_METERS,
+        'cold_start_distance': cfg.TRIP_DETECTION_COLD_START_DISTANCE_METERS,
+        'accuracy_cutoff_meters': cfg.TRIP_DETECTION_ACCURACY_CUTOFF_METERS,
     }
-    user.trips = tripkit.process.trip_detection.triplab.v2.algorithm.run(user.coordinates, parameters=parameters)
+
+
+def trip_detection_parameters(tripkit, user, cfg):
+    '''
+    Returns the `triplab.v2.algorithm.run()` parameters of a user's trip detection with a config.
+    '''
+    latlons = user.coordinates.rows('latitude', 'longitude')
+    nearby_entrances = spatial.subway_index(tripkit).nearby(latlons, cfg.TRIP_DETECTION_SUBWAY_BUFFER_METERS)
+    return algorithm_parameters(cfg, nearby_entrances)
+
+
+def detect_trips(tripkit, user, write_geo=False, append_to=None):
+    with profiler.stage('trip_detection'):
+        parameters = trip_detection_parameters(tripkit, user, tripkit.config)
+        user.trips = tripkit.process.trip_detection.triplab.v2.algorithm.run(user.coordinates, parameters=parameters)
     tripkit.database.save_trips(user, user.trips)
     if write_geo:
         write_geodata_trips(tripkit, user)
-    trip_summaries = tripkit.process.trip_detection.triplab.v2.summarize.run(user, tripkit.config.TIMEZONE)
+    with profiler.stage('summaries'):
+        trip_summaries = tripkit.process.trip_detection.triplab.v2.summarize.run(user, tripkit.config.TIMEZONE)
     fn_base = append_to if append_to else user.uuid
     tripkit.io.csv.write_trip_summaries(fn_base=fn_base, summaries=trip_summaries, append=append_to)
 
 
 def detect_complete_day_summaries(tripkit, user, append=False):
-    complete_day_summaries = tripkit.process.complete_days.triplab.counter.run(user.trips, tripkit.config.TIMEZONE)
+    with profiler.stage('summaries'):
+        complete_day_summaries = tripkit.process.complete_days.triplab.counter.run(user.trips, tripkit.config.TIMEZONE)
     tripkit.database.save_trip_day_summaries(user, complete_day_summaries, tripkit.config.TIMEZONE)
     tripkit.io.csv.write_complete_days({user.uuid: complete_day_summaries}, append=append)
 
 
+@profiler.timed('summaries')
 def detect_activity_summaries(tripkit, user, append=False):
     locations = utils.itinerum.create_activity_locations(user)
     activity = tripkit.process.activities.triplab.detect.run(user, locations, tripkit.config.ACTIVITY_LOCATION_PROXIMITY_METERS)
@@ -60,47 +97,110 @@ def detect_activity_summaries(tripkit, user, append=False):
     tripkit.io.csv.write_activities_daily(activity_summaries_full, extra_cols=duration_cols, append=append)
 
 
+@profiler.timed('gis_writes')
 def write_input_data(tripkit, user):
-    output_fmt = tripkit.config.GIS_OUTPUT_FORMAT
-    if output_fmt.lower() == 'shp':
-        tripkit.io.shapefile.write_inputs(
-            fn_base=user.uuid,
-            coordinates=user.coordinates,
-            prompts=user.prompt_responses,
-            cancelled_prompts=user.cancelled_prompt_responses,
-        )
-    elif output_fmt.lower() == 'gpkg':
-        tripkit.io.geopackage.write_inputs(
-            fn_base=user.uuid,
-            coordinates=user.coordinates,
-            prompts=user.prompt_responses,
-            cancelled_prompts=user.cancelled_prompt_responses,
-        )
-    elif output_fmt.lower() == 'geojson':
-        tripkit.io.geojson.write_inputs(
-            fn_base=user.uuid,
-            coordinates=user.coordinates,
-            prompts=user.prompt_responses,
-            cancelled_prompts=user.cancelled_prompt_responses,
-        )
-    else:
-        msg = f'Error: file format {output_fmt} not recognized.'
-        click.echo(msg)
-        sys.exit(1)
+    gis.writer(tripkit).write_inputs(
+        fn_base=user.uuid,
+        coordinates=user.coordinates,
+        prompts=user.prompt_responses,
+        cancelled_prompts=user.cancelled_prompt_responses,
+    )
 
 
+@profiler.timed('gis_writes')
 def write_geodata_trips(tripkit, user):
-    output_fmt = tripkit.config.GIS_OUTPUT_FORMAT
-    if output_fmt.lower() == 'shp':
-        tripkit.io.shapefile.write_trips(fn_base=user.uuid, trips=user.trips)
-    elif output_fmt.lower() == 'gpkg':
-        tripkit.io.geopackage.write_trips(fn_base=user.uuid, trips=user.trips)
-    elif output_fmt.lower() == 'geojson':
-        tripkit.io.geojson.write_trips(fn_base=user.uuid, trips=user.trips)
+    gis.writer(tripkit).write_trips(fn_base=user.uuid, trips=user.trips)
+
+
+@profiler.timed('preprocess')
+def project_coordinates(user):
+    '''
+    Returns the trip detection point attributes of each of a user's coordinates with its UTM position
+    so points can be rebuilt for every set of parameters without reprojecting.
+    '''
+    points = []
+    columns = ('id', 'latitude', 'longitude', 'speed', 'h_accuracy', 'timestamp_UTC')
+    for database_id, latitude, longitude, speed, h_accuracy, timestamp_UTC in user.coordinates.rows(*columns):
+        easting, northing, _, _ = utm.from_latlon(latitude, longitude)
+        points.append((database_id, latitude, longitude, northing, easting, speed, h_accuracy, timestamp_UTC))
+    return points
+
+
+@profiler.timed('trip_detection')
+def run_projected_trip_detection(points, subway_entrances, cfg):
+    '''
+    Runs `triplab.v2.algorithm.run()` on pre-projected coordinates by standing in for the function it
+    projects the coordinates with, so every other step of tripkit's trip detection is its own.
+
+    :param points:           The user's points from :py:func:`project_coordinates`.
+    :param subway_entrances: The subway entrances within the config's buffer of the user's coordinates.
+    :param cfg:              The config with the trip detection parameters.
+    '''
+    fields = ('database_id', 'latitude', 'longitude', 'northing', 'easting', 'speed', 'h_accuracy', 'timestamp_UTC')
+
+    def generate_gps_points(_):
+        # points are rebuilt since breaking them into segments sets their attributes
+        return [GPSPoint(**dict(zip(fields, p))) for p in points]
+
+    generate_gps_points_utm = triplab.generate_gps_points
+    triplab.generate_gps_points = generate_gps_points
+    try:
+        return triplab.run(points, parameters=algorithm_parameters(cfg, subway_entrances))
+    finally:
+        triplab.generate_gps_points = generate_gps_points_utm
+
+
+def sweep_user(tripkit, user, configs):
+    '''
+    Yields a user's trips and complete day summaries detected with each config of a parameter sweep,
+    projecting the user's coordinates and finding nearby subway entrances only once.
+
+    :param tripkit: The TripKit instance for the survey.
+    :param user:    The user to process.
+    :param configs: The configs with the trip detection parameters of each combination.
+    '''
+    coordinates.materialize(user)
+    points = project_coordinates(user)
+    latlons = [(p[1], p[2]) for p in points]
+    nearby_entrances = {}
+    for cfg in configs:
+        buffer_m = cfg.TRIP_DETECTION_SUBWAY_BUFFER_METERS
+        if buffer_m not in nearby_entrances:
+            nearby_entrances[buffer_m] = spatial.subway_index(tripkit).nearby(latlons, buffer_m)
+        trips = run_projected_trip_detection(points, nearby_entrances[buffer_m], cfg)
+        with profiler.stage('summaries'):
+            complete_day_summaries = tripkit.process.complete_days.triplab.counter.run(trips, cfg.TIMEZONE)
+        yield trips, complete_day_summaries
+
+
+def process_user(tripkit, user, trips_only, complete_days_only, activity_summaries_only, write_inputs, write_geo,
+                 append_fn_base, append_mode):
+    coordinates.materialize(user)
+    if write_inputs:
+        write_input_data(tripkit, user)
+
+    if trips_only:
+        if not user.coordinates.count():
+            click.echo(f'No coordinates available for user: {user.uuid}')
+        else:
+            detect_trips(tripkit, user, write_geo, append_to=append_fn_base)
+    elif complete_days_only:
+        if not user.trips:
+            click.echo(f'No trips available for user: {user.uuid}')
+        else:
+            detect_complete_day_summaries(tripkit, user, append=append_mode)
+    elif activity_summaries_only:
+        if not user.trips:
+            click.echo(f'No trips available for user: {user.uuid}')
+        else:
+            detect_activity_summaries(tripkit, user, append=append_mode)
     else:
-        msg = f'Error: file format {output_fmt} not recognized.'
-        click.echo(msg)
-        sys.exit(1)
+        detect_trips(tripkit, user, write_geo, append_to=append_fn_base)
+        if not user.trips:
+            click.echo(f'No trips available for user: {user.uuid}')
+        else:
+            detect_complete_day_summaries(tripkit, user, append=append_mode)
+            detect_activity_summaries(tripkit, user, append=append_mode)
 
 
 @click.command()
@@ -111,47 +211,52 @@ def write_geodata_trips(tripkit, user):
 @click.option('-cn', '--condensed', 'condensed_output', is_flag=True, help='(QStarz only) Create a condensed output with a locations file, trips summaries, and aggregate survey summary.')
 @click.option('-wi', '--write-inputs', is_flag=True, help='Write input .csv coordinates data to GIS format.')
 @click.option('-wg', '--write-geo', is_flag=True, help='Write output GIS data for each user in survey.')
+@click.option('--workers', default=1, type=click.IntRange(min=1), help='Number of worker processes to process users in parallel.')
+@click.option('--incremental', is_flag=True, help='Skip users unchanged since the last incremental run and reuse their outputs.')
+@click.option('--batch-size', default=100, type=click.IntRange(min=1), help='Number of users loaded from the database at a time.')
+@click.option('--shard', callback=shards.parse_shard, help='Process only shard i of N of the users as i/N, writing outputs and a cache database named for the shard.')
+@click.option('--window', type=click.Choice(['day', 'week']), help="(QStarz only) Stream each user's coordinates through processing one day or week at a time to bound memory use on long traces.")
+@click.option('--profile', is_flag=True, help='Write a report of the time and memory used by each processing stage for each user.')
+@click.option('--profile-top', default=0, type=click.IntRange(min=0), help='With --profile, save cProfile dumps of this many of the slowest users.')
 @click.pass_context
-def run(ctx, user_id, trips_only, complete_days_only, activity_summaries_only, condensed_output, write_inputs, write_geo):
+def run(ctx, user_id, trips_only, complete_days_only, activity_summaries_only, condensed_output, write_inputs, write_geo, workers, incremental, batch_size, shard, window, profile, profile_top):
     if sum([trips_only, complete_days_only, activity_summaries_only, condensed_output]) > 1:
         click.echo('Error: Only one exclusive mode can be used at a time.')
         sys.exit(1)
     if condensed_output:
         click.echo('Error: condensed output mode is only available for QStarz datasets.')
         sys.exit(1)
+    if window:
+        click.echo('Error: windowed processing is only available for QStarz datasets.')
+        sys.exit(1)
 
     cfg = ctx.obj['config']
-    tripkit = setup(cfg)
-    users = load_users(tripkit, user_id)
-    append_fn_base = cfg.SURVEY_NAME if not user_id else None
-    append_mode = user_id is None
-
-    for user in users:
-        if write_inputs:
-            if len(users) > 1:
-                click.echo('Warning: Multiple users selected, continue writing input data? (y/n)')
-                sys.exit(1)
-            write_input_data(tripkit, user)
-
-        if trips_only:
-            if not user.coordinates.count():
-                click.echo(f'No coordinates available for user: {user.uuid}')
-            else:
-                detect_trips(tripkit, user, write_geo, append_to=append_fn_base)
-        elif complete_days_only:
-            if not user.trips:
-                click.echo(f'No trips available for user: {user.uuid}')
-            else:
-                detect_complete_day_summaries(tripkit, user, append=append_mode)
-        elif activity_summaries_only:
-            if not user.trips:
-                click.echo(f'No trips available for user: {user.uuid}')
-            else:
-                detect_activity_summaries(tripkit, user, append=append_mode)
-        else:
-            detect_trips(tripkit, user, write_geo, append_to=append_fn_base)
-            if not user.trips:
-                click.echo(f'No trips available for user: {user.uuid}')
-            else:
-                detect_complete_day_summaries(tripkit, user, append=append_mode)
-                detect_activity_summaries(tripkit, user, append=append_mode)
+    shards.use_shard(cfg, shard, user_id)
+    if write_inputs or write_geo:
+        gis.check_config(cfg)
+    if profile:
+        profiler.enable(os.path.join(cfg.OUTPUT_DATA_DIR, f'{cfg.SURVEY_NAME}-profile'), top_n=profile_top)
+    with profiler.stage('setup'):
+        tripkit = setup(cfg)
+    # the inputs of all users can be written to the survey-wide GeoPackage but not as files for each user
+    if write_inputs and not user_id and not gis.survey_file_enabled(cfg) and loader.count_users(tripkit) > 1:
+        click.echo('Warning: Multiple users selected, continue writing input data? (y/n)')
+        sys.exit(1)
+    # load the subway entrances once for all users and worker processes
+    with profiler.stage('setup'):
+        spatial.subway_index(tripkit)
+
+    options = {
+        'trips_only': trips_only,
+        'complete_days_only': complete_days_only,
+        'activity_summaries_only': activity_summaries_only,
+        'write_inputs': write_inputs,
+        'write_geo': write_geo,
+        'append_fn_base': cfg.SURVEY_NAME if not user_id else None,
+        'append_mode': user_id is None,
+    }
+    # users are loaded from the database in batches as they are processed
+    users = load_users(tripkit, user_id, batch_size=batch_size, shard=shard)
+    workers = 1 if user_id else workers
+    pipeline.run_users(tripkit, __name__, users, options, workers=workers, incremental=incremental, batch_size=batch_size)
+    shards.mark_completed(cfg, shard)
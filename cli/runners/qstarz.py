@@ -1,148 +1,321 @@
 #!/usr/bin/env python
 # Kyle Fitzsimmons, 2019
 import click
+import copy
+import functools
 import logging
 import os
-import pickle
 import sys
 
 from tripkit import TripKit
-from tripkit.utils.misc import temp_path
+
+from cli import coordinates, gis, importer, loader, pipeline, profiler, shards, windows
+from cli.artifacts import ArtifactStore
+from cli.cache import PreparedCoordinatesCache
+from cli.stages import Stage, StageGraph
 
 logger = logging.getLogger('itinerum-tripkit-cli.runners.qstarz')
 
+# config parameters of the trip detection algorithm that can be varied by a parameter sweep
+SWEEP_PARAMS = ['TRIP_DETECTION_BREAK_INTERVAL_SECONDS']
+
 
 def setup(cfg):
     tripkit = TripKit(config=cfg)
+    importer.check_import_finished(tripkit)
     tripkit.setup(force=False)
     return tripkit
 
 
-def load_users(tripkit, user_id):
-    if user_id:
-        logger.info(f'Loading user by ID: {user_id}')
-        user = tripkit.load_user_by_orig_id(orig_id=user_id)
-        if not user:
-            click.echo(f'Error: Valid data for user {user_id} not found.')
-            sys.exit(1)
-        return [user]
-    return tripkit.load_users()
+def load_users(tripkit, user_id, batch_size=loader.DEFAULT_BATCH_SIZE, shard=None):
+    with profiler.stage('load_users'):
+        if user_id:
+            logger.info(f'Loading user by ID: {user_id}')
+            user = tripkit.load_user_by_orig_id(orig_id=user_id)
+            if not user:
+                click.echo(f'Error: Valid data for user {user_id} not found.')
+                sys.exit(1)
+            return [user]
+        uuids = shards.shard_uuids(tripkit, shard) if shard else None
+    return loader.iter_users(tripkit, batch_size=batch_size, uuids=uuids)
 
 
+@profiler.timed('preprocess')
 def cache_prepared_data(tripkit, user):
-    pickle_fp = temp_path(f'{user.uuid}.pickle')
-    if not os.path.exists(pickle_fp):
-        logger.debug('Pre-processing raw coordinates data to remove empty points and duplicates...')
-        prepared_coordinates = tripkit.process.canue.preprocess.run(user.uuid, user.coordinates)
-        with open(pickle_fp, 'wb') as pickle_f:
-            pickle.dump(prepared_coordinates, pickle_f)
-    with open(pickle_fp, 'rb') as pickle_f:
-        logger.debug('Loading pre-processed coordinates data from cache...')
-        prepared_coordinates = pickle.load(pickle_f)
+    cache = PreparedCoordinatesCache(tripkit.config)
+    cache_key = cache.key(user)
+    prepared_coordinates = cache.load(cache_key)
+    if prepared_coordinates is not None:
+        logger.debug('Loaded pre-processed coordinates data from cache...')
+        return prepared_coordinates
+
+    logger.debug('Pre-processing raw coordinates data to remove empty points and duplicates...')
+    prepared_coordinates = tripkit.process.canue.preprocess.run(user.uuid, user.coordinates)
+    cache.save(cache_key, user.uuid, prepared_coordinates)
     return prepared_coordinates
 
 
-def detect_activity_locations(tripkit, user, prepared_coordinates, write_geo):
+def prepared_data_key(tripkit, user):
+    return PreparedCoordinatesCache(tripkit.config).key(user)
+
+
+def database_locations_key(tripkit, user):
+    # activity locations loaded from the database are used instead of clustering
+    return [(loc.label, loc.latitude, loc.longitude) for loc in user.activity_locations or []]
+
+
+@profiler.timed('clustering')
+def cluster_activity_locations(tripkit, user, prepared_coordinates):
+    if user.activity_locations:
+        return user.activity_locations
+    kmeans_groups = tripkit.process.clustering.kmeans.run(prepared_coordinates)
+    delta_heading_stdev_groups = tripkit.process.clustering.delta_heading_stdev.run(prepared_coordinates)
+    return tripkit.process.activities.canue.detect_locations.run(kmeans_groups, delta_heading_stdev_groups)
+
+
+@profiler.timed('trip_detection')
+def run_trip_detection(tripkit, user, prepared_coordinates, locations):
+    return tripkit.process.trip_detection.canue.algorithm.run(tripkit.config, prepared_coordinates, locations)
+
+
+@profiler.timed('summaries')
+def summarize_trips(tripkit, user, trips):
+    user.trips = trips
+    return tripkit.process.trip_detection.canue.summarize.run(user, tripkit.config.TIMEZONE)
+
+
+@profiler.timed('summaries')
+def count_complete_days(tripkit, user, trips):
+    return tripkit.process.complete_days.canue.counter.run(trips, tripkit.config.TIMEZONE)
+
+
+def pack_complete_days(complete_day_summaries, trips):
+    # day summaries reference their trips' points, stored by index to restore them against the loaded trips
+    point_idxs = {id(p): (trip_idx, idx) for trip_idx, trip in enumerate(trips) for idx, p in enumerate(trip.points)}
+    packed = []
+    for summary in complete_day_summaries:
+        summary = copy.copy(summary)
+        summary.start_point = point_idxs.get(id(summary.start_point), summary.start_point)
+        summary.end_point = point_idxs.get(id(summary.end_point), summary.end_point)
+        packed.append(summary)
+    return packed
+
+
+def unpack_complete_days(complete_day_summaries, trips):
+    for summary in complete_day_summaries:
+        if isinstance(summary.start_point, tuple):
+            summary.start_point = trips[summary.start_point[0]].points[summary.start_point[1]]
+        if isinstance(summary.end_point, tuple):
+            summary.end_point = trips[summary.end_point[0]].points[summary.end_point[1]]
+    return complete_day_summaries
+
+
+@profiler.timed('summaries')
+def tally_activities(tripkit, user, trips, locations):
+    user.trips = trips
+    activity = tripkit.process.activities.canue.tally_times.run(user, locations, tripkit.config.ACTIVITY_LOCATION_PROXIMITY_METERS)
+    if not activity:
+        return None
+    return tripkit.process.activities.canue.summarize.run_full(activity, tripkit.config.TIMEZONE)
+
+
+# each user's stage outputs are stored as artifacts keyed by their inputs and config parameters,
+# pre-processed coordinates are stored separately by the `PreparedCoordinatesCache`
+STAGES = [
+    Stage('preprocess', cache_prepared_data, key=prepared_data_key, persist=False),
+    Stage('locations', cluster_activity_locations, inputs=['preprocess'], key=database_locations_key),
+    Stage(
+        'trips',
+        run_trip_detection,
+        inputs=['preprocess', 'locations'],
+        params=['TRIP_DETECTION_BREAK_INTERVAL_SECONDS'],
+    ),
+    Stage('trip_summaries', summarize_trips, inputs=['trips'], params=['TIMEZONE']),
+    Stage(
+        'complete_days',
+        count_complete_days,
+        inputs=['trips'],
+        params=['TIMEZONE'],
+        pack=pack_complete_days,
+        unpack=unpack_complete_days,
+    ),
+    Stage(
+        'activity_summaries',
+        tally_activities,
+        inputs=['trips', 'locations'],
+        params=['TIMEZONE', 'ACTIVITY_LOCATION_PROXIMITY_METERS'],
+    ),
+]
+
+
+@profiler.timed('preprocess')
+def prepare_windows(tripkit, user, window_s):
+    return windows.prepare(tripkit, user, window_s)
+
+
+def windowed_locations_key(tripkit, user):
+    # clustered windowed locations are stored apart from those clustered from the whole trace
+    return ['windowed', database_locations_key(tripkit, user)]
+
+
+@profiler.timed('clustering')
+def cluster_windowed_locations(tripkit, user, prepared_windows):
+    if user.activity_locations:
+        return user.activity_locations
+    return windows.detect_locations(prepared_windows)
+
+
+@profiler.timed('trip_detection')
+def run_windowed_trip_detection(tripkit, user, prepared_windows, locations):
+    return windows.detect_trips(tripkit.config, prepared_windows, locations)
+
+
+def windowed_stages(window_s):
+    '''
+    Returns the stages with pre-processing, clustering and trip detection run over a user's
+    coordinates one time window at a time to bound memory use on long traces.
+
+    :param window_s: The length of each time window in seconds.
+    '''
+    replaced = {
+        'preprocess': Stage(
+            'preprocess', functools.partial(prepare_windows, window_s=window_s), key=prepared_data_key, persist=False
+        ),
+        'locations': Stage('locations', cluster_windowed_locations, inputs=['preprocess'], key=windowed_locations_key),
+        'trips': Stage(
+            'trips',
+            run_windowed_trip_detection,
+            inputs=['preprocess', 'locations'],
+            params=['TRIP_DETECTION_BREAK_INTERVAL_SECONDS'],
+        ),
+    }
+    return [replaced.get(stage.name, stage) for stage in STAGES]
+
+
+def sweep_user(tripkit, user, configs):
+    '''
+    Yields a user's trips and complete day summaries detected with each config of a parameter sweep,
+    pre-processing the user's coordinates and clustering their activity locations only once.
+
+    :param tripkit: The TripKit instance for the survey.
+    :param user:    The user to process.
+    :param configs: The configs with the trip detection parameters of each combination.
+    '''
+    coordinates.materialize(user)
+    graph = StageGraph(tripkit, user, STAGES, ArtifactStore(tripkit.config))
+    prepared_coordinates = graph.get('preprocess')
+    locations = graph.get('locations')
+    for cfg in configs:
+        with profiler.stage('trip_detection'):
+            trips = tripkit.process.trip_detection.canue.algorithm.run(cfg, prepared_coordinates, locations)
+        with profiler.stage('summaries'):
+            complete_day_summaries = tripkit.process.complete_days.canue.counter.run(trips, cfg.TIMEZONE)
+        yield trips, complete_day_summaries
+
+
+def detect_activity_locations(tripkit, user, graph, write_geo):
     logger.debug('Clustering coordinates to determine activity locations between trips...')
-    locations = user.activity_locations
-    if not locations:
-        kmeans_groups = tripkit.process.clustering.kmeans.run(prepared_coordinates)
-        delta_heading_stdev_groups = tripkit.process.clustering.delta_heading_stdev.run(prepared_coordinates)
-        locations = tripkit.process.activities.canue.detect_locations.run(kmeans_groups, delta_heading_stdev_groups)
+    locations = graph.get('locations')
     if write_geo:
         write_geodata_activity_locations(tripkit, user, locations)
     return locations
 
 
-def detect_trips(tripkit, user, prepared_coordinates, locations, write_geo, append_to=None):
+def detect_trips(tripkit, user, graph, write_geo, append_to=None):
     logger.debug('Detecting trips from GPS coordinates data...')
-    user.trips = tripkit.process.trip_detection.canue.algorithm.run(tripkit.config, prepared_coordinates, locations)
+    user.trips = graph.get('trips')
     tripkit.database.save_trips(user, user.trips)
     if write_geo:
         write_geodata_trips(tripkit, user)
-    trip_summaries = tripkit.process.trip_detection.canue.summarize.run(user, tripkit.config.TIMEZONE)
+    trip_summaries = graph.get('trip_summaries')
     fn_base = append_to if append_to else user.uuid
     tripkit.io.csv.write_trip_summaries(fn_base=fn_base, summaries=trip_summaries, append=append_to)
 
 
-def detect_complete_day_summaries(tripkit, user, append=False):
+def detect_complete_day_summaries(tripkit, user, complete_day_summaries, append=False):
     logger.debug('Generating complete days summaries...')
-    complete_day_summaries = tripkit.process.complete_days.canue.counter.run(user.trips, tripkit.config.TIMEZONE)
     tripkit.database.save_trip_day_summaries(user, complete_day_summaries, tripkit.config.TIMEZONE)
     tripkit.io.csv.write_complete_days({user.uuid: complete_day_summaries}, append=append)
 
 
-def detect_activity_summaries(tripkit, user, locations, append=False):
+def detect_activity_summaries(tripkit, user, graph, append=False):
     logger.debug('Generating dwell time at activity locations summaries...')
-    activity = tripkit.process.activities.canue.tally_times.run(user, locations, tripkit.config.ACTIVITY_LOCATION_PROXIMITY_METERS)
-    activity_summaries = tripkit.process.activities.canue.summarize.run_full(activity, tripkit.config.TIMEZONE)
+    activity_summaries = graph.get('activity_summaries')
+    if not activity_summaries:
+        logger.info(f'No trips or activity locations to summarize for {user.uuid}, skipped.')
+        return
     tripkit.io.csv.write_activities_daily(activity_summaries['records'], extra_cols=activity_summaries['duration_keys'], append=append)
 
 
-def create_condensed_output(tripkit, user, prepared_coordinates, locations):
+def create_condensed_output(tripkit, user, graph):
     logger.debug('Detecting trips from GPS coordinates data...')
-    user.trips = tripkit.process.trip_detection.canue.algorithm.run(tripkit.config, prepared_coordinates, locations)
-    trip_summaries = tripkit.process.trip_detection.canue.summarize.run(user, tripkit.config.TIMEZONE)
-    complete_day_summaries = tripkit.process.complete_days.canue.counter.run(user.trips, tripkit.config.TIMEZONE)
+    user.trips = graph.get('trips')
+    trip_summaries = graph.get('trip_summaries')
+    complete_day_summaries = graph.get('complete_days')
     tripkit.io.csv.write_condensed_activity_locations(user)
     tripkit.io.csv.write_condensed_trip_summaries(user, trip_summaries, complete_day_summaries)
 
 
+@profiler.timed('gis_writes')
 def write_input_data(tripkit, user):
-    output_fmt = tripkit.config.GIS_OUTPUT_FORMAT
-    if output_fmt.lower() == 'shp':
-        tripkit.io.shapefile.write_inputs(
-            fn_base=user.uuid,
-            coordinates=user.coordinates,
-            prompts=user.prompt_responses,
-            cancelled_prompts=user.cancelled_prompt_responses,
-        )
-    elif output_fmt.lower() == 'gpkg':
-        tripkit.io.geopackage.write_inputs(
-            fn_base=user.uuid,
-            coordinates=user.coordinates,
-            prompts=user.prompt_responses,
-            cancelled_prompts=user.cancelled_prompt_responses,
-        )
-    elif output_fmt.lower() == 'geojson':
-        tripkit.io.geojson.write_inputs(
-            fn_base=user.uuid,
-            coordinates=user.coordinates,
-            prompts=user.prompt_responses,
-            cancelled_prompts=user.cancelled_prompt_responses,
-        )
-    else:
-        msg = f'Error: file format {output_fmt} not recognized.'
-        click.echo(msg)
-        sys.exit(1)
+    gis.writer(tripkit).write_inputs(
+        fn_base=user.uuid,
+        coordinates=user.coordinates,
+        prompts=user.prompt_responses,
+        cancelled_prompts=user.cancelled_prompt_responses,
+    )
 
 
+@profiler.timed('gis_writes')
 def write_geodata_trips(tripkit, user):
-    output_fmt = tripkit.config.GIS_OUTPUT_FORMAT
-    if output_fmt.lower() == 'shp':
-        tripkit.io.shapefile.write_trips(fn_base=user.uuid, trips=user.trips)
-    elif output_fmt.lower() == 'gpkg':
-        tripkit.io.geopackage.write_trips(fn_base=user.uuid, trips=user.trips)
-    elif output_fmt.lower() == 'geojson':
-        tripkit.io.geojson.write_trips(fn_base=user.uuid, trips=user.trips)
-    else:
-        msg = f'Error: file format {output_fmt} not recognized.'
-        click.echo(msg)
-        sys.exit(1)
+    gis.writer(tripkit).write_trips(fn_base=user.uuid, trips=user.trips)
 
 
+@profiler.timed('gis_writes')
 def write_geodata_activity_locations(tripkit, user, locations):
-    output_fmt = tripkit.config.GIS_OUTPUT_FORMAT
-    if output_fmt.lower() == 'shp':
-        tripkit.io.shapefile.write_activity_locations(fn_base=user.uuid, locations=locations)
-    elif output_fmt.lower() == 'gpkg':
-        tripkit.io.geopackage.write_activity_locations(fn_base=user.uuid, locations=locations)
-    elif output_fmt.lower() == 'geojson':
-        tripkit.io.geojson.write_activity_locations(fn_base=user.uuid, locations=locations)
+    gis.writer(tripkit).write_activity_locations(fn_base=user.uuid, locations=locations)
+
+
+def process_user(tripkit, user, trips_only, complete_days_only, activity_summaries_only, condensed_output,
+                 write_inputs, write_geo, append_fn_base, append_mode, window=None):
+    if window:
+        coordinates.set_streaming(True)
+    coordinates.materialize(user)
+    if write_inputs:
+        write_input_data(tripkit, user)
+
+    stages = windowed_stages(windows.WINDOW_SECONDS[window]) if window else STAGES
+    graph = StageGraph(tripkit, user, stages, ArtifactStore(tripkit.config))
+    if trips_only:
+        if not user.coordinates.count():
+            click.echo(f'No coordinates available for user: {user.uuid}')
+        else:
+            detect_activity_locations(tripkit, user, graph, write_geo)
+            detect_trips(tripkit, user, graph, write_geo, append_to=append_fn_base)
+    elif complete_days_only:
+        if not user.trips:
+            click.echo(f'No trips available for user: {user.uuid}')
+        else:
+            # summarizes the trips saved to the database to reference their points
+            complete_day_summaries = count_complete_days(tripkit, user, user.trips)
+            detect_complete_day_summaries(tripkit, user, complete_day_summaries, append=append_mode)
+    elif activity_summaries_only:
+        if not user.trips:
+            click.echo(f'No trips available for user: {user.uuid}')
+        else:
+            detect_activity_locations(tripkit, user, graph, write_geo)
+            detect_activity_summaries(tripkit, user, graph, append=append_mode)
+    elif condensed_output:
+        detect_activity_locations(tripkit, user, graph, write_geo)
+        create_condensed_output(tripkit, user, graph)
     else:
-        msg = f'Error: file format {output_fmt} not recognized.'
-        click.echo(msg)
-        sys.exit(1)
+        detect_activity_locations(tripkit, user, graph, write_geo)
+        detect_trips(tripkit, user, graph, write_geo, append_to=append_fn_base)
+        if not user.trips:
+            click.echo(f'No trips available for user: {user.uuid}')
+        else:
+            detect_complete_day_summaries(tripkit, user, graph.get('complete_days'), append=append_mode)
+            detect_activity_summaries(tripkit, user, graph, append=append_mode)
 
 
 @click.command()
@@ -153,55 +326,49 @@ def write_geodata_activity_locations(tripkit, user, locations):
 @click.option('-cn', '--condensed', 'condensed_output', is_flag=True, help='(QStarz only) Create a condensed output with a locations file, trips summaries, and aggregate survey summary.')
 @click.option('-wi', '--write-inputs', is_flag=True, help='Write input .csv coordinates data to GIS format.')
 @click.option('-wg', '--write-geo', is_flag=True, help='Write output GIS data for each user in survey.')
+@click.option('--workers', default=1, type=click.IntRange(min=1), help='Number of worker processes to process users in parallel.')
+@click.option('--incremental', is_flag=True, help='Skip users unchanged since the last incremental run and reuse their outputs.')
+@click.option('--batch-size', default=100, type=click.IntRange(min=1), help='Number of users loaded from the database at a time.')
+@click.option('--shard', callback=shards.parse_shard, help='Process only shard i of N of the users as i/N, writing outputs and a cache database named for the shard.')
+@click.option('--window', type=click.Choice(sorted(windows.WINDOW_SECONDS)), help="(QStarz only) Stream each user's coordinates through processing one day or week at a time to bound memory use on long traces.")
+@click.option('--profile', is_flag=True, help='Write a report of the time and memory used by each processing stage for each user.')
+@click.option('--profile-top', default=0, type=click.IntRange(min=0), help='With --profile, save cProfile dumps of this many of the slowest users.')
 @click.pass_context
-def run(ctx, user_id, trips_only, complete_days_only, activity_summaries_only, condensed_output, write_inputs, write_geo):
+def run(ctx, user_id, trips_only, complete_days_only, activity_summaries_only, condensed_output, write_inputs, write_geo, workers, incremental, batch_size, shard, window, profile, profile_top):
     if sum([trips_only, complete_days_only, activity_summaries_only, condensed_output]) > 1:
         click.echo('Error: Only one exclusive mode can be run at a time.')
         sys.exit(1)
 
     cfg = ctx.obj['config']
     cfg.INPUT_DATA_TYPE = 'qstarz'
-    tripkit = setup(cfg)
-    users = load_users(tripkit, user_id)
-    append_fn_base = cfg.SURVEY_NAME if not user_id else None
-    append_mode = user_id is None
-
-    for user in users:
-        if write_inputs:
-            if len(users) > 1:
-                click.echo('Warning: Multiple users selected, continue writing input data? (y/n)')
-                sys.exit(1)
-            write_input_data(tripkit, user)
+    shards.use_shard(cfg, shard, user_id)
+    if write_inputs or write_geo:
+        gis.check_config(cfg)
+    if profile:
+        profiler.enable(os.path.join(cfg.OUTPUT_DATA_DIR, f'{cfg.SURVEY_NAME}-profile'), top_n=profile_top)
+    # users' coordinates are read from the database by each windowed stage instead of being held in memory
+    coordinates.set_streaming(bool(window))
+    with profiler.stage('setup'):
+        tripkit = setup(cfg)
+    # the inputs of all users can be written to the survey-wide GeoPackage but not as files for each user
+    if write_inputs and not user_id and not gis.survey_file_enabled(cfg) and loader.count_users(tripkit) > 1:
+        click.echo('Warning: Multiple users selected, continue writing input data? (y/n)')
+        sys.exit(1)
 
-        if trips_only:
-            if not user.coordinates.count():
-                click.echo(f'No coordinates available for user: {user.uuid}')
-                sys.exit(1)
-            prepared_coordinates = cache_prepared_data(tripkit, user)
-            locations = detect_activity_locations(tripkit, user, prepared_coordinates, write_geo)
-            detect_trips(tripkit, user, prepared_coordinates, locations, write_geo, append_to=append_fn_base)
-        elif complete_days_only:
-            if not user.trips:
-                click.echo(f'No trips available for user: {user.uuid}')
-                sys.exit(1)
-            detect_complete_day_summaries(tripkit, user, append=append_mode)
-        elif activity_summaries_only:
-            if not user.trips:
-                click.echo(f'No trips available for user: {user.uuid}')
-                sys.exit(1)
-            prepared_coordinates = cache_prepared_data(tripkit, user)
-            locations = detect_activity_locations(tripkit, user, prepared_coordinates, write_geo)
-            detect_activity_summaries(tripkit, user, locations, append=append_mode)
-        elif condensed_output:
-            prepared_coordinates = cache_prepared_data(tripkit, user)
-            locations = detect_activity_locations(tripkit, user, prepared_coordinates, write_geo)
-            create_condensed_output(tripkit, user, prepared_coordinates, locations)
-        else:
-            prepared_coordinates = cache_prepared_data(tripkit, user)
-            locations = detect_activity_locations(tripkit, user, prepared_coordinates, write_geo)
-            detect_trips(tripkit, user, prepared_coordinates, locations, write_geo, append_to=append_fn_base)
-            if not user.trips:
-                click.echo(f'No trips available for user: {user.uuid}')
-                sys.exit(1)
-            detect_complete_day_summaries(tripkit, user, append=append_mode)
-            detect_activity_summaries(tripkit, user, locations, append=append_mode)
+    options = {
+        'trips_only': trips_only,
+        'complete_days_only': complete_days_only,
+        'activity_summaries_only': activity_summaries_only,
+        'condensed_output': condensed_output,
+        'write_inputs': write_inputs,
+        'write_geo': write_geo,
+        'append_fn_base': cfg.SURVEY_NAME if not user_id else None,
+        'append_mode': user_id is None,
+    }
+    if window:
+        options['window'] = window
+    # users are loaded from the database in batches as they are processed
+    users = load_users(tripkit, user_id, batch_size=batch_size, shard=shard)
+    workers = 1 if user_id else workers
+    pipeline.run_users(tripkit, __name__, users, options, workers=workers, incremental=incremental, batch_size=batch_size)
+    shards.mark_completed(cfg, shard)
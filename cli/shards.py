@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+import click
+import hashlib
+import itertools
+import json
+import logging
+import os
+import shutil
+import sys
+
+logger = logging.getLogger('itinerum-tripkit-cli.shards')
+
+# survey-wide .csv outputs as written by `cli.sinks.CSVSinks` with their number of header rows and
+# the number of those rows that must match across shards, since the QStarz daily activity columns
+# are named from the first user of each run as in a single run's append mode
+MERGED_CSV_OUTPUTS = [
+    ('trip_summaries', 1, 1),
+    ('complete_days', 1, 1),
+    ('daily_activity_summaries', 2, 1),
+    ('activity_locations_condensed', 2, 2),
+    ('trip_summaries_condensed', 2, 2),
+]
+MERGE_BATCH_FEATURES = 20000
+
+
+def parse_shard(ctx, param, value):
+    '''
+    Parses a `--shard i/N` option as the 1-based shard index and the number of shards.
+    '''
+    if value is None:
+        return None
+    try:
+        index, count = [int(v) for v in value.split('/')]
+    except ValueError:
+        raise click.BadParameter('must be given as i/N, e.g., 1/4')
+    if count < 1 or not 1 <= index <= count:
+        raise click.BadParameter('the shard index must be from 1 to the number of shards')
+    return index, count
+
+
+def shard_survey_name(survey_name, shard):
+    index, count = shard
+    return f'{survey_name}-shard-{index}-of-{count}'
+
+
+def in_shard(key, shard):
+    '''
+    Returns whether a user belongs to a shard from a hash of the user's key, so each user is assigned
+    to the same shard on every machine.
+    '''
+    index, count = shard
+    return int(hashlib.sha1(key.encode()).hexdigest(), 16) % count == index - 1
+
+
+def shard_uuids(tripkit, shard):
+    '''
+    Returns the uuids of the users of a shard in the same order as `tripkit.load_users()`. Users
+    are keyed by their original id where the data has one (QStarz) since their uuids are generated
+    for each cache database, and otherwise by their uuid.
+    '''
+    from tripkit.database import UserSurveyResponse
+
+    tripkit.check_setup()
+    query = UserSurveyResponse.select(UserSurveyResponse.uuid, UserSurveyResponse.orig_id)
+    return [u.uuid for u in query if in_shard(u.orig_id or str(u.uuid), shard)]
+
+
+def use_shard(cfg, shard, user_id=None):
+    '''
+    Renames the survey of a config to the shard's survey name so the shard is processed with its own
+    cache database and writes its own survey-wide outputs.
+    '''
+    if shard and user_id:
+        click.echo('Error: --shard cannot be used with a single user.')
+        sys.exit(1)
+    if shard:
+        cfg.SURVEY_NAME = shard_survey_name(cfg.SURVEY_NAME, shard)
+        logger.info(f'Processing shard {shard[0]}/{shard[1]} as survey {cfg.SURVEY_NAME}...')
+
+
+def completed_fp(output_dir, shard_name):
+    return os.path.join(output_dir, f'{shard_name}-completed.json')
+
+
+def mark_completed(cfg, shard):
+    '''
+    Writes the marker of a shard whose users have all been processed, a shard may have no outputs
+    when none of its users have trips.
+    '''
+    if shard:
+        os.makedirs(cfg.OUTPUT_DATA_DIR, exist_ok=True)
+        with open(completed_fp(cfg.OUTPUT_DATA_DIR, cfg.SURVEY_NAME), 'w') as json_f:
+            json.dump({'shard': shard[0], 'shards': shard[1]}, json_f)
+
+
+def read_headers(fp, header_rows):
+    with open(fp, 'rb') as csv_f:
+        return [csv_f.readline() for _ in range(header_rows)]
+
+
+def check_csv_headers(shard_fps, header_rows, matched_rows):
+    '''
+    Raises an error if the header rows that must match differ between the shards' .csv files.
+    '''
+    headers = read_headers(shard_fps[0], header_rows)[:matched_rows]
+    for shard_fp in shard_fps[1:]:
+        if read_headers(shard_fp, header_rows)[:matched_rows] != headers:
+            raise click.ClickException(f'Headers of {shard_fp} do not match the other shards.')
+
+
+def merge_csv(output_fp, shard_fps, header_rows):
+    '''
+    Concatenates the rows of each shard's .csv file after the header rows of the first file, copying
+    the files' bytes as written.
+    '''
+    with open(output_fp, 'wb') as output_f:
+        output_f.writelines(read_headers(shard_fps[0], header_rows))
+        for shard_fp in shard_fps:
+            with open(shard_fp, 'rb') as shard_f:
+                for _ in range(header_rows):
+                    shard_f.readline()
+                shutil.copyfileobj(shard_f, output_f)
+
+
+def check_geopackages(shard_fps):
+    '''
+    Raises an error if a layer's schema differs between the shards' GeoPackages.
+    '''
+    import fiona
+
+    schemas = {}
+    for shard_fp in shard_fps:
+        for layer in fiona.listlayers(shard_fp):
+            with fiona.open(shard_fp, layer=layer) as src:
+                if schemas.setdefault(layer, src.schema) != src.schema:
+                    raise click.ClickException(f'Layer {layer} of {shard_fp} does not match the other shards.')
+
+
+def merge_geopackage(cfg, shard_fps):
+    import fiona
+
+    from cli.gis import GeoPackageSink
+
+    sink = GeoPackageSink(cfg, batch_features=MERGE_BATCH_FEATURES)
+    for shard_fp in shard_fps:
+        for layer in fiona.listlayers(shard_fp):
+            with fiona.open(shard_fp, layer=layer) as src:
+                features = iter(src)
+                batch = list(itertools.islice(features, MERGE_BATCH_FEATURES))
+                while batch:
+                    sink.write_gis_features(layer, src.schema, batch)
+                    batch = list(itertools.islice(features, MERGE_BATCH_FEATURES))
+    sink.close()
+
+
+def merge(cfg, num_shards, shards_dir=None):
+    '''
+    Combines the survey-wide outputs written by each shard of a survey into the survey's own
+    survey-wide files. Rows are grouped by shard in shard order.
+
+    :param cfg:        The tripkit config for the survey.
+    :param num_shards: The number of shards the survey was split into.
+    :param shards_dir: (Optional) The directory of the shard outputs, defaults to the output directory.
+    '''
+    shards_dir = shards_dir if shards_dir else cfg.OUTPUT_DATA_DIR
+    shard_names = [shard_survey_name(cfg.SURVEY_NAME, (index, num_shards)) for index in range(1, num_shards + 1)]
+
+    def _shard_fps(suffix):
+        shard_fps = [os.path.join(shards_dir, f'{shard_name}{suffix}') for shard_name in shard_names]
+        return [fp for fp in shard_fps if os.path.exists(fp)]
+
+    missing = [name for name in shard_names if not os.path.exists(completed_fp(shards_dir, name))]
+    if missing:
+        click.echo(f'Error: shards not completed in {shards_dir}: {", ".join(missing)}')
+        sys.exit(1)
+
+    # check every shard's files before writing so a failed merge leaves no merged outputs
+    csv_merges = []
+    for name, header_rows, matched_rows in MERGED_CSV_OUTPUTS:
+        shard_fps = _shard_fps(f'-{name}.csv')
+        if shard_fps:
+            check_csv_headers(shard_fps, header_rows, matched_rows)
+            csv_merges.append((f'{cfg.SURVEY_NAME}-{name}.csv', shard_fps, header_rows))
+    gpkg_fps = _shard_fps('.gpkg')
+    if gpkg_fps:
+        check_geopackages(gpkg_fps)
+
+    os.makedirs(cfg.OUTPUT_DATA_DIR, exist_ok=True)
+    for output_fn, shard_fps, header_rows in csv_merges:
+        merge_csv(os.path.join(cfg.OUTPUT_DATA_DIR, output_fn), shard_fps, header_rows)
+        click.echo(f'Merged {len(shard_fps)} shards to {output_fn}')
+    if gpkg_fps:
+        merge_geopackage(cfg, gpkg_fps)
+        click.echo(f'Merged {len(gpkg_fps)} shards to {cfg.SURVEY_NAME}.gpkg')
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+import builtins
+import contextlib
+import functools
+import logging
+
+from tripkit.io import csvio
+
+from cli.recorder import CSV_WRITE_METHODS
+
+logger = logging.getLogger('itinerum-tripkit-cli.sinks')
+
+SINK_BUFFER_BYTES = 1024 * 1024
+
+
+class CSVSinks(object):
+    '''
+    Writes the survey-wide .csv outputs with the `tripkit.io.csv` writers through buffered files held
+    open for the whole run instead of reopening each file for every user. While a writer runs, its
+    opens of an output file return the held file, restarted when opened for writing, so headers, rows
+    and the replacement of files left by a previous run are all tripkit's own.
+
+    :param cfg: The tripkit config for the survey.
+    '''
+
+    def __init__(self, cfg):
+        self.csv_io = csvio.CSVIO(cfg)
+        self.files = {}
+        for method in CSV_WRITE_METHODS:
+            setattr(self, method, functools.partial(self._write, method))
+
+    def _open(self, csv_fp, mode='r', **kwargs):
+        if mode not in ('w', 'a'):
+            return builtins.open(csv_fp, mode, **kwargs)
+        if csv_fp not in self.files:
+            self.files[csv_fp] = builtins.open(csv_fp, 'a', buffering=SINK_BUFFER_BYTES, **kwargs)
+        csv_f = self.files[csv_fp]
+        if mode == 'w':
+            csv_f.seek(0)
+            csv_f.truncate()
+        # the writer's `with` block leaves the held file open
+        return contextlib.nullcontext(csv_f)
+
+    def _write(self, method, *args, **kwargs):
+        csvio.open = self._open
+        try:
+            getattr(self.csv_io, method)(*args, **kwargs)
+        finally:
+            del csvio.open
+
+    def flush(self):
+        for csv_f in self.files.values():
+            csv_f.flush()
+
+    def close(self):
+        for csv_f in self.files.values():
+            csv_f.close()
+        self.files = {}
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+from collections import namedtuple
+import logging
+import math
+
+logger = logging.getLogger('itinerum-tripkit-cli.spatial')
+
+# the shortest length of a degree of latitude and the length of a degree of longitude at the equator
+METERS_PER_DEGREE_LAT = 110574.0
+METERS_PER_DEGREE_LON = 111320.0
+# widen searches to cover the difference between UTM and great-circle distances
+DISTANCE_TOLERANCE = 1.1
+# smallest grid cell, so a zero or small subway buffer does not index the entrances in tiny cells
+MIN_CELL_M = 100.0
+
+Entrance = namedtuple('Entrance', ['latitude', 'longitude'])
+
+# subway entrances index shared by all users of a run within this process
+_subway_index = None
+
+
+class SubwayEntranceIndex(object):
+    '''
+    Grid index of subway station entrances with cells sized in meters. Trip detection tests segment
+    ends against every entrance it is given, so each user is passed only the entrances within reach
+    of their coordinates. Entrances keep their original order so the first matching entrance is the
+    same as when testing against all entrances.
+
+    :param entrances: Iterable of objects with `latitude` and `longitude` attributes.
+    :param cell_m:    The grid cell size in meters, usually the subway buffer distance, and at
+                      least `MIN_CELL_M`.
+    '''
+
+    def __init__(self, entrances, cell_m):
+        self.entrances = [Entrance(e.latitude, e.longitude) for e in entrances]
+        self.cell_m = max(cell_m, MIN_CELL_M)
+        # size longitude cells by the narrowest degree of longitude near the entrances
+        max_lat = max([abs(e.latitude) for e in self.entrances], default=0.0)
+        max_lat = min(max_lat + 1.0, 89.0)
+        self.cell_lat = self.cell_m / METERS_PER_DEGREE_LAT
+        self.cell_lon = self.cell_m / (METERS_PER_DEGREE_LON * math.cos(math.radians(max_lat)))
+
+        self.cells = {}
+        for idx, e in enumerate(self.entrances):
+            self.cells.setdefault(self._cell(e.latitude, e.longitude), []).append(idx)
+        logger.info(f'Indexed {len(self.entrances)} subway entrances into {len(self.cells)} grid cells.')
+
+    def _cell(self, latitude, longitude):
+        return int(latitude // self.cell_lat), int(longitude // self.cell_lon)
+
+    def nearby(self, latlons, buffer_m):
+        '''
+        Returns the entrances that may be within a buffer distance of any of the given points.
+
+        :param latlons:  Iterable of (latitude, longitude) pairs.
+        :param buffer_m: The search distance in meters.
+        '''
+        if not self.entrances or buffer_m < 0:
+            return []
+        ring = int(math.ceil(buffer_m * DISTANCE_TOLERANCE / self.cell_m))
+        point_cells = {self._cell(lat, lon) for lat, lon in latlons}
+
+        matches = set()
+        for i, j in point_cells:
+            for di in range(-ring, ring + 1):
+                for dj in range(-ring, ring + 1):
+                    matches.update(self.cells.get((i + di, j + dj), ()))
+        return [self.entrances[idx] for idx in sorted(matches)]
+
+
+def subway_index(tripkit):
+    '''
+    Returns the subway entrances index for the run, loading the entrances from the cache
+    database on first use.
+    '''
+    global _subway_index
+    if _subway_index is None:
+        entrances = tripkit.database.load_subway_entrances()
+        _subway_index = SubwayEntranceIndex(entrances, tripkit.config.TRIP_DETECTION_SUBWAY_BUFFER_METERS)
+    return _subway_index
+
+
+def set_subway_index(index):
+    '''
+    Shares an index built by another process, such as the parent of a worker process.
+    '''
+    global _subway_index
+    _subway_index = index
+
+
+def shared_subway_index():
+    '''
+    Returns the index built by this process to share with worker processes, or `None` if not built.
+    '''
+    return _subway_index
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+import logging
+
+from cli import profiler
+from cli.artifacts import MISSING
+
+logger = logging.getLogger('itinerum-tripkit-cli.stages')
+
+
+class Stage(object):
+    '''
+    A processing stage computing an output for a user from the outputs of its input stages.
+
+    :param name:    The stage name.
+    :param run:     Function called as `run(tripkit, user, *inputs)` returning the stage output.
+    :param inputs:  (Optional) The names of the stages whose outputs are passed to `run`.
+    :param params:  (Optional) The config parameters used by `run`.
+    :param key:     (Optional) Function called as `key(tripkit, user)` returning any other value
+                    the output depends on, such as a fingerprint of the user's input data.
+    :param persist: (Optional) Store the output as an artifact, disabled for stages cached elsewhere.
+    :param pack:    (Optional) Function called as `pack(output, *inputs)` returning the value to store.
+    :param unpack:  (Optional) Function called as `unpack(value, *inputs)` restoring a stored output.
+    '''
+
+    def __init__(self, name, run, inputs=None, params=None, key=None, persist=True, pack=None, unpack=None):
+        self.name = name
+        self.run = run
+        self.inputs = inputs if inputs else []
+        self.params = params if params else []
+        self.key = key
+        self.persist = persist
+        self.pack = pack
+        self.unpack = unpack
+
+
+class StageGraph(object):
+    '''
+    Resolves a user's stage outputs on demand, running only the stages whose output is not stored
+    for the current inputs and config parameters. Each stage's key chains the keys of its inputs so
+    changing a parameter reruns the stage using it and every stage downstream of it.
+
+    :param tripkit: The TripKit instance for the survey.
+    :param user:    The user to process.
+    :param stages:  The :py:class:`Stage` definitions, in any order.
+    :param store:   The :py:class:`cli.artifacts.ArtifactStore` for stage outputs.
+    '''
+
+    def __init__(self, tripkit, user, stages, store):
+        self.tripkit = tripkit
+        self.user = user
+        self.stages = {stage.name: stage for stage in stages}
+        self.store = store
+        self.keys = {}
+        self.outputs = {}
+
+    def key(self, name):
+        if name not in self.keys:
+            stage = self.stages[name]
+            parts = {
+                'stage': name,
+                'inputs': [self.key(input_name) for input_name in stage.inputs],
+                'params': {param: getattr(self.tripkit.config, param) for param in stage.params},
+            }
+            if stage.key:
+                parts['key'] = stage.key(self.tripkit, self.user)
+            self.keys[name] = self.store.key(parts)
+        return self.keys[name]
+
+    def get(self, name):
+        '''
+        Returns a stage output, loading it from the artifact store or running the stage and its
+        missing inputs.
+
+        :param name: The stage name.
+        '''
+        if name in self.outputs:
+            return self.outputs[name]
+        stage = self.stages[name]
+        key = self.key(name)
+
+        value = MISSING
+        if stage.persist:
+            with profiler.stage('artifacts'):
+                value = self.store.load(self.user.uuid, name, key)
+        if value is not MISSING:
+            logger.debug(f'Loaded {name} artifact for {self.user.uuid}.')
+            inputs = [self.get(input_name) for input_name in stage.inputs] if stage.unpack else []
+            output = stage.unpack(value, *inputs) if stage.unpack else value
+        else:
+            inputs = [self.get(input_name) for input_name in stage.inputs]
+            output = stage.run(self.tripkit, self.user, *inputs)
+            if stage.persist:
+                with profiler.stage('artifacts'):
+                    value = stage.pack(output, *inputs) if stage.pack else output
+                    self.store.save(self.user.uuid, name, key, value)
+        self.outputs[name] = output
+        return output
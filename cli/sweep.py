@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+import click
+import concurrent.futures
+import csv
+import importlib
+import itertools
+import logging
+import math
+import multiprocessing
+import os
+import statistics
+import sys
+import types
+
+from cli import loader, spatial
+from cli.parallel import config_values
+
+logger = logging.getLogger('itinerum-tripkit-cli.sweep')
+
+# trip codes below 100 are complete trips and codes from 100 are inferred missing trips
+MISSING_TRIP_CODE = 100
+STAT_COLUMNS = [
+    'users',
+    'failed_users',
+    'trips',
+    'complete_trips',
+    'missing_trips',
+    'total_trip_duration_h',
+    'mean_trip_duration_min',
+    'median_trip_duration_min',
+    'days',
+    'days_with_trips',
+    'complete_days',
+]
+
+# state initialized once within each worker process
+_worker = {}
+
+
+def parse_values(values_str):
+    '''
+    Returns the values of a swept parameter given as a comma-separated list or an inclusive
+    `start:stop:step` range.
+    '''
+    def number(value):
+        value = value.strip()
+        return float(value) if '.' in value else int(value)
+
+    if ':' in values_str:
+        start, stop, step = [number(v) for v in values_str.split(':')]
+        if step <= 0:
+            raise ValueError('step must be positive')
+        # count the steps with a tolerance so float ranges keep their inclusive stop value
+        count = math.floor((stop - start) / step + 1e-9) + 1
+        if count < 1:
+            raise ValueError('stop must not be less than start')
+        values = [start + step * idx for idx in range(count)]
+        if isinstance(start + step, float):
+            values = [round(value, 9) for value in values]
+        return values
+    return [number(v) for v in values_str.split(',')]
+
+
+def parse_grid(param_args, sweep_params):
+    '''
+    Returns the swept parameters and their values from `NAME=VALUES` command line arguments.
+
+    :param param_args:   The `--param` arguments, names may omit the `TRIP_DETECTION_` prefix.
+    :param sweep_params: The config parameters the runner's trip detection can sweep.
+    '''
+    grid = {}
+    for arg in param_args:
+        name, _, values_str = arg.partition('=')
+        name = name.strip().upper()
+        if name not in sweep_params and f'TRIP_DETECTION_{name}' in sweep_params:
+            name = f'TRIP_DETECTION_{name}'
+        if name not in sweep_params:
+            click.echo(f'Error: {name} cannot be swept, available parameters: {", ".join(sweep_params)}')
+            sys.exit(1)
+        try:
+            grid[name] = parse_values(values_str)
+        except ValueError:
+            click.echo(f'Error: values for {name} must be numbers as v1,v2,... or start:stop:step.')
+            sys.exit(1)
+    return grid
+
+
+def combinations(grid):
+    '''
+    Returns a dictionary of parameter values for each combination of the grid.
+    '''
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def sweep_configs(cfg_values, combos):
+    return [types.SimpleNamespace(**dict(cfg_values, **combo)) for combo in combos]
+
+
+def user_stats(trips, complete_day_summaries):
+    '''
+    Returns the trip and complete day counts of a user's results for one parameter combination.
+    '''
+    complete_trips = [t for t in trips if t.trip_code < MISSING_TRIP_CODE]
+    return {
+        'trips': len(trips),
+        'complete_trips': len(complete_trips),
+        'missing_trips': len(trips) - len(complete_trips),
+        'durations_s': [(t.end_UTC - t.start_UTC).total_seconds() for t in complete_trips],
+        'days': len(complete_day_summaries),
+        'days_with_trips': sum([1 for day in complete_day_summaries if day.has_trips]),
+        'complete_days': sum([1 for day in complete_day_summaries if day.is_complete]),
+    }
+
+
+def sweep_user(runner, tripkit, user, combos, combo_idxs):
+    '''
+    Returns a user's stats for each of the given parameter combinations by their index. A combination
+    failing trip detection is returned as `None` and the user's remaining combinations are resumed.
+    '''
+    cfg_values = config_values(tripkit.config)
+    results = {}
+    pending = list(combo_idxs)
+    while pending:
+        user_results = runner.sweep_user(tripkit, user, sweep_configs(cfg_values, [combos[idx] for idx in pending]))
+        for idx in list(pending):
+            pending.remove(idx)
+            try:
+                trips, complete_day_summaries = next(user_results)
+            except Exception:
+                logger.exception(f'Trip detection failed for {user.uuid} with {combos[idx]}')
+                results[idx] = None
+                break
+            results[idx] = user_stats(trips, complete_day_summaries)
+    return results
+
+
+def _init_worker(runner_name, cfg_values, combos, log_level, subway_index):
+    logging.basicConfig(level=log_level)
+    logging.getLogger('peewee').setLevel(logging.INFO)
+    if subway_index:
+        spatial.set_subway_index(subway_index)
+    runner = importlib.import_module(runner_name)
+    tripkit = runner.setup(types.SimpleNamespace(**cfg_values))
+    _worker.update({'runner': runner, 'tripkit': tripkit, 'combos': combos})
+
+
+def _sweep_user(uuid, combo_idxs):
+    tripkit = _worker['tripkit']
+    user = tripkit.load_users(uuid=uuid)
+    if not user or not user.coordinates.count():
+        return uuid, {}
+    return uuid, sweep_user(_worker['runner'], tripkit, user, _worker['combos'], combo_idxs)
+
+
+def chunk(items, num_chunks):
+    size = -(-len(items) // num_chunks)
+    return [items[idx:idx + size] for idx in range(0, len(items), size)]
+
+
+class SweepTotals(object):
+    '''
+    Totals of every user's stats for each parameter combination.
+
+    :param combos: The parameter values of each combination.
+    '''
+
+    def __init__(self, combos):
+        self.combos = combos
+        self.totals = [{'users': 0, 'failed_users': 0, 'durations_s': []} for _ in combos]
+
+    def add(self, results):
+        for idx, stats in results.items():
+            totals = self.totals[idx]
+            if stats is None:
+                totals['failed_users'] += 1
+                continue
+            totals['users'] += 1
+            totals['durations_s'].extend(stats['durations_s'])
+            for key, value in stats.items():
+                if key != 'durations_s':
+                    totals[key] = totals.get(key, 0) + value
+
+    def rows(self):
+        for idx, (combo, totals) in enumerate(zip(self.combos, self.totals)):
+            durations_s = totals['durations_s']
+            row = {'config': idx + 1}
+            row.update(combo)
+            row.update({
+                'users': totals['users'],
+                'failed_users': totals['failed_users'],
+                'trips': totals.get('trips', 0),
+                'complete_trips': totals.get('complete_trips', 0),
+                'missing_trips': totals.get('missing_trips', 0),
+                'total_trip_duration_h': round(sum(durations_s) / 3600, 2),
+                'mean_trip_duration_min': round(statistics.mean(durations_s) / 60, 2) if durations_s else None,
+                'median_trip_duration_min': round(statistics.median(durations_s) / 60, 2) if durations_s else None,
+                'days': totals.get('days', 0),
+                'days_with_trips': totals.get('days_with_trips', 0),
+                'complete_days': totals.get('complete_days', 0),
+            })
+            yield row
+
+
+def run_serial(runner, tripkit, users, combos, totals):
+    combo_idxs = list(range(len(combos)))
+    for user in users:
+        if not user.coordinates.count():
+            continue
+        logger.info(f'Sweeping {len(combos)} configs for {user.uuid}...')
+        totals.add(sweep_user(runner, tripkit, user, combos, combo_idxs))
+
+
+def run_parallel(runner_name, tripkit, uuids, combos, totals, workers):
+    # split the combinations of each user across idle workers when there are fewer users than workers
+    combo_idxs = list(range(len(combos)))
+    num_chunks = max(1, min(len(combos), workers // max(len(uuids), 1)))
+    tasks = [(uuid, idxs) for uuid in uuids for idxs in chunk(combo_idxs, num_chunks)]
+
+    logger.info(f'Starting {workers} worker processes...')
+    mp_context = multiprocessing.get_context('spawn')
+    initargs = (
+        runner_name,
+        config_values(tripkit.config),
+        combos,
+        logging.getLogger().getEffectiveLevel(),
+        spatial.shared_subway_index(),
+    )
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, mp_context=mp_context, initializer=_init_worker, initargs=initargs
+    ) as executor:
+        futures = [executor.submit(_sweep_user, uuid, idxs) for uuid, idxs in tasks]
+        for future in concurrent.futures.as_completed(futures):
+            uuid, results = future.result()
+            logger.info(f'Swept {len(results)} configs for {uuid}.')
+            totals.add(results)
+
+
+def write_table(output_fp, rows, param_names):
+    fieldnames = ['config'] + param_names + STAT_COLUMNS
+    with open(output_fp, 'w', newline='') as csv_f:
+        writer = csv.DictWriter(csv_f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def echo_table(rows, param_names):
+    headers = ['config'] + [name.replace('TRIP_DETECTION_', '').lower() for name in param_names] + STAT_COLUMNS
+    keys = ['config'] + param_names + STAT_COLUMNS
+    lines = [[('-' if row[key] is None else str(row[key])) for key in keys] for row in rows]
+    widths = [max([len(h)] + [len(line[idx]) for line in lines]) for idx, h in enumerate(headers)]
+    click.echo('  '.join(h.rjust(w) for h, w in zip(headers, widths)))
+    for line in lines:
+        click.echo('  '.join(v.rjust(w) for v, w in zip(line, widths)))
+
+
+def run(cfg, runner_name, param_args, user_id=None, workers=1, batch_size=loader.DEFAULT_BATCH_SIZE):
+    '''
+    Runs trip detection for every combination of a grid of parameter values and writes a table
+    comparing the trips and complete days found with each combination. Each user's coordinates are
+    loaded and prepared once for all of the combinations it is given.
+
+    :param cfg:         The tripkit config for the survey.
+    :param runner_name: The importable name of the runner module providing `SWEEP_PARAMS` and `sweep_user`.
+    :param param_args:  The `NAME=VALUES` arguments of the parameters to sweep.
+    :param user_id:     (Optional) The user ID to sweep a single user only.
+    :param workers:     (Optional) The number of worker processes.
+    :param batch_size:  (Optional) The number of users loaded from the database at a time.
+    '''
+    runner = importlib.import_module(runner_name)
+    grid = parse_grid(param_args, runner.SWEEP_PARAMS)
+    combos = combinations(grid)
+    param_names = sorted(grid)
+    click.echo(f'Sweeping {len(combos)} configs of {", ".join(param_names)}...')
+
+    tripkit = runner.setup(cfg)
+    # load the subway entrances once for all users and worker processes
+    if 'TRIP_DETECTION_SUBWAY_BUFFER_METERS' in runner.SWEEP_PARAMS:
+        spatial.subway_index(tripkit)
+    totals = SweepTotals(combos)
+    if workers > 1:
+        if user_id:
+            uuids = [user.uuid for user in runner.load_users(tripkit, user_id)]
+        else:
+            uuids = loader.user_uuids(tripkit)
+        run_parallel(runner_name, tripkit, uuids, combos, totals, workers)
+    else:
+        users = runner.load_users(tripkit, user_id, batch_size=batch_size)
+        run_serial(runner, tripkit, users, combos, totals)
+
+    rows = list(totals.rows())
+    output_fp = os.path.join(cfg.OUTPUT_DATA_DIR, f'{cfg.SURVEY_NAME}-sweep.csv')
+    os.makedirs(cfg.OUTPUT_DATA_DIR, exist_ok=True)
+    write_table(output_fp, rows, param_names)
+    echo_table(rows, param_names)
+    click.echo(f'Wrote sweep comparison to {output_fp}')
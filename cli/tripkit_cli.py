@@ -6,7 +6,9 @@ import logging
 import os
 import sys
 
-from cli import runners
+# commands import the runner and processing modules they use when invoked so that help and
+# config errors are shown without first importing tripkit
+from cli import runners, shards
 
 
 def dynamic_import(filepath, module_name):
@@ -17,7 +19,7 @@ def dynamic_import(filepath, module_name):
 
 
 # TODO: rename function
-@click.command()
+@click.group(invoke_without_command=True)
 @click.option('-c', '--config', 'config_fp', default='./tripkit_config.py', help='A Python file of global variables to set processing parameters.')
 @click.option('-q', '--verbose', is_flag=True, help='Enable info logging output to console.')
 @click.option('-q', '--quiet', is_flag=True, help='Output only warnings to console.')
@@ -28,11 +30,19 @@ def dynamic_import(filepath, module_name):
 @click.option('-cn', '--condensed', 'condensed_output', is_flag=True, help='(QStarz only) Create a condensed output with a locations file, trips summaries, and aggregate survey summary.')
 @click.option('-wi', '--write-inputs', is_flag=True, help='Write input .csv coordinates data to GIS format.')
 @click.option('-wg', '--write-geo', is_flag=True, help='Write output GIS data for each user in survey.')
+@click.option('--workers', default=1, type=click.IntRange(min=1), help='Number of worker processes to process users in parallel.')
+@click.option('--incremental', is_flag=True, help='Skip users unchanged since the last incremental run and reuse their outputs.')
+@click.option('--batch-size', default=100, type=click.IntRange(min=1), help='Number of users loaded from the database at a time.')
+@click.option('--shard', callback=shards.parse_shard, help='Process only shard i of N of the users as i/N, writing outputs and a cache database named for the shard.')
+@click.option('--window', type=click.Choice(['day', 'week']), help="(QStarz only) Stream each user's coordinates through processing one day or week at a time to bound memory use on long traces.")
+@click.option('--profile', is_flag=True, help='Write a report of the time and memory used by each processing stage for each user.')
+@click.option('--profile-top', default=0, type=click.IntRange(min=0), help='With --profile, save cProfile dumps of this many of the slowest users.')
 @click.pass_context
 def main(ctx, config_fp, verbose, quiet, *ivk_args, **ivk_kwargs):
     '''
     The itinerum-tripkit-cli provides an interface for using the itinerum-tripkit processing library
-    on Itinerum or QStarz .csv data.
+    on Itinerum or QStarz .csv data. Runs the processing for the config's data type unless a
+    command is given.
     '''
     if not os.path.exists(config_fp):
         click.echo('Error: config could not be found.')
@@ -48,9 +58,80 @@ def main(ctx, config_fp, verbose, quiet, *ivk_args, **ivk_kwargs):
     else:
         logging.basicConfig(level=logging.INFO)
 
-    if cfg.INPUT_DATA_TYPE == 'itinerum':
-        ctx.invoke(runners.itinerum.run, **ivk_kwargs)
-    elif cfg.INPUT_DATA_TYPE == 'qstarz':
-        ctx.invoke(runners.qstarz.run, **ivk_kwargs)
-    else:
+    if ctx.invoked_subcommand:
+        return
+    if cfg.INPUT_DATA_TYPE not in runners.RUNNERS:
+        click.echo(f'Data type {cfg.INPUT_DATA_TYPE} not recognized.')
+        return
+    ctx.invoke(runners.load(cfg.INPUT_DATA_TYPE).run, **ivk_kwargs)
+
+
+def check_data_type(cfg):
+    if cfg.INPUT_DATA_TYPE not in runners.RUNNERS:
         click.echo(f'Data type {cfg.INPUT_DATA_TYPE} not recognized.')
+        sys.exit(1)
+
+
+@main.command('import')
+@click.option('--workers', default=1, type=click.IntRange(min=1), help='Number of worker processes to parse input files in parallel.')
+@click.option('--force', is_flag=True, help='Reimport all input files even if unchanged since the last import.')
+@click.option('--shard', callback=shards.parse_shard, help='Import to the cache database of shard i of N as i/N.')
+@click.pass_context
+def import_command(ctx, workers, force, shard):
+    '''
+    Imports the input .csv data to the cache database, skipping files unchanged since the last import.
+    '''
+    from cli import importer
+
+    cfg = ctx.obj['config']
+    check_data_type(cfg)
+    shards.use_shard(cfg, shard)
+    importer.run(cfg, workers=workers, force=force)
+
+
+@main.command('sweep')
+@click.option('-p', '--param', 'param_args', multiple=True, required=True, help='A trip detection parameter and its values to sweep as NAME=v1,v2,... or NAME=start:stop:step, can be repeated.')
+@click.option('-u', '--user', 'user_id', help='The user ID to sweep a single user only.')
+@click.option('--workers', default=1, type=click.IntRange(min=1), help='Number of worker processes to sweep users and parameter combinations in parallel.')
+@click.option('--batch-size', default=100, type=click.IntRange(min=1), help='Number of users loaded from the database at a time.')
+@click.pass_context
+def sweep_command(ctx, param_args, user_id, workers, batch_size):
+    '''
+    Runs trip detection for every combination of the given parameter values and writes a table
+    comparing the trips and complete days detected with each.
+    '''
+    from cli import sweep
+
+    cfg = ctx.obj['config']
+    check_data_type(cfg)
+    sweep.run(cfg, runners.RUNNERS[cfg.INPUT_DATA_TYPE], param_args, user_id=user_id, workers=workers, batch_size=batch_size)
+
+
+@main.command('merge')
+@click.option('-n', '--shards', 'num_shards', required=True, type=click.IntRange(min=1), help='The number of shards the survey was processed as.')
+@click.option('-d', '--dir', 'shards_dir', type=click.Path(exists=True, file_okay=False), help='Directory of the shard outputs, defaults to the output directory.')
+@click.pass_context
+def merge_command(ctx, num_shards, shards_dir):
+    '''
+    Combines the outputs written by the runs of each --shard into the survey-wide files of the survey.
+    '''
+    shards.merge(ctx.obj['config'], num_shards, shards_dir=shards_dir)
+
+
+@main.command('watch')
+@click.option('-i', '--interval', 'interval_s', default=5, type=click.IntRange(min=1), help='Seconds between polls of the input data directory.')
+@click.option('-wg', '--write-geo', is_flag=True, help='Write output GIS data for each user in survey.')
+@click.option('--workers', default=1, type=click.IntRange(min=1), help='Number of worker processes to process changed users in parallel.')
+@click.option('--batch-size', default=100, type=click.IntRange(min=1), help='Number of users loaded from the database at a time.')
+@click.option('--window', type=click.Choice(['day', 'week']), help="(QStarz only) Stream each user's coordinates through processing one day or week at a time to bound memory use on long traces.")
+@click.pass_context
+def watch_command(ctx, interval_s, write_geo, workers, batch_size, window):
+    '''
+    Keeps the survey loaded and polls the input data directory, importing new or appended input files
+    and processing only the users they change.
+    '''
+    from cli import watch
+
+    cfg = ctx.obj['config']
+    check_data_type(cfg)
+    watch.run(cfg, interval_s=interval_s, workers=workers, batch_size=batch_size, write_geo=write_geo, window=window)
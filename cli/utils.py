@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+import sys
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+
+def tripkit_version():
+    '''
+    Returns the installed itinerum-tripkit version for keying cached outputs.
+    '''
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError:
+        # Python 3.7 and earlier
+        import pkg_resources
+        version, PackageNotFoundError = (
+            lambda name: pkg_resources.get_distribution(name).version,
+            pkg_resources.DistributionNotFound,
+        )
+    try:
+        return version('itinerum-tripkit')
+    except PackageNotFoundError:
+        return 'unknown'
+
+
+def peak_memory_mb(children=False):
+    '''
+    Returns the peak resident memory of this process in megabytes, or `None` where not available.
+
+    :param children: Return the peak of the largest finished child process instead, such as a worker.
+    '''
+    if not resource:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    return maxrss_mb(usage)
+
+
+def maxrss_mb(usage):
+    '''
+    Returns the peak resident memory of a resource usage report in megabytes.
+    '''
+    # reported in bytes on macOS and kilobytes elsewhere
+    return usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+import click
+import logging
+import os
+import sys
+import time
+
+from peewee import fn
+from tripkit import TripKit
+from tripkit.database import Coordinate
+from tripkit.utils import misc
+
+from cli import coordinates, gis, loader, pipeline, runners, spatial
+from cli.importer import Importer
+from cli.manifest import RunManifest
+
+logger = logging.getLogger('itinerum-tripkit-cli.watch')
+
+DEFAULT_INTERVAL_S = 5
+
+
+def run_options(cfg, write_geo=False, window=None):
+    '''
+    Returns the `process_user` options of a run of every user by the config's runner, matching those
+    of the runner commands so the run manifest is shared with `--incremental` runs.
+    '''
+    options = {
+        'trips_only': False,
+        'complete_days_only': False,
+        'activity_summaries_only': False,
+        'write_inputs': False,
+        'write_geo': write_geo,
+        'append_fn_base': cfg.SURVEY_NAME,
+        'append_mode': True,
+    }
+    if cfg.INPUT_DATA_TYPE == 'qstarz':
+        options['condensed_output'] = False
+        if window:
+            options['window'] = window
+    return options
+
+
+def coordinate_stats(tripkit):
+    '''
+    Returns a summary of each user's coordinates from a single grouped query, compared before and
+    after rows are appended to find the users with new coordinates without reading their rows.
+    '''
+    query = Coordinate.select(
+        Coordinate.user,
+        fn.COUNT(Coordinate.id),
+        fn.MIN(Coordinate.timestamp_epoch),
+        fn.MAX(Coordinate.timestamp_epoch),
+    ).group_by(Coordinate.user)
+    return {row[0]: row[1:] for row in query.tuples()}
+
+
+class Watcher(object):
+    '''
+    Keeps a survey's TripKit instance, cache database connection and subway entrances index loaded
+    between polls of the input data directory. Input files changed since the last poll are imported
+    and only the users with appended coordinates are processed, while the stored outputs of the other
+    users are replayed from the run manifest to rewrite the survey-wide outputs. The first poll and
+    polls reimporting a rewritten coordinates file check every user against the run manifest as an
+    `--incremental` run would.
+
+    :param cfg:        The tripkit config for the survey.
+    :param options:    The runner options for every poll's run.
+    :param workers:    The number of worker processes started for each poll with changed users.
+    :param batch_size: The number of users loaded from the database at a time.
+    '''
+
+    def __init__(self, cfg, options, workers=1, batch_size=loader.DEFAULT_BATCH_SIZE):
+        self.cfg = cfg
+        self.options = options
+        self.workers = workers
+        self.batch_size = batch_size
+        self.runner_name = runners.RUNNERS[cfg.INPUT_DATA_TYPE]
+        self.tripkit = TripKit(config=cfg)
+        self.importer = Importer(self.tripkit)
+        subway_stations_fp = getattr(cfg, 'SUBWAY_STATIONS_FP', None)
+        self.subway_stations_fp = os.path.abspath(subway_stations_fp) if subway_stations_fp else None
+        # input file signatures as of the last poll and the last import
+        self.seen = self.signatures()
+        self.imported = None
+        # coordinate stats of the users processed by this watcher, unset until the first run succeeds
+        self.stats = None
+
+    def signatures(self):
+        signatures = {}
+        for fp, _ in self.importer.input_files():
+            try:
+                stat = os.stat(fp)
+                signatures[fp] = (stat.st_size, stat.st_mtime_ns)
+            except FileNotFoundError:
+                signatures[fp] = None
+        return signatures
+
+    def poll(self):
+        '''
+        Imports the input files changed since the last import once they are unchanged for a whole
+        polling interval, so files still being copied are not imported, and processes the users whose
+        coordinates changed. Returns the number of users processed, or None if no input files changed.
+        '''
+        signatures = self.signatures()
+        settled = signatures == self.seen
+        self.seen = signatures
+        if not settled or (self.stats is not None and signatures == self.imported):
+            return None
+
+        stations_changed = (
+            self.imported is not None
+            and self.subway_stations_fp
+            and signatures.get(self.subway_stations_fp) != self.imported.get(self.subway_stations_fp)
+        )
+        with self.importer:
+            self.importer.run()
+        self.imported = signatures
+        coordinates_fps = [fp for fp, input_file in self.importer.input_files() if input_file.model is Coordinate]
+        if any(self.importer.modes.get(fp) == 'full' for fp in coordinates_fps):
+            # rows changed within a rewritten file are only found by the users' fingerprints
+            self.stats = None
+
+        stats = coordinate_stats(self.tripkit)
+        if stations_changed and self.cfg.INPUT_DATA_TYPE == 'itinerum':
+            # the subway entrances are not part of the users' fingerprints so every user is reprocessed
+            logger.info('Subway stations changed, reprocessing all users...')
+            spatial.set_subway_index(None)
+            manifest = RunManifest(self.cfg, self.options)
+            manifest.clear()
+            manifest.close()
+            self.stats = None
+        if self.stats is None:
+            changed, stored = set(stats), set()
+        else:
+            changed = {uuid for uuid, user_stats in stats.items() if self.stats.get(uuid) != user_stats}
+            stored = set(stats) - changed
+            if not changed and set(self.stats) == set(stats):
+                click.echo('No users changed by the import.')
+                return 0
+
+        self.stats = None
+        # outputs written by earlier polls are replaced on first write as if left by a previous run
+        misc.RUN_TIME = time.time()
+        if self.cfg.INPUT_DATA_TYPE == 'itinerum':
+            spatial.subway_index(self.tripkit)
+        users = loader.iter_users(self.tripkit, batch_size=self.batch_size, stored=stored)
+        num_processed = pipeline.run_users(
+            self.tripkit,
+            self.runner_name,
+            users,
+            self.options,
+            workers=self.workers,
+            incremental=True,
+            batch_size=self.batch_size,
+        )
+        self.stats = stats
+        return num_processed
+
+
+def run(cfg, interval_s=DEFAULT_INTERVAL_S, workers=1, batch_size=loader.DEFAULT_BATCH_SIZE, write_geo=False, window=None):
+    '''
+    Polls the survey's input data directory until interrupted, importing new input files and
+    processing the users they change with the survey kept loaded between polls.
+
+    :param cfg:        The tripkit config for the survey.
+    :param interval_s: (Optional) The number of seconds between polls.
+    :param workers:    (Optional) The number of worker processes to process changed users in parallel.
+    :param batch_size: (Optional) The number of users loaded from the database at a time.
+    :param write_geo:  (Optional) Write output GIS data for each user.
+    :param window:     (Optional) (QStarz only) Process each user's coordinates a day or week at a time.
+    '''
+    if window and cfg.INPUT_DATA_TYPE != 'qstarz':
+        click.echo('Error: windowed processing is only available for QStarz datasets.')
+        sys.exit(1)
+    if write_geo:
+        gis.check_config(cfg)
+    coordinates.set_streaming(bool(window))
+    watcher = Watcher(cfg, run_options(cfg, write_geo=write_geo, window=window), workers=workers, batch_size=batch_size)
+
+    click.echo(f'Watching {cfg.INPUT_DATA_DIR} for new input data every {interval_s}s, press Ctrl+C to stop...')
+    try:
+        while True:
+            start_time = time.time()
+            try:
+                num_updated = watcher.poll()
+            except Exception:
+                # users left unprocessed are checked against the run manifest by the next poll
+                logger.exception('Processing the new input data failed.')
+                num_updated = None
+            if num_updated:
+                click.echo(f'Updated the outputs of {num_updated} users in {time.time() - start_time:.1f}s')
+            time.sleep(interval_s)
+    except KeyboardInterrupt:
+        click.echo('Stopped watching.')
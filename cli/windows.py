@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+# Kyle Fitzsimmons, 2019
+import itertools
+import logging
+import math
+import types
+
+import numpy as np
+from tripkit.process.activities.canue import detect_locations as canue_locations
+from tripkit.process.canue import preprocess
+from tripkit.process.clustering.kmeans import MAX_AVG_DISTANCE, MIN_STOP_TIME
+from tripkit.process.trip_detection.canue import algorithm, location_split
+from tripkit.utils import geo
+
+from cli import coordinates
+from cli.cache import PreparedCoordinatesCache
+
+logger = logging.getLogger('itinerum-tripkit-cli.windows')
+
+WINDOW_SECONDS = {
+    'day': 24 * 60 * 60,
+    'week': 7 * 24 * 60 * 60,
+}
+# pre-processed coordinates written to the cache at a time
+PREPARED_CHUNK_ROWS = 50000
+# points on each side of a coordinate within its rolling averages, as in `canue.preprocess`
+ROLLING_HALF_SIZE = 10
+# pre-processed coordinates of a chunk pre-processed again before the next chunk for its rolling averages,
+# and one more since the first has no bearing for the change in heading of the second
+OVERLAP_ROWS = 2 * ROLLING_HALF_SIZE + 2
+# width of the bins of clipped average distances clustered into stops and trips
+DISTANCE_BIN_M = 0.01
+NUM_DISTANCE_BINS = int(round(MAX_AVG_DISTANCE / DISTANCE_BIN_M)) + 1
+# distances used by `canue.algorithm.run`
+MIN_SEGMENT_DISTANCE_M = 250
+MISSING_SEGMENT_M = 250
+# cached columns read by the clustering of each window
+CLUSTER_COLUMNS = ['easting', 'northing', 'zone_num', 'zone_letter', 'timestamp_epoch', 'avg_distance_m', 'avg_delta_heading']
+
+
+def _chunks(items, size):
+    items = iter(items)
+    chunk = list(itertools.islice(items, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(items, size))
+
+
+class _Coordinates(list):
+    # coordinates counted like a coordinates query by `canue.preprocess.run`
+    def count(self):
+        return len(self)
+
+
+def _as_raw(gc):
+    # a pre-processed coordinate passed back to `canue.preprocess.run` as the raw coordinate it was made from
+    return types.SimpleNamespace(
+        uuid=gc.uuid,
+        latitude=gc.latitude,
+        longitude=gc.longitude,
+        timestamp_UTC=gc.timestamp_UTC.isoformat(),
+        altitude=gc.altitude,
+        speed=gc.speed,
+        timestamp_epoch=gc.timestamp_epoch,
+    )
+
+
+def iter_prepared(uuid, points):
+    '''
+    Yields a user's pre-processed coordinates from `canue.preprocess.run` on consecutive chunks of
+    the raw coordinates. Each chunk is pre-processed following the last pre-processed coordinates of
+    the chunk before, so its points are filtered and averaged as in the whole trace while holding only
+    one chunk in memory.
+
+    :param uuid:   The user's uuid.
+    :param points: The user's raw coordinates in timestamp order.
+    '''
+    carried, num_pending = [], 0
+    for chunk in _chunks(points, PREPARED_CHUNK_ROWS):
+        prepared = preprocess.run(uuid, _Coordinates([_as_raw(gc) for gc in carried] + chunk))
+        # a point's rolling averages are known once the points following it are pre-processed
+        start = len(carried) - num_pending
+        end = max(start, len(prepared) - ROLLING_HALF_SIZE)
+        yield from prepared[start:end]
+        carried, num_pending = prepared[-OVERLAP_ROWS:], len(prepared) - end
+    # the last points have too few trailing points for their rolling averages
+    yield from carried[len(carried) - num_pending:]
+
+
+class PreparedWindows(object):
+    '''
+    A user's pre-processed coordinates in the prepared coordinates cache, iterated as a list of
+    coordinates for each time window read from disk only when reached.
+
+    :param cache:  The :py:class:`cli.cache.PreparedCoordinatesCache` holding the coordinates.
+    :param key:    The cache key of the user's pre-processed coordinates.
+    :param slices: The row slices of each time window.
+    '''
+
+    def __init__(self, cache, key, slices):
+        self.cache = cache
+        self.key = key
+        self.slices = slices
+
+    def __iter__(self):
+        for rows in self.slices:
+            yield self.cache.load(self.key, rows=rows)
+
+    def __len__(self):
+        return len(self.slices)
+
+    def columns(self, names):
+        '''
+        Yields the arrays of the given columns for each time window.
+        '''
+        for rows in self.slices:
+            yield self.cache.load_columns(self.key, names, rows=rows)
+
+
+def prepare(tripkit, user, window_s):
+    '''
+    Returns a user's pre-processed coordinates as :py:class:`PreparedWindows`, streaming the raw
+    coordinates through the pre-processing into the cache in chunks when not already cached.
+
+    :param tripkit:  The TripKit instance for the survey.
+    :param user:     The user to process.
+    :param window_s: The length of each time window in seconds.
+    '''
+    cache = PreparedCoordinatesCache(tripkit.config)
+    key = cache.key(user)
+    slices = cache.window_slices(key, window_s)
+    if slices is None:
+        logger.debug('Pre-processing raw coordinates data in chunks...')
+        prepared = iter_prepared(user.uuid, coordinates.iter_points(user))
+        cache.save_chunks(key, user.uuid, _chunks(prepared, PREPARED_CHUNK_ROWS))
+        slices = cache.window_slices(key, window_s)
+    return PreparedWindows(cache, key, slices)
+
+
+def _distance_bins(avg_distances):
+    distances = np.minimum(np.nan_to_num(avg_distances, nan=0.0), MAX_AVG_DISTANCE)
+    return np.minimum((distances / DISTANCE_BIN_M).astype(np.int64), NUM_DISTANCE_BINS - 1), distances
+
+
+class ClusterThresholds(object):
+    '''
+    Running totals of a user's pre-processed coordinates updated one window at a time, from which
+    the stop and trip clusters of `clustering.kmeans` and the heading threshold of
+    `clustering.delta_heading_stdev` are found without holding every coordinate. The 2-means
+    clustering of average distances is solved exactly over a fine histogram of the values.
+    '''
+
+    def __init__(self):
+        self.bin_counts = np.zeros(NUM_DISTANCE_BINS, dtype=np.int64)
+        self.bin_sums = np.zeros(NUM_DISTANCE_BINS)
+        # count, mean and sum of squared differences of the truthy average delta headings
+        self.num_headings, self.heading_mean, self.heading_m2 = 0, 0.0, 0.0
+        self.min_heading, self.max_heading = math.inf, -math.inf
+
+    def add(self, avg_distances, avg_delta_headings):
+        bins, distances = _distance_bins(avg_distances)
+        self.bin_counts += np.bincount(bins, minlength=NUM_DISTANCE_BINS)
+        self.bin_sums += np.bincount(bins, weights=distances, minlength=NUM_DISTANCE_BINS)
+
+        headings = avg_delta_headings[~np.isnan(avg_delta_headings) & (avg_delta_headings != 0)]
+        if not len(headings):
+            return
+        # combine the window's variance with the running variance (Chan et al.)
+        num, mean = len(headings), headings.mean()
+        m2 = ((headings - mean) ** 2).sum()
+        total = self.num_headings + num
+        delta = mean - self.heading_mean
+        self.heading_m2 += m2 + delta ** 2 * self.num_headings * num / total
+        self.heading_mean += delta * num / total
+        self.num_headings = total
+        self.min_heading = min(self.min_heading, headings.min())
+        self.max_heading = max(self.max_heading, headings.max())
+
+    def stop_bin(self):
+        '''
+        Returns the last histogram bin of the stop cluster, the cluster of lower average distances.
+        '''
+        counts = np.cumsum(self.bin_counts)[:-1]
+        sums = np.cumsum(self.bin_sums)[:-1]
+        total, total_sum = self.bin_counts.sum(), self.bin_sums.sum()
+        valid = (counts > 0) & (counts < total)
+        if not valid.any():
+            return NUM_DISTANCE_BINS - 1
+        # the split minimizing the within-cluster sum of squares maximizes the sum of S^2 / n of both clusters
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = sums ** 2 / counts + (total_sum - sums) ** 2 / (total - counts)
+        return int(np.argmax(np.where(valid, scores, -np.inf)))
+
+    def heading_threshold(self):
+        if not self.num_headings:
+            return None
+        offset = round((self.max_heading - self.min_heading) / 2)
+        return math.sqrt(self.heading_m2 / self.num_headings) + offset
+
+
+class _StopGroup(object):
+    # running sums of a group's projected coordinates for its centroid, as `geo.centroid`
+    def __init__(self):
+        self.easting, self.northing, self.count = 0, 0, 0
+        self.zones = set()
+        self.start_epoch, self.end_epoch = None, None
+
+    def add(self, easting, northing, zone, epoch):
+        self.easting += easting
+        self.northing += northing
+        self.count += 1
+        self.zones.add(zone)
+        if self.start_epoch is None:
+            self.start_epoch = epoch
+        self.end_epoch = epoch
+
+    def is_stop(self):
+        # stops shorter than the minimum stop time are relabeled as trips
+        return self.end_epoch - self.start_epoch >= MIN_STOP_TIME
+
+    def centroid(self):
+        assert len(self.zones) == 1  # asserts all points are from the same UTM zone
+        zone_num, zone_letter = list(self.zones)[0]
+        return geo.Centroid(self.easting / self.count, self.northing / self.count, zone_num, zone_letter)
+
+
+def detect_locations(windows):
+    '''
+    Returns the activity locations of a user's pre-processed coordinates from
+    `canue.detect_locations.run`, clustering the coordinates one window at a time. The cluster
+    thresholds are totaled over a first pass of the windows and the stop groups of each
+    clustering are then grouped over a second pass, with only the open groups carried between
+    windows. Each stop group is given to tripkit as its centroid, which is its own centroid.
+
+    :param windows: The user's :py:class:`PreparedWindows`.
+    '''
+    thresholds = ClusterThresholds()
+    for columns in windows.columns(['avg_distance_m', 'avg_delta_heading']):
+        thresholds.add(columns['avg_distance_m'], columns['avg_delta_heading'])
+    stop_bin = thresholds.stop_bin()
+    heading_threshold = thresholds.heading_threshold()
+
+    kmeans_centroids, stdev_centroids = [], []
+    kmeans_group, kmeans_is_stop, stdev_group = None, False, None
+    for columns in windows.columns(CLUSTER_COLUMNS):
+        bins, _ = _distance_bins(columns['avg_distance_m'])
+        points = zip(
+            (bins <= stop_bin).tolist(),
+            columns['avg_delta_heading'].tolist(),
+            columns['easting'].tolist(),
+            columns['northing'].tolist(),
+            zip(columns['zone_num'].tolist(), columns['zone_letter'].tolist()),
+            columns['timestamp_epoch'].tolist(),
+        )
+        for is_stop, heading, easting, northing, zone, epoch in points:
+            if kmeans_group is None or is_stop != kmeans_is_stop:
+                if kmeans_is_stop and kmeans_group.is_stop():
+                    kmeans_centroids.append(kmeans_group.centroid())
+                kmeans_group, kmeans_is_stop = _StopGroup(), is_stop
+            kmeans_group.add(easting, northing, zone, epoch)
+
+            # missing average headings are stored as NaN
+            if heading_threshold is None or heading != heading or not heading:
+                continue
+            if heading >= heading_threshold:
+                stdev_group = stdev_group if stdev_group else _StopGroup()
+                stdev_group.add(easting, northing, zone, epoch)
+            elif stdev_group:
+                stdev_centroids.append(stdev_group.centroid())
+                stdev_group = None
+    if kmeans_is_stop and kmeans_group.is_stop():
+        kmeans_centroids.append(kmeans_group.centroid())
+
+    kmeans_groups = {'clusters': [[ce] for ce in kmeans_centroids], 'stops': range(len(kmeans_centroids))}
+    return canue_locations.run(kmeans_groups, [[ce] for ce in stdev_centroids])
+
+
+class TripStitcher(object):
+    '''
+    Detects trips with the CANUE trip detection of `canue.algorithm.run` from a user's pre-processed
+    coordinates given one at a time. Time gap segments are split at stop locations point by point,
+    since a continuously logging QStarz device can record its whole trace as one segment, with the
+    open split and its points at a stop location carried over from one window to the next. The
+    valid segments are then made into trips by tripkit as from the whole trace.
+
+    :param cfg:       The tripkit config for the survey.
+    :param locations: The user's activity locations.
+    '''
+
+    def __init__(self, cfg, locations):
+        self.period_s = cfg.TRIP_DETECTION_BREAK_INTERVAL_SECONDS
+        self.locations = locations
+        self.last_c = None
+        self.split = []
+        self.stop_points = []
+        self.valid_segments = []
+
+    def _close_split(self):
+        split, self.split = self.split, []
+        self.valid_segments.extend(algorithm.filter_too_short_segments([split], min_distance_m=MIN_SEGMENT_DISTANCE_M))
+
+    def _close_segment(self, is_last):
+        # leftover stop points at the end of segments are considered valid
+        if self.stop_points:
+            if not is_last:
+                self.split.extend(self.stop_points)
+            else:
+                stop_centroid = location_split._common_centroid(self.stop_points, self.locations)
+                if self.split:
+                    self.split.extend(
+                        location_split._append_to_split(self.split[-1], self.stop_points, stop_centroid, self.period_s)
+                    )
+            self.stop_points = []
+        self._close_split()
+
+    def _split_by_stop_location(self, c):
+        stop_label = location_split._nearest_location(c, self.locations, buffer_m=60)
+        if stop_label:
+            c.stop_label = stop_label
+            self.stop_points.append(c)
+        elif self.stop_points:
+            diff_s = self.stop_points[-1].timestamp_epoch - self.stop_points[0].timestamp_epoch
+            if diff_s >= self.period_s:
+                stop_centroid = location_split._common_centroid(self.stop_points, self.locations)
+                if self.split:
+                    self.split.extend(
+                        location_split._append_to_split(self.split[-1], self.stop_points, stop_centroid, self.period_s)
+                    )
+                prepend_points = location_split._prepend_to_split(c, self.stop_points, stop_centroid, self.period_s)
+                self._close_split()
+                self.split = prepend_points + [c]
+            else:
+                self.split.extend(self.stop_points)
+            self.stop_points = []
+        else:
+            self.split.append(c)
+
+    def add(self, c):
+        # the first point begins the time gaps and is not part of a segment
+        if self.last_c is None:
+            self.last_c = c
+            return
+        if c.timestamp_epoch - self.last_c.timestamp_epoch > self.period_s:
+            self._close_segment(is_last=False)
+        self._split_by_stop_location(c)
+        self.last_c = c
+
+    def finish(self):
+        '''
+        Returns the detected trips once every coordinate has been added.
+        '''
+        self._close_segment(is_last=True)
+        missing_segments = algorithm.detect_missing_segments(self.valid_segments, missing_segment_m=MISSING_SEGMENT_M)
+        return algorithm.wrap_for_tripkit(algorithm.make_trips_diary(self.valid_segments, missing_segments))
+
+
+def detect_trips(cfg, windows, locations):
+    '''
+    Returns the trips detected from a user's pre-processed coordinates read one window at a time.
+
+    :param cfg:       The tripkit config for the survey.
+    :param windows:   The user's :py:class:`PreparedWindows`.
+    :param locations: The user's activity locations.
+    '''
+    stitcher = TripStitcher(cfg, locations)
+    for window in windows:
+        for c in window:
+            stitcher.add(c)
+    return stitcher.finish()
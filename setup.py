@@ -15,6 +15,7 @@ setuptools.setup(
     install_requires=[
         'Click',
         'itinerum-tripkit==0.0.16',
+        'numpy',
     ],
     entry_points='''
         [console_scripts]